@@ -0,0 +1,109 @@
+'''Compares the ways of checking path consistency on a synthetic catalog.
+
+Measures the rate at which the checker compares the physical paths of replicas with their collection
+names, using pathlib for every replica (as earlier versions did) and using string comparison, on rows
+that have been fetched in advance. It also times the path consistency test as a whole, in each of the
+modes of the --path-consistency-mode option. The results are printed as JSON.'''
+
+from argparse import ArgumentParser, Namespace
+from benchmarks import synthetic_catalog
+from benchmarks.run_benchmarks import CountingOutputProcessor
+from icat_tools import utils
+from icat_tools.coll_path_store import CollectionPathStore
+from icat_tools.detectors.pathinconsistency_detector import PathConsistencyChecker, PathInconsistencyDetector
+from icat_tools.query_profiler import QueryProfiler
+import json
+import psycopg2
+import sys
+import time
+
+MODES = ['script', 'sql']
+
+
+def get_rows(connection):
+    cursor = connection.cursor('get_rows')
+    cursor.execute("SELECT {} FROM r_data_main".format(", ".join(PathConsistencyChecker.columns)))
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+
+def time_comparison(compare, rows):
+    '''Compares the paths of all rows, and returns the wall time, rate and number of findings. '''
+    start = time.monotonic()
+    findings = sum(1 for _ in compare(rows))
+    wall_time = time.monotonic() - start
+    return {'wall_time': wall_time, 'rows_per_second': len(rows) / wall_time if wall_time > 0 else None,
+            'findings': findings}
+
+
+def run_benchmark(connection, repeat):
+    def get_checker():
+        return PathConsistencyChecker(utils.get_resource_vault_path_dict(connection),
+                                      utils.get_resource_name_dict(connection),
+                                      CollectionPathStore.from_database(connection))
+
+    def compare_pathlib(rows):
+        checker = get_checker()
+        findings = (checker.check_path(row) for row in rows if row[2] in checker.resource_path_lookup)
+        return (finding for finding in findings if finding is not None)
+
+    def compare_strings(rows):
+        return get_checker().visit(rows)
+
+    rows = get_rows(connection)
+    connection.rollback()
+    results = []
+    for comparison, compare in [('pathlib', compare_pathlib), ('strings', compare_strings)]:
+        for run in range(repeat):
+            result = time_comparison(compare, rows)
+            result.update({'benchmark': 'comparison', 'method': comparison, 'run': run, 'rows': len(rows)})
+            results.append(result)
+            connection.rollback()
+
+    for mode in MODES:
+        for run in range(repeat):
+            output_processor = CountingOutputProcessor()
+            # The profiler counts the rows that the queries of the test return
+            profiler = QueryProfiler()
+            detector = PathInconsistencyDetector(
+                Namespace(path_consistency_mode=mode, data_object_prefix=None, v=False, conflict_retries=0,
+                          lookup_cache=None),
+                connection, output_processor, profiler=profiler)
+            start = time.monotonic()
+            detector.run()
+            results.append({'benchmark': 'test', 'method': mode, 'run': run,
+                            'wall_time': time.monotonic() - start,
+                            'rows_fetched': sum(record['rows_fetched'] for record in profiler.records),
+                            'findings': output_processor.findings})
+            connection.rollback()
+
+    return results
+
+
+def get_arguments():
+    parser = ArgumentParser(description="Compares the ways of checking path consistency")
+    parser.add_argument('--dsn', required=True,
+                        help='libpq connection string of the benchmark database')
+    parser.add_argument('--populate', action='store_const', const=True,
+                        help='Create a synthetic catalog in the (empty) benchmark database first')
+    parser.add_argument('--data-objects', type=int, default=100000,
+                        help='Number of data objects of the synthetic catalog (default: 100000)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each comparison (default: 3)')
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+    connection = psycopg2.connect(args.dsn)
+    if args.populate:
+        synthetic_catalog.create_schema(connection)
+        synthetic_catalog.populate(connection, collections=max(1, args.data_objects // 100),
+                                   data_objects=args.data_objects)
+    json.dump(run_benchmark(connection, args.repeat), sys.stdout, indent=2)
+    print()
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+'''Compares the query shapes of the referential integrity checks on a synthetic catalog.
+
+Runs each referential integrity check with each query shape, as well as the merged check of each
+table, and prints the wall time and number of findings of each query as JSON. The checks of each
+table that the client engine can run are also timed with that engine, once with the id sets that
+they need loaded in advance and once including the time to load them.'''
+
+from argparse import ArgumentParser, Namespace
+from benchmarks import synthetic_catalog
+from benchmarks.run_benchmarks import CountingOutputProcessor
+from icat_tools.detectors.refintegrityissue_detector import RefIntegrityIssueDetector, can_run_on_client, compile_conditions
+import json
+import psycopg2
+import sys
+import time
+
+QUERY_SHAPES = ['not_in', 'not_exists', 'left_join']
+
+
+def time_query(run_query):
+    '''Runs a query, fetches all rows, and returns the wall time and number of rows. '''
+    start = time.monotonic()
+    cursor = run_query()
+    number_rows = len(cursor.fetchall())
+    cursor.close()
+    return time.monotonic() - start, number_rows
+
+
+def run_benchmark(connection, repeat):
+    detector = RefIntegrityIssueDetector(
+        Namespace(ref_integrity_check='all', ref_integrity_merge=False, ref_integrity_engine='database',
+                  data_object_prefix=None, v=False),
+        connection, None)
+    results = []
+
+    for check_name, check_params in detector._get_ref_integrity_data():
+        for query_shape in QUERY_SHAPES:
+            conditions, joins = compile_conditions(check_params, query_shape)
+            for run in range(repeat):
+                wall_time, findings = time_query(lambda: detector._check_ref_integrity(
+                    check_params['table'], check_params['report_columns'], conditions, joins))
+                results.append({'check_name': check_name, 'query_shape': query_shape,
+                                'run': run, 'wall_time': wall_time, 'findings': findings})
+
+    for table, checks in detector._get_checks_by_table().items():
+        for run in range(repeat):
+            wall_time, findings = time_query(lambda: detector._check_ref_integrity_merged(table, checks)[1])
+            results.append({'check_name': table, 'query_shape': 'merged',
+                            'run': run, 'wall_time': wall_time, 'findings': findings})
+
+    for table, checks in detector._get_checks_by_table().items():
+        client_checks = [check for check in checks if can_run_on_client(check[1])]
+        if len(client_checks) == 0:
+            continue
+        for run in range(repeat):
+            for preloaded in [True, False]:
+                output_processor = CountingOutputProcessor()
+                client_detector = RefIntegrityIssueDetector(detector.args, connection, output_processor)
+                if preloaded:
+                    for _, check_params in client_checks:
+                        for _, ref_table, ref_column in check_params.get('references', []) + check_params.get('collisions', []):
+                            client_detector._get_id_set(ref_table, ref_column)
+                start = time.monotonic()
+                client_detector._run_client_checks(table, client_checks)
+                results.append({'check_name': table, 'query_shape': 'client' if preloaded else 'client_with_loading',
+                                'run': run, 'wall_time': time.monotonic() - start,
+                                'findings': output_processor.findings,
+                                'id_set_bytes': sum(id_set.get_size() for id_set in client_detector.id_set_cache.id_sets.values())})
+            connection.rollback()
+
+    return results
+
+
+def get_arguments():
+    parser = ArgumentParser(description="Compares the query shapes of the referential integrity checks")
+    parser.add_argument('--dsn', required=True,
+                        help='libpq connection string of the benchmark database')
+    parser.add_argument('--populate', action='store_const', const=True,
+                        help='Create a synthetic catalog in the (empty) benchmark database first')
+    parser.add_argument('--data-objects', type=int, default=100000,
+                        help='Number of data objects of the synthetic catalog (default: 100000)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each query (default: 3)')
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+    connection = psycopg2.connect(args.dsn)
+    if args.populate:
+        synthetic_catalog.create_schema(connection)
+        synthetic_catalog.populate(connection, collections=max(1, args.data_objects // 100),
+                                   data_objects=args.data_objects)
+    json.dump(run_benchmark(connection, args.repeat), sys.stdout, indent=2)
+    print()
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+'''Times every detector and sub-check of the database checker on a synthetic catalog.
+
+Each detector, or each sub-check of detectors that have sub-checks, runs in a fresh worker
+process, so that its peak memory use can be measured. The results are written as JSON, so
+that results of different versions can be compared.'''
+
+from argparse import ArgumentParser, FileType
+from benchmarks import synthetic_catalog
+from icat_tools import dbcheck_command, utils
+from icat_tools.dbcheck_outputprocessors import OutputProcessor
+from icat_tools.name_resolver import ObjectNameResolver
+from icat_tools.scan_engine import ScanEngine
+import json
+import multiprocessing
+import platform
+import psycopg2
+import resource
+import shlex
+import sys
+import time
+
+# Tables whose size is recorded with the results
+CATALOG_TABLES = ['r_coll_main', 'r_data_main', 'r_objt_access', 'r_objt_metamap', 'r_meta_main']
+
+
+class CountingOutputProcessor(OutputProcessor):
+    '''Output processor that only counts findings. '''
+
+    def __init__(self):
+        super().__init__(None)
+        self.findings = 0
+
+    def output_item(self, check, values):
+        self.findings += 1
+
+    def print_progress(self, message):
+        pass
+
+
+def _run_unit(dsn, checker_argv, detector_name, subcheck):
+    '''Runs a detector, or one sub-check of a detector, in a worker process. '''
+    connection = psycopg2.connect(dsn)
+    args = dbcheck_command.get_arguments(checker_argv)
+    output_processor = CountingOutputProcessor()
+    detectors = dbcheck_command.get_detectors(args, connection, output_processor, ObjectNameResolver(connection),
+                                              None, ScanEngine(itersize=args.itersize))
+    detector = [detector for detector in detectors if detector.get_name() == detector_name][0]
+    if subcheck is not None:
+        detector.restrict_to_subcheck(subcheck)
+
+    start = time.monotonic()
+    detector.run()
+    wall_time = time.monotonic() - start
+    rows_scanned = utils.get_rows_scanned(connection)
+    connection.close()
+
+    return {'test': detector_name,
+            'subcheck': subcheck,
+            'wall_time': wall_time,
+            'rows_scanned': rows_scanned,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'findings': output_processor.findings}
+
+
+def get_units(dsn, checker_argv):
+    '''Returns (detector name, sub-check) tuples for all units of work of the selected tests. '''
+    connection = psycopg2.connect(dsn)
+    args = dbcheck_command.get_arguments(checker_argv)
+    detectors = dbcheck_command.get_detectors(args, connection, CountingOutputProcessor(),
+                                              ObjectNameResolver(connection), None, ScanEngine())
+    units = []
+    for detector in detectors:
+        subchecks = detector.get_subchecks()
+        if len(subchecks) == 0:
+            units.append((detector.get_name(), None))
+        else:
+            units.extend((detector.get_name(), subcheck) for subcheck in subchecks)
+    connection.close()
+    return units
+
+
+def get_catalog_metadata(dsn):
+    connection = psycopg2.connect(dsn)
+    cursor = connection.cursor()
+    cursor.execute("SHOW server_version")
+    metadata = {'server_version': cursor.fetchone()[0],
+                'python_version': platform.python_version(),
+                'table_rows': {}}
+    for table in CATALOG_TABLES:
+        cursor.execute("SELECT count(*) FROM {}".format(table))
+        metadata['table_rows'][table] = cursor.fetchone()[0]
+    cursor.close()
+    connection.close()
+    return metadata
+
+
+def get_arguments():
+    parser = ArgumentParser(description="Times every detector and sub-check on a synthetic catalog")
+    synthetic_catalog.add_catalog_arguments(parser)
+    parser.add_argument('--populate', action='store_const', const=True,
+                        help='Create a synthetic catalog in the (empty) benchmark database first')
+    parser.add_argument('--checker-args', default='',
+                        help='Options for the database checker, e.g. "--run-test names --min-replicas 2"')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of runs of each unit (default: 1)')
+    parser.add_argument('-o', '--output', type=FileType('w'), default=sys.stdout,
+                        help='Output file for the JSON results (default: standard output)')
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+    if args.populate:
+        connection = psycopg2.connect(args.dsn)
+        synthetic_catalog.populate_from_arguments(connection, args)
+        connection.close()
+
+    checker_argv = shlex.split(args.checker_args)
+    results = []
+    # A worker process is used for a single unit, so that peak memory use is measured per unit
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        for detector_name, subcheck in get_units(args.dsn, checker_argv):
+            for run in range(args.repeat):
+                result = pool.apply(_run_unit, (args.dsn, checker_argv, detector_name, subcheck))
+                result['run'] = run
+                results.append(result)
+
+    json.dump({'metadata': get_catalog_metadata(args.dsn),
+               'checker_args': checker_argv,
+               'results': results}, args.output, indent=2)
+    args.output.write("\n")
+
+
+if __name__ == '__main__':
+    main()
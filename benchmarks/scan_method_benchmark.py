@@ -0,0 +1,118 @@
+'''Compares the scan methods of large scans on a synthetic catalog.
+
+Measures the rate at which rows of the scans of the path consistency, hard links and minimum replicas
+tests are read using a cursor and using COPY, once without processing the rows and once with the
+processor of the test. The results are printed as JSON.'''
+
+from argparse import ArgumentParser
+from benchmarks import synthetic_catalog
+from icat_tools.detectors.hardlink_detector import AdjacentPathGrouper
+from icat_tools.detectors.minreplicaissue_detector import ReplicaCounter
+from icat_tools.detectors.pathinconsistency_detector import PathConsistencyChecker
+from icat_tools.lookup_cache import CatalogLookups
+from icat_tools.scan_engine import RowVisitor, ScanEngine
+import json
+import psycopg2
+import sys
+import time
+
+SCAN_METHODS = ['cursor', 'copy']
+
+
+class RowCounter(RowVisitor):
+    '''Visitor that only counts rows, so that the rate at which rows are read can be measured. '''
+
+    def __init__(self):
+        self.rows = 0
+
+    def visit(self, rows):
+        for _ in rows:
+            self.rows += 1
+        return iter(())
+
+    def visit_columns(self, columns):
+        self.rows += len(columns[0])
+        return iter(())
+
+
+def get_scans(connection, min_replicas):
+    '''Returns the name, query, partitions and processor factory of the scan of each test. '''
+    lookups = CatalogLookups(connection)
+
+    def get_checker():
+        return PathConsistencyChecker(lookups.get_resource_vault_paths(), lookups.get_resource_names(),
+                                      lookups.get_collection_names())
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT min(data_id) - 1, max(data_id) FROM r_data_main")
+    data_id_range = cursor.fetchone()
+    cursor.execute("SELECT DISTINCT resc_id FROM r_data_main ORDER BY resc_id")
+    resources = cursor.fetchall()
+    cursor.close()
+    return [
+        ('path_consistency',
+         "SELECT {} FROM r_data_main WHERE data_id > %s AND data_id <= %s".format(
+             ", ".join(PathConsistencyChecker.columns)),
+         [data_id_range], get_checker),
+        ('hardlinks',
+         "SELECT resc_id, data_path, data_id FROM r_data_main WHERE resc_id = %s ORDER BY data_path, data_id",
+         resources, AdjacentPathGrouper),
+        ('minreplicas',
+         "SELECT data_id, resc_id FROM r_data_main WHERE data_id > %s AND data_id <= %s ORDER BY data_id",
+         [data_id_range], lambda: ReplicaCounter(min_replicas))]
+
+
+def time_scan(connection, scan_engine, query, partitions, processor):
+    '''Runs a scan, and returns its wall time and number of results. '''
+    start = time.monotonic()
+    results = sum(1 for _ in scan_engine.scan(connection, query, partitions, processor))
+    return time.monotonic() - start, results
+
+
+def run_benchmark(connection, repeat, itersize, min_replicas):
+    results = []
+    for scan, query, partitions, get_processor in get_scans(connection, min_replicas):
+        for scan_method in SCAN_METHODS:
+            scan_engine = ScanEngine(itersize=itersize, scan_method=scan_method)
+            for run in range(repeat):
+                counter = RowCounter()
+                fetch_time, _ = time_scan(connection, scan_engine, query, partitions, counter)
+                process_time, findings = time_scan(connection, scan_engine, query, partitions, get_processor())
+                results.append({'scan': scan, 'method': scan_method, 'run': run, 'rows': counter.rows,
+                                'fetch_rows_per_second': counter.rows / fetch_time if fetch_time > 0 else None,
+                                'process_rows_per_second': counter.rows / process_time if process_time > 0 else None,
+                                'findings': findings})
+                connection.rollback()
+    return results
+
+
+def get_arguments():
+    parser = ArgumentParser(description="Compares the scan methods of large scans")
+    parser.add_argument('--dsn', required=True,
+                        help='libpq connection string of the benchmark database')
+    parser.add_argument('--populate', action='store_const', const=True,
+                        help='Create a synthetic catalog in the (empty) benchmark database first')
+    parser.add_argument('--data-objects', type=int, default=100000,
+                        help='Number of data objects of the synthetic catalog (default: 100000)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each scan (default: 3)')
+    parser.add_argument('--itersize', type=int, default=2000,
+                        help='Number of rows to fetch or decode at a time (default: 2000)')
+    parser.add_argument('--min-replicas', type=int, default=1,
+                        help='Minimum number of replicas for the minimum replicas scan (default: 1)')
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+    connection = psycopg2.connect(args.dsn)
+    if args.populate:
+        synthetic_catalog.create_schema(connection)
+        synthetic_catalog.populate(connection, collections=max(1, args.data_objects // 100),
+                                   data_objects=args.data_objects)
+    json.dump(run_benchmark(connection, args.repeat, args.itersize, args.min_replicas), sys.stdout, indent=2)
+    print()
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+'''Generates a synthetic ICAT catalog for benchmarks.
+
+The catalog is created in an empty PostgreSQL database, using the DDL of the ICAT schema
+that is included with the database checker. Never point this script at a production database.'''
+
+from argparse import ArgumentParser
+from icat_tools import icat_schemas
+import psycopg2
+
+# Timestamp of all generated rows
+TIMESTAMP = "01600000000"
+
+# Offsets of ids of the different types of objects, so that they do not overlap
+ZONE_ID_OFFSET = 9000
+USER_ID_OFFSET = 10000
+RESC_ID_OFFSET = 20000
+META_ID_OFFSET = 1000000
+COLL_ID_OFFSET = 100000000
+DATA_ID_OFFSET = 200000000
+# Ids that don't refer to any object, for injected referential integrity issues
+ORPHAN_ID_OFFSET = 900000000
+
+# Types of injected issues, with their default rates relative to the number of data objects
+CORRUPTION_RATES = {
+    'orphan': 0.001,
+    'path_inconsistency': 0.001,
+    'hardlink': 0.001,
+    'missing_replica': 0.001,
+    'bad_name': 0.001,
+    'timestamp': 0.001}
+
+
+def create_schema(connection, schema_version=8):
+    '''Creates the tables and indexes of the ICAT schema. The DDL of the schema lacks the
+       resc_id column of r_data_main that was added in iRODS 4.2, so it is added here. '''
+    cursor = connection.cursor()
+    cursor.execute(icat_schemas.get_schema(schema_version).replace('VARCHAR_MAX_IDX_SIZE', ''))
+    cursor.execute("ALTER TABLE r_data_main ADD COLUMN resc_id bigint")
+    cursor.execute("CREATE INDEX idx_data_main7 ON r_data_main (resc_id)")
+    connection.commit()
+    cursor.close()
+
+
+def _get_interval(rate):
+    '''Converts a rate of injected issues to an interval: one in every interval objects gets
+       the issue. Returns 0 if no issues should be injected. '''
+    return int(round(1 / rate)) if rate > 0 else 0
+
+
+def populate(connection, collections=1000, data_objects=100000, replicas=1, zones=1,
+             acls=1, avus=1, corruption=None):
+    '''Fills the catalog with zones, a user per ACL, one unixfilesystem resource per replica, collections,
+       data objects, ACLs and AVUs. Collections are spread evenly over the zones, and data objects over
+       the collections.
+
+       Issues are injected at the rates in the corruption dictionary (see CORRUPTION_RATES), which
+       overrides the default rates. '''
+    rates = dict(CORRUPTION_RATES)
+    rates.update(corruption or {})
+    cursor = connection.cursor()
+    params = {'ts': TIMESTAMP,
+              'zone_id': ZONE_ID_OFFSET,
+              'user_id': USER_ID_OFFSET,
+              'resc_id': RESC_ID_OFFSET,
+              'meta_id': META_ID_OFFSET,
+              'coll_id': COLL_ID_OFFSET,
+              'data_id': DATA_ID_OFFSET,
+              'orphan_id': ORPHAN_ID_OFFSET,
+              'zones': zones,
+              'collections': collections,
+              'data_objects': data_objects,
+              'replicas': replicas,
+              'acls': acls,
+              'avus': avus}
+    for corruption_type, rate in rates.items():
+        params[corruption_type] = _get_interval(rate)
+
+    cursor.execute("INSERT INTO r_zone_main (zone_id, zone_name, zone_type_name, create_ts, modify_ts) "
+                   + "SELECT %(zone_id)s + z, 'zone' || z, CASE WHEN z = 0 THEN 'local' ELSE 'remote' END, %(ts)s, %(ts)s "
+                   + "FROM generate_series(0, %(zones)s - 1) AS z", params)
+    cursor.execute("INSERT INTO r_user_main (user_id, user_name, user_type_name, zone_name, create_ts, modify_ts) "
+                   + "SELECT %(user_id)s + u, 'user' || u, 'rodsuser', 'zone0', %(ts)s, %(ts)s "
+                   + "FROM generate_series(0, greatest(%(acls)s, 1) - 1) AS u", params)
+    cursor.execute("INSERT INTO r_resc_main (resc_id, resc_name, zone_name, resc_type_name, resc_class_name, "
+                   + "resc_net, resc_def_path, resc_parent, create_ts, modify_ts) "
+                   + "SELECT %(resc_id)s + r, 'resc' || r, 'zone0', 'unixfilesystem', 'cache', 'localhost', "
+                   + "'/vault' || r, '', %(ts)s, %(ts)s FROM generate_series(0, %(replicas)s - 1) AS r", params)
+
+    # The root collection, and the zone and home collections of each zone
+    cursor.execute("INSERT INTO r_coll_main (coll_id, parent_coll_name, coll_name, coll_owner_name, coll_owner_zone, "
+                   + "create_ts, modify_ts) VALUES (%(coll_id)s - 1, '/', '/', 'user0', 'zone0', %(ts)s, %(ts)s)", params)
+    cursor.execute("INSERT INTO r_coll_main (coll_id, parent_coll_name, coll_name, coll_owner_name, coll_owner_zone, "
+                   + "create_ts, modify_ts) "
+                   + "SELECT %(coll_id)s - 2 - 2 * z, '/', '/zone' || z, 'user0', 'zone0', %(ts)s, %(ts)s "
+                   + "FROM generate_series(0, %(zones)s - 1) AS z "
+                   + "UNION ALL SELECT %(coll_id)s - 3 - 2 * z, '/zone' || z, '/zone' || z || '/home', 'user0', 'zone0', "
+                   + "%(ts)s, %(ts)s FROM generate_series(0, %(zones)s - 1) AS z", params)
+    cursor.execute("INSERT INTO r_coll_main (coll_id, parent_coll_name, coll_name, coll_owner_name, coll_owner_zone, "
+                   + "create_ts, modify_ts) "
+                   + "SELECT %(coll_id)s + c, '/zone' || c %% %(zones)s || '/home', "
+                   + "'/zone' || c %% %(zones)s || '/home/coll' || c, 'user0', 'zone0', %(ts)s, %(ts)s "
+                   + "FROM generate_series(0, %(collections)s - 1) AS c", params)
+
+    # Data objects, with one replica on each resource. Paths in the vault are based on the
+    # collection name without the zone name.
+    cursor.execute("INSERT INTO r_data_main (data_id, coll_id, data_name, data_repl_num, data_type_name, data_size, "
+                   + "resc_name, data_path, data_owner_name, data_owner_zone, create_ts, modify_ts, resc_id) "
+                   + "SELECT %(data_id)s + n, %(coll_id)s + n %% %(collections)s, 'obj' || n, r, 'generic', 1024, "
+                   + "'EMPTY_RESC_NAME', '/vault' || r || '/home/coll' || n %% %(collections)s || '/obj' || n, "
+                   + "'user0', 'zone0', %(ts)s, %(ts)s, %(resc_id)s + r "
+                   + "FROM generate_series(0, %(data_objects)s - 1) AS n, "
+                   + "generate_series(0, %(replicas)s - 1) AS r", params)
+
+    cursor.execute("INSERT INTO r_objt_access (object_id, user_id, access_type_id, create_ts, modify_ts) "
+                   + "SELECT coll_id, %(user_id)s + u, 1200, %(ts)s, %(ts)s FROM r_coll_main, "
+                   + "generate_series(0, %(acls)s - 1) AS u", params)
+    cursor.execute("INSERT INTO r_objt_access (object_id, user_id, access_type_id, create_ts, modify_ts) "
+                   + "SELECT %(data_id)s + n, %(user_id)s + u, 1200, %(ts)s, %(ts)s "
+                   + "FROM generate_series(0, %(data_objects)s - 1) AS n, generate_series(0, %(acls)s - 1) AS u", params)
+    cursor.execute("INSERT INTO r_meta_main (meta_id, meta_attr_name, meta_attr_value, create_ts, modify_ts) "
+                   + "SELECT %(meta_id)s + a, 'attribute' || a, 'value', %(ts)s, %(ts)s "
+                   + "FROM generate_series(0, %(avus)s - 1) AS a", params)
+    cursor.execute("INSERT INTO r_objt_metamap (object_id, meta_id, create_ts, modify_ts) "
+                   + "SELECT %(data_id)s + n, %(meta_id)s + a, %(ts)s, %(ts)s "
+                   + "FROM generate_series(0, %(data_objects)s - 1) AS n, generate_series(0, %(avus)s - 1) AS a", params)
+
+    _inject_issues(cursor, params)
+
+    connection.commit()
+    cursor.execute("ANALYZE")
+    cursor.close()
+
+
+def _inject_issues(cursor, params):
+    # ACLs and AVUs of objects that don't exist
+    if params['orphan'] > 0:
+        cursor.execute("INSERT INTO r_objt_access (object_id, user_id, access_type_id, create_ts, modify_ts) "
+                       + "SELECT %(orphan_id)s + n, %(user_id)s, 1200, %(ts)s, %(ts)s "
+                       + "FROM generate_series(0, %(data_objects)s / %(orphan)s - 1) AS n", params)
+        cursor.execute("INSERT INTO r_objt_metamap (object_id, meta_id, create_ts, modify_ts) "
+                       + "SELECT %(orphan_id)s + n, %(meta_id)s, %(ts)s, %(ts)s "
+                       + "FROM generate_series(0, %(data_objects)s / %(orphan)s - 1) AS n", params)
+
+    # Replicas in a directory that doesn't match the collection name
+    if params['path_inconsistency'] > 0:
+        cursor.execute("UPDATE r_data_main SET data_path = '/vault' || data_repl_num || '/wrong/' || data_name "
+                       + "WHERE (data_id - %(data_id)s + 2) %% %(path_inconsistency)s = 0", params)
+
+    # Data objects that refer to the file of the previous data object
+    if params['hardlink'] > 0:
+        cursor.execute("UPDATE r_data_main SET data_path = previous.data_path FROM r_data_main AS previous "
+                       + "WHERE (r_data_main.data_id - %(data_id)s + 3) %% %(hardlink)s = 0 "
+                       + "AND previous.data_id = r_data_main.data_id - 1 "
+                       + "AND previous.data_repl_num = r_data_main.data_repl_num", params)
+
+    # Data objects with only one replica, if there should be more
+    if params['missing_replica'] > 0:
+        cursor.execute("DELETE FROM r_data_main WHERE data_repl_num > 0 "
+                       + "AND (data_id - %(data_id)s + 4) %% %(missing_replica)s = 0", params)
+
+    # Names with a trailing slash or a control character
+    if params['bad_name'] > 0:
+        cursor.execute("UPDATE r_data_main SET data_name = CASE WHEN data_id %% 2 = 0 "
+                       + "THEN data_name || '/' ELSE data_name || chr(1) END "
+                       + "WHERE (data_id - %(data_id)s + 5) %% %(bad_name)s = 0", params)
+
+    # Creation timestamps that are later than modification timestamps
+    if params['timestamp'] > 0:
+        cursor.execute("UPDATE r_data_main SET create_ts = '01700000000' "
+                       + "WHERE (data_id - %(data_id)s + 6) %% %(timestamp)s = 0", params)
+
+
+def get_arguments():
+    parser = ArgumentParser(description="Creates a synthetic ICAT catalog in an empty database, for benchmarks")
+    add_catalog_arguments(parser)
+    return parser.parse_args()
+
+
+def add_catalog_arguments(parser):
+    '''Adds the arguments for the size and corruption rates of the synthetic catalog to a parser. '''
+    parser.add_argument('--dsn', required=True,
+                        help='libpq connection string of the (empty) benchmark database')
+    parser.add_argument('--zones', type=int, default=1, help='Number of zones (default: 1)')
+    parser.add_argument('--collections', type=int, default=1000, help='Number of collections (default: 1000)')
+    parser.add_argument('--data-objects', type=int, default=100000, help='Number of data objects (default: 100000)')
+    parser.add_argument('--replicas', type=int, default=1, help='Number of replicas per data object (default: 1)')
+    parser.add_argument('--acls', type=int, default=1, help='Number of ACLs per object (default: 1)')
+    parser.add_argument('--avus', type=int, default=1, help='Number of AVUs per data object (default: 1)')
+    for corruption_type, rate in CORRUPTION_RATES.items():
+        parser.add_argument('--{}-rate'.format(corruption_type.replace('_', '-')), type=float, default=rate,
+                            help='Rate of injected {} issues, relative to the number of data objects (default: {})'.format(
+                                corruption_type.replace('_', ' '), rate))
+
+
+def populate_from_arguments(connection, args):
+    '''Creates the schema and fills the catalog, based on the arguments of add_catalog_arguments. '''
+    create_schema(connection)
+    populate(connection, args.collections, args.data_objects, args.replicas, args.zones, args.acls, args.avus,
+             {corruption_type: getattr(args, corruption_type + '_rate') for corruption_type in CORRUPTION_RATES})
+
+
+def main():
+    args = get_arguments()
+    connection = psycopg2.connect(args.dsn)
+    populate_from_arguments(connection, args)
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+from array import array
+import bisect
+import mmap
+import os
+import struct
+import tempfile
+import weakref
+
+# Number of names per block. The first name of each block is stored in full; the other names only store
+# the part that differs from the previous name.
+BLOCK_SIZE = 16
+
+# Header of store files: magic, number of collections and size of the name buffer
+FILE_MAGIC = b"ICATCOL1"
+HEADER = struct.Struct("=8sqq")
+
+
+def _get_common_prefix_length(first, second, low=0):
+    '''Returns the length of the common prefix of two byte strings, which is known to be at least
+       low. The length is found using a binary search, so that the bytes are compared by slice
+       comparisons rather than one at a time. '''
+    high = min(len(first), len(second))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[:middle] == second[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class CollectionPathStore(object):
+    '''Compact mapping of collection ids to collection names, for catalogs with many collections.
+
+       Names are kept in a single buffer of UTF-8 bytes in sorted order, where each name only stores the
+       part that follows the prefix it shares with the previous name (usually its parent collection or a
+       sibling). Collection ids are kept in a sorted array of 64-bit integers, along with the position of
+       their name, so that a name is looked up using binary search followed by decoding of at most
+       BLOCK_SIZE names.
+
+       A store can be saved to a file, and loaded from it using a memory map. When a store is pickled,
+       e.g. to pass it to worker processes of a parallel scan, it is saved to a temporary file first,
+       so that the workers map the same file rather than each receiving a copy.'''
+
+    def __init__(self, ids, positions, prefix_lengths, suffix_ends, names, filename=None, mapped_file=None):
+        self.ids = ids
+        self.positions = positions
+        self.prefix_lengths = prefix_lengths
+        self.suffix_ends = suffix_ends
+        self.names = names
+        self.filename = filename
+        self.mapped_file = mapped_file
+
+    @classmethod
+    def from_database(cls, connection):
+        '''Reads the names of all collections from the database. The database sorts the collections by
+           name, and numbers them in order of id, so that the script doesn't need to sort them. '''
+        cursor = connection.cursor('get_coll_path_store')
+        cursor.execute("SELECT coll_id, coll_name, row_number() OVER (ORDER BY coll_id) - 1, count(*) OVER () "
+                       + "FROM r_coll_main ORDER BY coll_name COLLATE \"C\"")
+        ids = positions = None
+        prefix_lengths = array('I')
+        suffix_ends = array('q')
+        names = bytearray()
+        previous_name = b""
+        position = 0
+        for coll_id, coll_name, id_rank, number_collections in cursor:
+            if ids is None:
+                ids = array('q', bytes(8 * number_collections))
+                positions = array('I', bytes(4 * number_collections))
+            ids[id_rank] = coll_id
+            positions[id_rank] = position
+            name = coll_name.encode("utf-8")
+            if position % BLOCK_SIZE == 0:
+                prefix_length = 0
+            else:
+                # Names that follow each other usually share at least the name of the parent collection
+                parent_length = previous_name.rfind(b"/") + 1
+                prefix_length = _get_common_prefix_length(
+                    name, previous_name, parent_length if name[:parent_length] == previous_name[:parent_length] else 0)
+            prefix_lengths.append(prefix_length)
+            names += name[prefix_length:]
+            suffix_ends.append(len(names))
+            previous_name = name
+            position += 1
+        cursor.close()
+        return cls(ids or array('q'), positions or array('I'), prefix_lengths, suffix_ends, bytes(names))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _get_index(self, coll_id):
+        index = bisect.bisect_left(self.ids, coll_id)
+        if index == len(self.ids) or self.ids[index] != coll_id:
+            return None
+        return index
+
+    def __contains__(self, coll_id):
+        return self._get_index(coll_id) is not None
+
+    def __getitem__(self, coll_id):
+        index = self._get_index(coll_id)
+        if index is None:
+            raise KeyError(coll_id)
+        return self._get_name(self.positions[index])
+
+    def get(self, coll_id, default=None):
+        index = self._get_index(coll_id)
+        return default if index is None else self._get_name(self.positions[index])
+
+    def _get_name(self, position):
+        name = b""
+        for current in range(position - position % BLOCK_SIZE, position + 1):
+            start = self.suffix_ends[current - 1] if current > 0 else 0
+            name = name[:self.prefix_lengths[current]] + self.names[start:self.suffix_ends[current]]
+        return name.decode("utf-8")
+
+    def save(self, filename):
+        with open(filename, "wb") as store_file:
+            store_file.write(HEADER.pack(FILE_MAGIC, len(self.ids), len(self.names)))
+            for values in [self.ids, self.positions, self.prefix_lengths, self.suffix_ends, self.names]:
+                store_file.write(memoryview(values).cast('B'))
+
+    @classmethod
+    def load(cls, filename):
+        '''Loads a store from a file, which is mapped into memory rather than read. '''
+        with open(filename, "rb") as store_file:
+            mapped_file = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, number_collections, names_size = HEADER.unpack_from(mapped_file)
+        if magic != FILE_MAGIC:
+            mapped_file.close()
+            raise ValueError("{} is not a collection path store".format(filename))
+        view = memoryview(mapped_file)
+        offset = HEADER.size
+        arrays = []
+        for typecode in ['q', 'I', 'I', 'q']:
+            size = number_collections * array(typecode).itemsize
+            arrays.append(view[offset:offset + size].cast(typecode))
+            offset += size
+        return cls(*arrays, view[offset:offset + names_size], filename, mapped_file)
+
+    def spill(self):
+        '''Saves the store to a temporary file, and uses a memory map of that file from then on. The
+           file is removed when the store is no longer used. '''
+        if self.filename is not None:
+            return
+        file_descriptor, filename = tempfile.mkstemp(prefix="icat-collections-", suffix=".store")
+        os.close(file_descriptor)
+        self.save(filename)
+        loaded = CollectionPathStore.load(filename)
+        self.__dict__.update(loaded.__dict__)
+        weakref.finalize(self, os.remove, filename)
+
+    def __reduce__(self):
+        self.spill()
+        return (CollectionPathStore.load, (self.filename,))
@@ -0,0 +1,108 @@
+import psycopg2.extensions
+import re
+
+# Type OIDs of columns that are converted to integers and strings without using the typecasters of psycopg2
+INTEGER_TYPES = {20, 21, 23, 26}
+TEXT_TYPES = {19, 25, 1042, 1043}
+
+# Field that represents NULL in the text format of COPY
+NULL_FIELD = "\\N"
+
+ESCAPE_PATTERN = re.compile(r"\\(.)")
+ESCAPED_CHARACTERS = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+
+def _unescape(field):
+    '''Decodes a field in the text format of COPY that contains backslashes. '''
+    if field == NULL_FIELD:
+        return None
+    return ESCAPE_PATTERN.sub(lambda match: ESCAPED_CHARACTERS.get(match.group(1), match.group(1)), field)
+
+
+def get_column_types(connection, query, params):
+    '''Returns the type OIDs of the columns of the query, without running it. '''
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM ( {} ) AS copy_query LIMIT 0".format(query), params)
+    column_types = [column[1] for column in cursor.description]
+    cursor.close()
+    return column_types
+
+
+def get_converters(column_types, cursor):
+    '''Returns a function for each column that converts its fields to the values that a cursor would
+       return, or None for text columns, which need no conversion. Types other than integers and text
+       are converted using the typecasters of psycopg2. '''
+    converters = []
+    for column_type in column_types:
+        if column_type in INTEGER_TYPES:
+            converters.append(int)
+        elif column_type in TEXT_TYPES or column_type not in psycopg2.extensions.string_types:
+            converters.append(None)
+        else:
+            typecaster = psycopg2.extensions.string_types[column_type]
+            converters.append(lambda field, typecaster=typecaster: typecaster(field, cursor))
+    return converters
+
+
+def decode_columns(text, converters):
+    '''Decodes rows in the text format of COPY into a list of columns, each a list of values. Fields
+       are split for all rows at once. Only columns with escaped characters or NULL values need to be
+       decoded field by field. '''
+    number_columns = len(converters)
+    # Tabs and newlines in values are escaped, so they only separate fields and rows. Each row ends
+    # with a newline, so the last field is empty.
+    fields = text.replace("\n", "\t").split("\t")
+    escaped = "\\" in text
+    columns = []
+    for column_num, converter in enumerate(converters):
+        column = fields[column_num:-1:number_columns]
+        if escaped and any("\\" in field for field in column):
+            column = [_unescape(field) if "\\" in field else field for field in column]
+            if converter is not None:
+                column = [None if value is None else converter(value) for value in column]
+        elif converter is not None:
+            column = list(map(converter, column))
+        columns.append(column)
+    return columns
+
+
+class CopyReader(object):
+    '''File-like object that receives the output of COPY ... TO STDOUT in text format. Rows are
+       decoded into columns in batches of batch_size rows, which are passed to the visit_columns
+       method of a row visitor. The results of the visitor are collected. '''
+
+    def __init__(self, converters, encoding, batch_size, visitor):
+        self.converters = converters
+        self.encoding = encoding
+        self.batch_size = batch_size
+        self.visitor = visitor
+        self.chunks = []
+        self.results = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        if len(self.chunks) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        data = b"".join(self.chunks)
+        end = data.rfind(b"\n") + 1
+        # Data after the last newline belongs to a row that has not been received completely
+        self.chunks = [data[end:]] if end < len(data) else []
+        if end > 0:
+            columns = decode_columns(data[:end].decode(self.encoding), self.converters)
+            self.results.extend(self.visitor.visit_columns(columns))
+
+
+def read_partition(connection, query, params, column_types, batch_size, visitor):
+    '''Runs the query using COPY, passes its rows to the row visitor in batches of columns, and returns
+       the results of the visitor, including those of its finish method. The connection cannot run other
+       queries until COPY has finished, so results are only returned when all rows have been read. '''
+    encoding = psycopg2.extensions.encodings[connection.encoding]
+    cursor = connection.cursor()
+    reader = CopyReader(get_converters(column_types, cursor), encoding, batch_size, visitor)
+    cursor.copy_expert("COPY ( {} ) TO STDOUT".format(cursor.mogrify(query, params).decode(encoding)), reader)
+    reader.flush()
+    cursor.close()
+    reader.results.extend(visitor.finish())
+    return reader.results
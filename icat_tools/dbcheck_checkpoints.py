@@ -0,0 +1,110 @@
+from enum import Enum
+import threading
+
+# Section of the state file with the progress of the current run
+SECTION = 'checkpoint'
+
+# Options that determine which checks a run performs. Progress of an interrupted run is only
+# used if these options have not changed.
+SETTINGS = ['run_test', 'ref_integrity_check', 'ref_integrity_merge', 'ref_integrity_engine', 'min_replicas',
+            'data_object_prefix', 'incremental', 'shared_scan']
+
+
+def get_settings(args):
+    settings = {}
+    for name in SETTINGS:
+        value = getattr(args, name)
+        settings[name] = value.value if isinstance(value, Enum) else value
+    return settings
+
+
+class Checkpoints(object):
+    '''Progress of a run, kept in the state file, so that the run can be resumed after it has been
+       interrupted. Progress is recorded per test: the sub-checks that have been completed, the position
+       of large scans (the last data object id, or resource id, up to which all rows have been checked),
+       and the number of findings reported so far.
+
+       The state file is written after each completed sub-check and each page of a large scan. Output
+       is flushed first, so that findings are not lost if the run is interrupted right afterwards.'''
+
+    def __init__(self, state, settings, output_processor):
+        self.state = state
+        self.output_processor = output_processor
+        self.lock = threading.Lock()
+
+        saved_settings = state.get(SECTION, 'settings')
+        self.resumed = saved_settings == settings
+        if saved_settings is not None and not self.resumed:
+            output_processor.print_error(
+                "Warning: the saved progress is for a run with different options. Starting from the beginning.")
+        if not self.resumed:
+            state.clear(SECTION)
+            state.set(SECTION, 'settings', settings)
+        self.tests = state.get(SECTION, 'tests', {})
+        state.set(SECTION, 'tests', self.tests)
+        self.previous_findings = sum(test['findings'] for test in self.tests.values())
+
+    def get_run_timestamp(self, timestamp):
+        '''Returns the time at which the run started. For a resumed run, this is the start time of
+           the interrupted run, so that incremental checks do not skip rows that were modified after
+           part of the rows had been checked.'''
+        if self.state.get(SECTION, 'run_timestamp') is None:
+            self.state.set(SECTION, 'run_timestamp', timestamp)
+        return self.state.get(SECTION, 'run_timestamp')
+
+    def _get_test(self, test):
+        return self.tests.setdefault(test, {'completed': [], 'positions': {}, 'findings': 0})
+
+    def _save(self):
+        self.output_processor.flush()
+        self.state.save()
+
+    def is_completed(self, test, subcheck=None):
+        return subcheck in self.tests.get(test, {}).get('completed', [])
+
+    def get_position(self, test, check_name=None):
+        '''Returns the position up to which a scan has been completed, or None if it hasn't started. '''
+        return self.tests.get(test, {}).get('positions', {}).get(check_name or '')
+
+    def set_position(self, test, check_name, position):
+        with self.lock:
+            self._get_test(test)['positions'][check_name or ''] = position
+            self._save()
+
+    def add_finding(self, test):
+        with self.lock:
+            self._get_test(test)['findings'] += 1
+
+    def complete(self, test, subcheck=None):
+        '''Records that a sub-check, or the test as a whole if subcheck is None, has been completed. '''
+        with self.lock:
+            progress = self._get_test(test)
+            progress['completed'].append(subcheck)
+            if subcheck is None:
+                progress['positions'] = {}
+            else:
+                progress['positions'].pop(subcheck, None)
+            self._save()
+
+    def skip_completed(self, detectors, verbose=False):
+        '''Returns the detectors that have not been completed by the interrupted run. Sub-checks that
+           have been completed are excluded.'''
+        remaining = []
+        for detector in detectors:
+            name = detector.get_name()
+            if self.is_completed(name):
+                if verbose:
+                    self.output_processor.print_progress("Skipping test {}, which has been completed".format(name))
+                continue
+            for subcheck in detector.get_subchecks():
+                if self.is_completed(name, subcheck):
+                    detector.exclude_subcheck(subcheck)
+            if verbose and name in self.tests:
+                self.output_processor.print_progress(
+                    "Resuming test {} ({} issues reported before)".format(name, self.tests[name]['findings']))
+            remaining.append(detector)
+        return remaining
+
+    def finish(self):
+        '''Removes the progress of the run after it has been completed. '''
+        self.state.clear(SECTION)
@@ -1,15 +1,26 @@
 from argparse import ArgumentParser, FileType
 from enum import Enum
-from icat_tools import utils
+from icat_tools import dbcheck_checkpoints, dbcheck_metrics, dbcheck_parallel, dbcheck_shared_scan, utils
 from icat_tools.dbcheck_outputprocessors import CheckOutputProcessorCSV, CheckOutputProcessorHuman
+from icat_tools.dbcheck_outputprocessors import CheckOutputProcessorJSONL, CheckOutputProcessorParquet
+from icat_tools.dbcheck_state import StateFile
+from icat_tools.detectors.colltree_detector import CollectionTreeDetector
 from icat_tools.detectors.hardlink_detector import HardlinkDetector
 from icat_tools.detectors.minreplicaissue_detector import MinreplicaIssueDetector
 from icat_tools.detectors.nameissue_detector import NameIssueDetector
 from icat_tools.detectors.pathinconsistency_detector import PathInconsistencyDetector
 from icat_tools.detectors.refintegrityissue_detector import RefIntegrityIssueDetector
 from icat_tools.detectors.timestampissue_detector import TimestampIssueDetector
+from icat_tools.detectors.vault_detector import VaultDetector
 from icat_tools.detectors.missingindex_detector import MissingIndexDetector
+from icat_tools.name_resolver import ObjectNameResolver
+from icat_tools.query_profiler import QueryProfiler
+from icat_tools.query_scheduler import QueryScheduler, TimeBudgetExceeded
+from icat_tools.scan_engine import ScanEngine
+import os
+import psycopg2
 import sys
+import time
 
 
 class TestSubset(Enum):
@@ -19,7 +30,9 @@ class TestSubset(Enum):
     hardlinks = 'hardlinks'
     minreplicas = 'minreplicas'
     path_consistency = 'path_consistency'
+    coll_tree = 'coll_tree'
     indexes = "indexes"
+    vault = 'vault'
     all = 'all'
 
     def __str__(self):
@@ -29,18 +42,48 @@ class TestSubset(Enum):
 class OutputMode(Enum):
     human = 'human'
     csv = 'csv'
+    jsonl = 'jsonl'
+    parquet = 'parquet'
 
     def __str__(self):
         return self.name
 
 
-def get_arguments():
+def get_arguments(argv=None):
     desc = 'Performs a number of sanity checks on the iRODS ICAT database'
     parser = ArgumentParser(description=desc)
     parser.add_argument(
         '--config-file',
         help='Location of the irods server_config file (default: etc/irods/server_config.json )',
         default='/etc/irods/server_config.json')
+    parser.add_argument(
+        '--replica-host',
+        help='''Run the checks on a read-only copy of the database on this host, such as a streaming replica
+                or a restored snapshot, rather than on the database server in the irods server_config file.
+                The user name and password in the server_config file are used.''',
+        default=None)
+    parser.add_argument(
+        '--replica-port',
+        help='Port of the read-only copy of the database (default: the port in the server_config file)',
+        default=None,
+        type=int)
+    parser.add_argument(
+        '--replica-database',
+        help='Name of the read-only copy of the database (default: the name in the server_config file)',
+        default=None)
+    parser.add_argument(
+        '--conflict-retries',
+        help='''Number of times a check is run again if one of its queries is cancelled because of a conflict
+                with recovery on a hot standby (default: 3). Checks that have already reported issues are
+                not run again, but partitions of large scans by worker processes are.''',
+        default=3,
+        type=int)
+    parser.add_argument(
+        '--snapshot',
+        help='''Run the checks in a snapshot that another session has exported using pg_export_snapshot(),
+                so that several runs of the checker see exactly the same database state. That session
+                must keep its transaction open until the checks have finished.''',
+        default=None)
     parser.add_argument(
         '-m',
         type=OutputMode,
@@ -57,9 +100,34 @@ def get_arguments():
         type=FileType('w'),
         default=sys.stdout,
         help='Output file (default: standard output)')
+    parser.add_argument(
+        '--output-compression',
+        help='Compression of the output file for the jsonl output type (default: none). The zstd compression needs the zstandard package.',
+        default='none',
+        choices=['none', 'gzip', 'zstd'])
+    parser.add_argument(
+        '--output-buffer-size',
+        help='Size of the output buffer in bytes for the jsonl output type (default: 1048576)',
+        default=1048576,
+        type=int)
+    parser.add_argument(
+        '--output-flush-interval',
+        help='Maximum number of seconds between writes of the output buffer for the jsonl output type (default: 5)',
+        default=5,
+        type=float)
+    parser.add_argument(
+        '--output-dir',
+        help='''Output directory for the parquet output type, which writes a Parquet file per test. The
+                parquet output type needs the pyarrow package.''',
+        default=None)
+    parser.add_argument(
+        '--output-batch-size',
+        help='Number of findings per row group for the parquet output type (default: 65536)',
+        default=65536,
+        type=int)
     parser.add_argument(
         '--run-test',
-        help='Test to run (default: all)',
+        help='Test to run (default: all). The coll_tree and vault tests only run if they are selected.',
         default='all',
         type=TestSubset,
         choices=list(TestSubset))
@@ -73,19 +141,332 @@ def get_arguments():
         default='all',
         required=False,
         type=str)
+    parser.add_argument(
+        '--ref-integrity-query',
+        help='''Query shape for the referential integrity checks (default: not_exists). The not_exists
+                and left_join shapes can be run as anti-joins by the database. The not_in shape is the
+                one used by earlier versions, and is mainly useful for comparison.''',
+        default='not_exists',
+        choices=['not_exists', 'left_join', 'not_in'])
+    parser.add_argument(
+        '--ref-integrity-merge',
+        action='store_const',
+        const=True,
+        help='''Run all referential integrity checks of a table in a single query, so that each table
+                is only scanned once. The --ref-integrity-query option does not apply to merged checks.''')
+    parser.add_argument(
+        '--ref-integrity-engine',
+        help='''Engine for the referential integrity checks (default: database). The client engine loads
+                the ids of collections, data objects, users, resources and metadata entries into compact
+                sets once, reads each checked table once, and looks up its references in the script.
+                Checks that refer to other columns are still run by the database.''',
+        default='database',
+        choices=['database', 'client'])
     parser.add_argument(
         '--min-replicas',
         help='Minimum number of replicas that a dataobject must have (default: 1).',
         default=1,
         type=int)
+    parser.add_argument(
+        '--minreplicas-mode',
+        help='''How to count replicas for the minimum replicas test (default: aggregate). The aggregate
+                mode counts replicas in the database, and only retrieves data objects with too few replicas.
+                The stream mode retrieves all replicas ordered by data object, and counts them in the
+                script. This can be used if the aggregate query is too expensive for the database server.''',
+        default='aggregate',
+        choices=['aggregate', 'stream'])
+    parser.add_argument(
+        '--hardlinks-mode',
+        help='''How to find physical paths that are used more than once for the hard links test
+                (default: aggregate). The aggregate mode groups replicas by path in the database. The
+                stream mode retrieves all replicas of a resource ordered by path, and compares adjacent
+                paths in the script. In both modes, memory use depends on the number of issues found,
+                rather than on the number of replicas.''',
+        default='aggregate',
+        choices=['aggregate', 'stream'])
+    parser.add_argument(
+        '--path-consistency-mode',
+        help='''Where to compare physical paths with collection names for the path consistency test
+                (default: script). The script mode retrieves all replicas on unixfilesystem resources. The
+                sql mode compares paths in normal form in the database, and only retrieves the other
+                replicas, which are compared in the script.''',
+        default='script',
+        choices=['script', 'sql'])
+    parser.add_argument(
+        '--vault-host',
+        help='''Host name of the unixfilesystem resources whose vaults are compared with the catalog by the
+                vault test (default: the host name and fully qualified domain name of this host). The test
+                needs to run on the server that has the vaults.''',
+        default=None)
+    parser.add_argument(
+        '--vault-jobs',
+        help='Number of threads that list vault directories for the vault test (default: 8)',
+        default=8,
+        type=int)
     parser.add_argument(
         '--data-object-prefix',
-        help='Only check data objects with a particular prefix. The referential integrity and hard links tests do not support this option yet, and will ignore it. ',
+        help='Only check data objects with a particular prefix. The referential integrity, hard links, collection tree and vault tests do not support this option yet, and will ignore it. ',
+        default=None)
+    parser.add_argument(
+        '--incremental',
+        action='store_const',
+        const=True,
+        help='''Only check rows that have been modified since the previous incremental run, for tests
+                where this is possible (names, timestamps, path_consistency). Other tests always check
+                all rows. The time of each run is kept in the state file.''')
+    parser.add_argument(
+        '--state-file',
+        help='Location of the state file for incremental and resumable runs (default: ~/.icat-database-checker-state.json)',
+        default=os.path.expanduser('~/.icat-database-checker-state.json'))
+    parser.add_argument(
+        '--resume',
+        action='store_const',
+        const=True,
+        help='''Record the progress of the tests in the state file, and continue where the previous run with this
+                option stopped if it has been interrupted. Issues in completed sub-checks and pages of large scans
+                are not reported again; issues in the sub-check or page that was interrupted may be reported
+                twice. Cannot be combined with --jobs or the parquet output type.''')
+    parser.add_argument(
+        '--scan-page-size',
+        help='''Number of rows of the data object table per query of large scans, if --resume or one of the
+                options that limit the load on the database is used. The progress of large scans is recorded
+                after each page. (default: 1000000)''',
+        default=1000000,
+        type=int)
+    parser.add_argument(
+        '--lookup-cache',
+        help='''Directory in which to keep the resource and collection lookup tables between runs, so that
+                repeated runs only need to read collections that have been modified since the previous run.
+                The cache is kept separately for each database.''',
+        default=None)
+    parser.add_argument(
+        '--max-rows-per-second',
+        help='''Maximum number of rows that the checks read from the database per second, as counted by the
+                database server. Checks pause between batches of rows to stay within this limit.''',
+        default=None,
+        type=int)
+    parser.add_argument(
+        '--max-concurrent-queries',
+        help='''Maximum number of queries of the checks that run at the same time, including those of
+                concurrent checks (--jobs) and of worker processes of large scans (--scan-jobs)''',
+        default=None,
+        type=int)
+    parser.add_argument(
+        '--statement-timeout',
+        help='''Maximum number of seconds that each query may take. For large scans, this applies to each batch
+                of rows. Checks with queries that time out are reported as incomplete.''',
+        default=None,
+        type=float)
+    parser.add_argument(
+        '--lock-timeout',
+        help='''Maximum number of seconds that a query may wait for a lock. Checks with queries that time out
+                are reported as incomplete.''',
+        default=None,
+        type=float)
+    parser.add_argument(
+        '--max-active-sessions',
+        help='''Pause the checks while more than this number of other sessions, such as those of iRODS servers,
+                are running queries on the database''',
+        default=None,
+        type=int)
+    parser.add_argument(
+        '--time-budget',
+        help='''Maximum number of seconds that the checks may take. When the budget has been used up, the checks
+                are stopped, and the coverage of the run is reported. Combined with --resume, the next run
+                continues where this run stopped.''',
+        default=None,
+        type=float)
+    parser.add_argument(
+        '--jobs',
+        help='''Number of checks to run concurrently, each on its own database connection (default: 1).
+                Detectors with sub-checks are split up into a separate check per sub-check. All
+                connections share a single snapshot of the database.''',
+        default=1,
+        type=int)
+    parser.add_argument(
+        '--scan-jobs',
+        help='''Number of worker processes for large scans of the data object table by the path consistency,
+                hard links and minimum replicas tests (default: 1). The table is split up into ranges of
+                data object ids (or into resources for the hard links test), which are scanned in parallel,
+                each on its own database connection.''',
+        default=1,
+        type=int)
+    parser.add_argument(
+        '--shared-scan',
+        action='store_const',
+        const=True,
+        help='''Read the data object table once for the data object checks of the path consistency,
+                minimum replicas, timestamps and names tests, rather than once per test. Not used
+                for incremental checks by the timestamps, names and path consistency tests.''')
+    parser.add_argument(
+        '--profile',
+        help='''Write a JSON report with the wall time, time to first row, number of rows fetched and number of
+                findings of each query of the tests to this file. Queries of scans by worker processes
+                (see --scan-jobs) are not included.''',
         default=None)
-    args = parser.parse_args()
+    parser.add_argument(
+        '--profile-explain',
+        action='store_const',
+        const=True,
+        help='''Include the query plan of each query in the profile report, using EXPLAIN (ANALYZE, BUFFERS).
+                This runs each query twice, so it makes the checks much slower.''')
+    parser.add_argument(
+        '--serve-metrics',
+        action='store_const',
+        const=True,
+        help='''Run the selected tests on a schedule, and serve the number of issues found, durations and
+                rows scanned of each test as OpenMetrics gauges over HTTP, rather than printing the issues.''')
+    parser.add_argument(
+        '--metrics-address',
+        help='Address to serve metrics on (default: 127.0.0.1)',
+        default='127.0.0.1')
+    parser.add_argument(
+        '--metrics-port',
+        help='Port to serve metrics on (default: 9713)',
+        default=9713,
+        type=int)
+    parser.add_argument(
+        '--metrics-interval',
+        help='Number of seconds between the starts of cycles of tests when serving metrics (default: 3600)',
+        default=3600,
+        type=float)
+    parser.add_argument(
+        '--itersize',
+        help='Number of rows to fetch at a time in large scans (default: 2000)',
+        default=2000,
+        type=int)
+    parser.add_argument(
+        '--scan-method',
+        help='''Method for reading rows in large scans: cursor (default) fetches rows using a server-side
+                cursor. copy reads them using COPY, and decodes batches of --itersize rows into columns, which
+                the path consistency, hard links and minimum replicas tests process at once. Scans use a cursor
+                if --profile or one of the options that limit the load on the database is used.''',
+        choices=['cursor', 'copy'],
+        default='cursor')
+    args = parser.parse_args(argv)
     return args
 
 
+def get_detectors(args, connection, output_processor, resolver, state, scan_engine, profiler=None, checkpoints=None,
+                  scheduler=None):
+    '''Returns the detectors of the tests that have been selected with the --run-test option. '''
+    detector_args = (args, connection, output_processor, resolver, state, scan_engine, profiler, checkpoints, scheduler)
+    detectors = [
+        PathInconsistencyDetector(*detector_args),
+        HardlinkDetector(*detector_args),
+        MinreplicaIssueDetector(*detector_args),
+        RefIntegrityIssueDetector(*detector_args),
+        TimestampIssueDetector(*detector_args),
+        NameIssueDetector(*detector_args),
+        CollectionTreeDetector(*detector_args),
+        MissingIndexDetector(*detector_args),
+        VaultDetector(*detector_args)]
+
+    return [detector for detector in detectors
+            if (args.run_test.value == 'all' and detector.included_in_all()) or args.run_test.value == detector.get_name()]
+
+
+def get_scheduler(args, config):
+    '''Returns a query scheduler if any of the options that limit the load on the database have been
+       used, otherwise None.'''
+    if (args.max_rows_per_second is None and args.max_concurrent_queries is None and args.statement_timeout is None
+            and args.lock_timeout is None and args.max_active_sessions is None and args.time_budget is None):
+        return None
+    return QueryScheduler(
+        config,
+        rows_per_second=args.max_rows_per_second,
+        max_queries=args.max_concurrent_queries,
+        statement_timeout=None if args.statement_timeout is None else int(args.statement_timeout * 1000),
+        lock_timeout=None if args.lock_timeout is None else int(args.lock_timeout * 1000),
+        max_sessions=args.max_active_sessions,
+        deadline=None if args.time_budget is None else time.time() + args.time_budget)
+
+
+def run_detector(detector, checkpoints=None, scheduler=None):
+    '''Runs a detector one sub-check at a time, so that the completion of each sub-check can be recorded
+       in the checkpoints and in the coverage report of the query scheduler. Returns True if an issue
+       has been found, otherwise False.'''
+    name = detector.get_name()
+    if len(detector.get_subchecks()) == 0:
+        units = [None]
+    else:
+        units = [subcheck for subcheck in detector.get_subchecks() if detector.need_to_run_subcheck(subcheck)]
+
+    issue_found = False
+    completed = True
+    for subcheck in units:
+        if subcheck is not None:
+            detector.restrict_to_subcheck(subcheck)
+        if scheduler is None:
+            unit_completed, unit_issue_found = True, detector.run_with_retries()
+        else:
+            unit_completed, unit_issue_found = scheduler.run_check(detector.connection, name, subcheck,
+                                                                   detector.run_with_retries)
+        issue_found = issue_found or unit_issue_found
+        completed = completed and unit_completed
+        if checkpoints is not None and unit_completed and subcheck is not None:
+            checkpoints.complete(name, subcheck)
+
+    if checkpoints is not None and completed:
+        checkpoints.complete(name)
+    return issue_found
+
+
+def run_checks(args, config, connection, output_processor, scan_engine, detectors, checkpoints, scheduler):
+    '''Runs the shared scan, if enabled, and the detectors. Returns True if an issue has been found,
+       otherwise False.'''
+    issue_found = False
+    snapshot_id = None
+
+    if args.jobs > 1:
+        # The shared scan runs in the snapshot that the workers import, so that all tests see the same
+        # database state
+        snapshot_id = utils.export_snapshot(connection)
+
+    if args.shared_scan:
+        # With a snapshot, the scan runs on a connection of its own, which imports the snapshot again if
+        # its transaction is restarted. The main connection keeps the exported snapshot valid.
+        scan_connection = connection
+        if snapshot_id is not None:
+            scan_connection = utils.get_connection_database(config)
+            utils.import_snapshot(scan_connection, snapshot_id)
+
+        def shared_scan():
+            # The shared scan is only run again if none of the detectors has reported issues yet
+            findings = sum(detector.findings for detector in detectors)
+            return utils.run_with_conflict_retries(
+                scan_connection,
+                lambda: dbcheck_shared_scan.run_shared_scan(args, scan_connection, scan_engine, detectors, checkpoints),
+                args.conflict_retries,
+                lambda: sum(detector.findings for detector in detectors) == findings)
+        try:
+            if scheduler is None:
+                issue_found = shared_scan()
+            else:
+                issue_found = scheduler.run_check(scan_connection, 'shared_scan', None, shared_scan)[1]
+        finally:
+            if scan_connection is not connection:
+                scan_connection.close()
+
+    if args.jobs > 1:
+        if dbcheck_parallel.run_detectors(args, config, connection, output_processor, detectors, snapshot_id):
+            issue_found = True
+    else:
+        for detector in detectors:
+            if args.v:
+                output_processor.print_progress(
+                    "Starting test {}".format(
+                        detector.get_name()))
+            detector.print_option_warnings()
+            if checkpoints is None and scheduler is None:
+                if detector.run_with_retries():
+                    issue_found = True
+            elif run_detector(detector, checkpoints, scheduler):
+                issue_found = True
+
+    return issue_found
+
+
 def entry():
     try:
         main()
@@ -95,42 +476,119 @@ def entry():
 
 def main():
     args = get_arguments()
-    config = utils.read_database_config(args.config_file)
+    primary_config = utils.read_database_config(args.config_file)
+    config = utils.get_replica_config(primary_config, args.replica_host, args.replica_port, args.replica_database)
+
+    if args.serve_metrics:
+        if args.incremental or args.snapshot is not None:
+            print("Error: the --serve-metrics option cannot be combined with the --incremental or --snapshot options.")
+            sys.exit(1)
+        dbcheck_metrics.serve_metrics(args, config, get_detectors)
+
+    scheduler = get_scheduler(args, config)
+    if scheduler is not None:
+        config['options'] = scheduler.get_connection_options()
+
+    if args.resume and (args.jobs > 1 or args.m.value == 'parquet'):
+        print("Error: the --resume option cannot be combined with the --jobs option or the parquet output type.")
+        sys.exit(1)
+
     connection = utils.get_connection_database(config)
+    if args.snapshot is not None:
+        try:
+            utils.import_snapshot(connection, args.snapshot)
+        except psycopg2.Error as error:
+            print("Error while importing snapshot: ", error)
+            sys.exit(1)
 
     if args.m.value == 'human':
         output_processor = CheckOutputProcessorHuman(args.output)
     elif args.m.value == 'csv':
         output_processor = CheckOutputProcessorCSV(args.output)
+    elif args.m.value == 'jsonl':
+        output_processor = CheckOutputProcessorJSONL(args.output, args.output_compression,
+                                                     args.output_buffer_size, args.output_flush_interval)
+    elif args.m.value == 'parquet':
+        output_processor = CheckOutputProcessorParquet(args.output_dir, args.output_batch_size)
     else:
         print("Error: unknown output processor selected.")
         sys.exit(1)
 
-    detectors = [
-        PathInconsistencyDetector(args, connection, output_processor),
-        HardlinkDetector(args, connection, output_processor),
-        MinreplicaIssueDetector(args, connection, output_processor),
-        RefIntegrityIssueDetector(args, connection, output_processor),
-        TimestampIssueDetector(args, connection, output_processor),
-        NameIssueDetector(args, connection, output_processor),
-        MissingIndexDetector(args, connection, output_processor)]
+    if args.incremental or args.resume:
+        # The state is kept per primary database, so that runs on a replica and on the primary share it
+        state = StateFile(args.state_file, primary_config)
+        run_timestamp = utils.get_database_time(connection)
+    else:
+        state = None
+
+    if args.incremental and args.data_object_prefix is not None:
+        output_processor.print_error(
+            "The --data-object-prefix option limits the rows that are checked, so the next incremental run "
+            + "will not start from this run.")
+
+    if args.resume:
+        checkpoints = dbcheck_checkpoints.Checkpoints(state, dbcheck_checkpoints.get_settings(args), output_processor)
+        run_timestamp = checkpoints.get_run_timestamp(run_timestamp)
+    else:
+        checkpoints = None
+
+    if state is not None:
+        state.start_run(run_timestamp)
+
+    resolver = ObjectNameResolver(connection)
+    scan_engine = ScanEngine(config, args.scan_jobs, args.itersize, args.scan_page_size, scheduler,
+                             args.conflict_retries, args.scan_method)
+    profiler = None if args.profile is None else QueryProfiler(args.profile_explain)
+    # The state of incremental checks is only passed to detectors for incremental runs
+    detectors = get_detectors(args, connection, output_processor, resolver, state if args.incremental else None,
+                              scan_engine, profiler, checkpoints, scheduler)
 
     issue_found = False
 
-    for detector in detectors:
-        if args.run_test.value == 'all' or args.run_test.value == detector.get_name():
-            if args.v:
-                output_processor.print_progress(
-                    "Starting test {}".format(
-                        detector.get_name()))
-            if detector.run():
-                issue_found = True
+    if checkpoints is not None:
+        detectors = checkpoints.skip_completed(detectors, args.v)
+        issue_found = checkpoints.previous_findings > 0
+
+    if scheduler is not None:
+        if args.shared_scan:
+            scheduler.plan('shared_scan')
+        for detector, subcheck in dbcheck_parallel.get_work_units(detectors):
+            scheduler.plan(detector.get_name(), subcheck)
+
+    try:
+        if run_checks(args, config, connection, output_processor, scan_engine, detectors, checkpoints, scheduler):
+            issue_found = True
+    except TimeBudgetExceeded:
+        connection.rollback()
+        output_processor.print_error("Time budget exceeded. The checks have been stopped.")
+
+    complete = scheduler is None or scheduler.is_complete()
+    if scheduler is not None and (args.v or not complete):
+        output_processor.print_progress("Coverage of this run:")
+        for line in scheduler.get_coverage_report():
+            output_processor.print_progress("  " + line)
+
+    if checkpoints is not None and complete:
+        checkpoints.finish()
+
+    output_processor.close()
+
+    if profiler is not None:
+        profiler.write_report(args.profile)
+
+    if state is not None:
+        state.save()
 
     if issue_found:
         if args.v:
             output_processor.print_progress(
                 "Script finished. At least one issue has been detected.")
         sys.exit(2)
+    elif not complete:
+        if args.v:
+            output_processor.print_progress(
+                "Script finished. No issues detected, but not all checks have been completed.")
+        sys.exit(3)
     else:
         if args.v:
             output_processor.print_progress(
@@ -0,0 +1,205 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from icat_tools import utils
+from icat_tools.dbcheck_outputprocessors import OutputProcessor
+from icat_tools.name_resolver import ObjectNameResolver
+from icat_tools.scan_engine import ScanEngine
+import atexit
+import psycopg2
+import shutil
+import tempfile
+import threading
+import time
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+class MetricsOutputProcessor(OutputProcessor):
+    '''Output processor that counts findings per test, sub-check and type of finding, rather than
+       writing them. '''
+
+    def __init__(self):
+        super().__init__(None)
+        self.findings = {}
+
+    def output_item(self, check, values):
+        key = (check, values.get('check_name', ''), values.get('type', ''))
+        self.findings[key] = self.findings.get(key, 0) + 1
+
+
+def _format_labels(labels):
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ",".join('{}="{}"'.format(name, _escape(value)) for name, value in labels)
+
+
+class MetricsRegistry(object):
+    '''Keeps the results of the latest check of each test, and renders them in the
+       OpenMetrics text format. '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tests = {}
+        self.cycles = 0
+        self.cycle_duration = None
+
+    def update_test(self, test, findings, subchecks, duration, rows_scanned, success):
+        '''Records the results of a run of a test. Findings are counted per (test, sub-check, type).
+           Sub-checks without findings are reported with a count of zero. Findings of failed runs
+           are not recorded, so that the gauges keep the values of the last successful run. '''
+        with self.lock:
+            result = self.tests.setdefault(test, {'last_success': None, 'failures': 0})
+            result['duration'] = duration
+            result['rows_scanned'] = rows_scanned
+            result['up'] = 1 if success else 0
+            if success:
+                totals = {subcheck: 0 for subcheck in subchecks or ['']}
+                for (_, check_name, _), number in findings.items():
+                    totals[check_name] = totals.get(check_name, 0) + number
+                result['findings'] = findings
+                result['totals'] = totals
+                result['last_success'] = time.time()
+            else:
+                result['failures'] += 1
+
+    def update_cycle(self, duration):
+        with self.lock:
+            self.cycles += 1
+            self.cycle_duration = duration
+
+    def render(self):
+        lines = []
+
+        def _metric(name, metric_type, help_text, samples):
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            lines.append("# HELP {} {}".format(name, help_text))
+            # The samples of counters have a _total suffix
+            sample_name = name + "_total" if metric_type == 'counter' else name
+            for labels, value in samples:
+                lines.append("{}{{{}}} {}".format(sample_name, _format_labels(labels), value) if labels
+                             else "{} {}".format(sample_name, value))
+
+        with self.lock:
+            tests = sorted(self.tests.items())
+            _metric('icat_checker_findings', 'gauge',
+                    'Number of issues found by the last successful run, per test and sub-check.',
+                    [((('test', test), ('check', check_name)), number)
+                     for test, result in tests
+                     for check_name, number in sorted(result.get('totals', {}).items())])
+            _metric('icat_checker_findings_by_type', 'gauge',
+                    'Number of issues found by the last successful run, per test, sub-check and type.',
+                    [((('test', test), ('check', check_name), ('type', finding_type or '')), number)
+                     for test, result in tests
+                     for (_, check_name, finding_type), number in sorted(result.get('findings', {}).items(),
+                                                                         key=lambda item: str(item[0]))])
+            _metric('icat_checker_test_duration_seconds', 'gauge',
+                    'Duration of the last run of each test.',
+                    [((('test', test),), result['duration']) for test, result in tests])
+            _metric('icat_checker_rows_scanned', 'gauge',
+                    'Number of rows read by the database in the last run of each test.',
+                    [((('test', test),), result['rows_scanned']) for test, result in tests])
+            _metric('icat_checker_test_up', 'gauge',
+                    'Whether the last run of each test was successful.',
+                    [((('test', test),), result['up']) for test, result in tests])
+            _metric('icat_checker_last_success_timestamp_seconds', 'gauge',
+                    'Time of the last successful run of each test.',
+                    [((('test', test),), result['last_success']) for test, result in tests
+                     if result['last_success'] is not None])
+            _metric('icat_checker_test_failures', 'counter',
+                    'Number of failed runs of each test.',
+                    [((('test', test),), result['failures']) for test, result in tests])
+            if self.cycle_duration is not None:
+                _metric('icat_checker_cycle_duration_seconds', 'gauge',
+                        'Duration of the last cycle of checks.', [((), self.cycle_duration)])
+            _metric('icat_checker_cycles', 'counter', 'Number of completed cycles of checks.', [((), self.cycles)])
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def _get_request_handler(registry):
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ['/metrics', '/']:
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsRequestHandler
+
+
+def serve_metrics(args, config, get_detectors):
+    '''Runs the selected tests on a schedule, and serves the results as OpenMetrics gauges over HTTP
+       until the process is interrupted. The database connection and the name resolver cache are reused
+       between cycles. A connection that has been lost is replaced by a new one from the pool. The lookup
+       tables of resources and collections are kept in a cache, in a temporary directory unless the
+       --lookup-cache option is used, so that each cycle only reads the collections that have changed.
+
+       get_detectors is called each cycle to create the detectors, with the same arguments as
+       dbcheck_command.get_detectors.'''
+    registry = MetricsRegistry()
+    server = ThreadingHTTPServer((args.metrics_address, args.metrics_port), _get_request_handler(registry))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print_progress = OutputProcessor(None).print_progress
+    print_progress("Serving metrics on http://{}:{}/metrics".format(args.metrics_address, args.metrics_port))
+
+    if args.lookup_cache is None:
+        args.lookup_cache = tempfile.mkdtemp(prefix="icat-database-checker-lookups-")
+        atexit.register(shutil.rmtree, args.lookup_cache, True)
+
+    pool = utils.get_connection_pool(config, 1)
+    connection = pool.getconn()
+    resolver = ObjectNameResolver(connection)
+    scan_engine = ScanEngine(config, args.scan_jobs, args.itersize, conflict_retries=args.conflict_retries,
+                             scan_method=args.scan_method)
+    warnings_printed = False
+
+    while True:
+        cycle_start = time.monotonic()
+        if connection.closed:
+            pool.putconn(connection, close=True)
+            connection = pool.getconn()
+            resolver.connection = connection
+
+        output_processor = MetricsOutputProcessor()
+        for detector in get_detectors(args, connection, output_processor, resolver, None, scan_engine):
+            if not warnings_printed:
+                detector.print_option_warnings()
+            if args.v:
+                print_progress("Starting test {}".format(detector.get_name()))
+            output_processor.findings = {}
+            start = time.monotonic()
+            # Each test runs in a new transaction, so that it sees recent changes, and so that rows
+            # scanned can be measured per test.
+            connection.rollback()
+            try:
+                detector.run_with_retries()
+                success = True
+            except psycopg2.Error as error:
+                detector.print_error("Test {} failed: {}".format(detector.get_name(), error))
+                success = False
+            except Exception as error:
+                # Other errors of a test should not stop the exporter either
+                detector.print_error("Test {} failed: {}: {}".format(detector.get_name(), type(error).__name__, error))
+                success = False
+            try:
+                rows_scanned = utils.get_rows_scanned(connection)
+            except psycopg2.Error:
+                rows_scanned = 0
+            registry.update_test(detector.get_name(), output_processor.findings, detector.get_subchecks(),
+                                 time.monotonic() - start, rows_scanned, success)
+            if connection.closed:
+                break
+
+        warnings_printed = True
+        registry.update_cycle(time.monotonic() - cycle_start)
+        if not connection.closed:
+            connection.rollback()
+        time.sleep(max(0, args.metrics_interval - (time.monotonic() - cycle_start)))
@@ -1,6 +1,22 @@
 import csv
+import gzip
+import json
 import operator
+import os
 import sys
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 
 class OutputProcessor:
@@ -21,8 +37,18 @@ class OutputProcessor:
 
     def exit_error(self, message):
         self.print_error(message)
+        self.close()
         sys.exit(1)
 
+    def flush(self):
+        '''Writes buffered output to the output file. '''
+        if self.output is not None:
+            self.output.flush()
+
+    def close(self):
+        '''Writes any buffered output. Called once, after all checks have finished. '''
+        pass
+
 
 class CheckOutputProcessorHuman(OutputProcessor):
     def __init__(self, output):
@@ -110,6 +136,49 @@ class CheckOutputProcessorHuman(OutputProcessor):
                     "Error: unknown output item type for timestamps check: {}".format(
                         values['type']))
 
+        elif check == 'coll_tree':
+            if values['type'] == 'invalid_name':
+                self._prnln("Invalid collection name: {}".format(values['coll_name']))
+            elif values['type'] == 'parent_mismatch':
+                self._prnln("Parent collection name {} of collection {} does not match its name".format(
+                    values['parent_coll_name'],
+                    values['coll_name']))
+            elif values['type'] == 'missing_parent':
+                self._prnln("Parent collection {} of collection {} does not exist".format(
+                    values['parent_coll_name'],
+                    values['coll_name']))
+            elif values['type'] == 'not_zone_collection':
+                self._prnln("Top-level collection {} is not the collection of a zone".format(
+                    values['coll_name']))
+            else:
+                self.exit_error(
+                    "Error: unknown output item type for collection tree check: {}".format(
+                        values['type']))
+
+        elif check == 'vault':
+            if values['type'] == 'missing_file':
+                self._prnln("File not found for data object {}\n  Resource: {}\n  Path: {}".format(
+                    values['object_name'],
+                    values['resource_name'],
+                    values['phy_path']))
+            elif values['type'] == 'orphan_file':
+                self._prnln("No replica found for file {} on resource {}".format(
+                    values['phy_path'],
+                    values['resource_name']))
+            elif values['type'] == 'size_mismatch':
+                self._prnln(
+                    "Size of file does not match replica of data object {}\n  Resource: {}\n  Path: {}\n"
+                    "  Replica size: {}\n  File size: {}".format(
+                        values['object_name'],
+                        values['resource_name'],
+                        values['phy_path'],
+                        values['data_size'],
+                        values['file_size']))
+            else:
+                self.exit_error(
+                    "Error: unknown output item type for vault check: {}".format(
+                        values['type']))
+
         elif check == 'indexes':
             if values['type'] == 'missing_index':
                 self._prnln("Missing index: {}".format(values['index']))
@@ -181,6 +250,23 @@ class CheckOutputProcessorCSV(OutputProcessor):
                     "Error: unknown output item type for timestamps check: {}".format(
                         values['type']))
 
+        elif check == 'coll_tree':
+            if values['type'] in ['invalid_name', 'parent_mismatch', 'missing_parent', 'not_zone_collection']:
+                self.writer.writerow([check, values['type'], values['coll_name'], values['parent_coll_name']])
+            else:
+                self.exit_error(
+                    "Error: unknown output item type for collection tree check: {}".format(
+                        values['type']))
+
+        elif check == 'vault':
+            if values['type'] in ['missing_file', 'orphan_file', 'size_mismatch']:
+                self.writer.writerow([check, values['type'], values['resource_name'], values['phy_path'],
+                                      values['object_name'], values['data_size'], values['file_size']])
+            else:
+                self.exit_error(
+                    "Error: unknown output item type for vault check: {}".format(
+                        values['type']))
+
         elif check == 'indexes':
             if values['type'] == 'missing_index':
                 self.writer.writerow([check, values['type'], values['index']])
@@ -192,3 +278,166 @@ class CheckOutputProcessorCSV(OutputProcessor):
         else:
             self.exit_error(
                 "Error: unknown output check type: {}".format(check))
+
+
+class CheckOutputProcessorJSONL(OutputProcessor):
+    '''Writes each finding as a JSON object on a separate line. Each object has the name of the
+       test ("check") and the type of finding ("type", which is null for tests that report only one
+       type of finding), along with the values reported by the detector.
+
+       Lines are collected in a buffer, which is written when it is full, or at most flush_interval
+       seconds after a line has been added to it, also while a slow check does not report anything.
+       Output can optionally be compressed with gzip or zstd.'''
+
+    def __init__(self, output, compression='none', buffer_size=1048576, flush_interval=5):
+        super().__init__(output)
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.last_flush = time.monotonic()
+        # The buffer is also written by a timer thread
+        self.lock = threading.Lock()
+        self.timer = None
+        self.encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+        self.compressed = compression != 'none'
+        self.stream = None
+        if compression == 'zstd' and zstandard is None:
+            self.exit_error("Error: the zstandard package is needed for zstd compression.")
+
+        # Write bytes to the underlying binary stream, so that output can be compressed
+        output.flush()
+        self.stream = output.buffer
+        if compression == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=self.stream, mode='wb')
+        elif compression == 'zstd':
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.stream, closefd=False)
+
+    def output_item(self, check, values):
+        record = {'check': check, 'type': values.get('type')}
+        record.update(values)
+        line = (self.encoder.encode(record) + "\n").encode('utf-8')
+        with self.lock:
+            self.buffer.append(line)
+            self.buffered_bytes += len(line)
+            if (self.buffered_bytes >= self.buffer_size
+                    or time.monotonic() - self.last_flush >= self.flush_interval):
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self._flush_on_timer)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _flush_on_timer(self):
+        with self.lock:
+            self.timer = None
+            if self.stream is not None and len(self.buffer) > 0:
+                self._flush()
+
+    def _flush(self):
+        self.stream.write(b"".join(self.buffer))
+        self.stream.flush()
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.last_flush = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        if self.stream is None:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.flush()
+        if self.compressed:
+            # Writes the end of the compressed stream, but leaves the output file open
+            self.stream.close()
+        self.output.buffer.flush()
+        self.stream = None
+
+
+class CheckOutputProcessorParquet(OutputProcessor):
+    '''Writes the findings of each test to a separate Parquet file in the output directory, with
+       typed columns. Findings are collected in Arrow record batches of batch_size rows, and each
+       full batch is written as a row group, so that memory use does not depend on the number of
+       findings. Tests that report varying columns (names, timestamps, ref_integrity) store them
+       in a map column.'''
+
+    def __init__(self, output_dir, batch_size=65536):
+        super().__init__(None)
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.writers = {}
+        self.batches = {}
+        if pyarrow is None:
+            self.exit_error("Error: the pyarrow package is needed for the parquet output type.")
+        if output_dir is None:
+            self.exit_error("Error: the parquet output type needs an output directory (--output-dir).")
+        os.makedirs(output_dir, exist_ok=True)
+        self.schemas = self._get_schemas()
+
+    def _get_schemas(self):
+        string = pyarrow.string()
+        int64 = pyarrow.int64()
+        report_columns = pyarrow.map_(string, string)
+        return {
+            'hardlinks': pyarrow.schema([
+                ('type', string), ('resc_id', int64), ('resource_name', string), ('phy_path', string),
+                ('data_id', int64), ('object_name', string),
+                ('data_id1', int64), ('object1', string), ('data_id2', int64), ('object2', string)]),
+            'minreplicas': pyarrow.schema([
+                ('data_id', int64), ('object_name', string), ('number_replicas', int64), ('min_replicas', int64)]),
+            'path_consistency': pyarrow.schema([
+                ('data_id', int64), ('resc_id', int64), ('resource_name', string), ('phy_path', string),
+                ('data_name', string)]),
+            'names': pyarrow.schema([
+                ('type', string), ('check_name', string), ('report_columns', report_columns)]),
+            'timestamps': pyarrow.schema([
+                ('type', string), ('check_name', string), ('report_columns', report_columns)]),
+            'ref_integrity': pyarrow.schema([
+                ('check_name', string), ('report_columns', report_columns)]),
+            'coll_tree': pyarrow.schema([
+                ('type', string), ('coll_id', int64), ('coll_name', string), ('parent_coll_name', string)]),
+            'vault': pyarrow.schema([
+                ('type', string), ('resc_id', int64), ('resource_name', string), ('phy_path', string),
+                ('data_id', int64), ('object_name', string), ('data_size', int64), ('file_size', int64)]),
+            'indexes': pyarrow.schema([
+                ('type', string), ('index', string)])}
+
+    def output_item(self, check, values):
+        if check not in self.schemas:
+            self.exit_error(
+                "Error: unknown output check type: {}".format(check))
+
+        if check not in self.batches:
+            self.batches[check] = {field.name: [] for field in self.schemas[check]}
+        batch = self.batches[check]
+        for column, column_values in batch.items():
+            value = values.get(column)
+            if column == 'report_columns':
+                value = list(value.items())
+            column_values.append(value)
+
+        if len(batch[self.schemas[check].names[0]]) >= self.batch_size:
+            self._write_batch(check)
+
+    def _write_batch(self, check):
+        if check not in self.writers:
+            self.writers[check] = pyarrow.parquet.ParquetWriter(
+                os.path.join(self.output_dir, check + ".parquet"), self.schemas[check])
+        self.writers[check].write_batch(
+            pyarrow.RecordBatch.from_pydict(self.batches[check], schema=self.schemas[check]))
+        self.batches[check] = {field.name: [] for field in self.schemas[check]}
+
+    def close(self):
+        for check in list(self.batches):
+            # Batches that have just been written are empty, and would add empty row groups
+            if len(self.batches[check][self.schemas[check].names[0]]) > 0:
+                self._write_batch(check)
+        for writer in self.writers.values():
+            writer.close()
+        self.batches = {}
+        self.writers = {}
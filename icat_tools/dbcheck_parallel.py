@@ -0,0 +1,189 @@
+from concurrent.futures import ThreadPoolExecutor
+from icat_tools import utils
+from icat_tools.dbcheck_outputprocessors import OutputProcessor
+from icat_tools.query_scheduler import TimeBudgetExceeded
+import pickle
+import queue
+import sys
+import tempfile
+
+# Number of output items of a unit that are kept in memory while the output of preceding units is being
+# written. Further output is written to a temporary file.
+MAX_BUFFERED_OUTPUT = 10000
+
+
+class QueueOutputProcessor(OutputProcessor):
+    '''Output processor for detectors that run in a worker thread. It forwards all
+       output to a queue, so that only the main thread writes to the actual output. '''
+
+    def __init__(self, output_queue, unit):
+        super().__init__(None)
+        self.output_queue = output_queue
+        self.unit = unit
+
+    def output_message(self, message):
+        self.output_queue.put((self.unit, 'message', message))
+
+    def output_item(self, check, values):
+        self.output_queue.put((self.unit, 'item', (check, values)))
+
+    def print_progress(self, message):
+        self.output_queue.put((self.unit, 'progress', message))
+
+    def print_error(self, message):
+        self.output_queue.put((self.unit, 'error', message))
+
+
+class UnitOutputBuffer(object):
+    '''Output of a unit of work that cannot be written yet, because preceding units have not finished.
+       Up to MAX_BUFFERED_OUTPUT items are kept in memory; the rest is spilled to a temporary file, so
+       that memory use does not depend on the number of findings of the unit. '''
+
+    def __init__(self):
+        self.items = []
+        self.spill_file = None
+
+    def append(self, item):
+        self.items.append(item)
+        if len(self.items) >= MAX_BUFFERED_OUTPUT:
+            if self.spill_file is None:
+                self.spill_file = tempfile.TemporaryFile()
+            for buffered_item in self.items:
+                pickle.dump(buffered_item, self.spill_file)
+            self.items = []
+
+    def drain(self):
+        '''Yields the buffered items in order, and empties the buffer. '''
+        if self.spill_file is not None:
+            self.spill_file.seek(0)
+            while True:
+                try:
+                    yield pickle.load(self.spill_file)
+                except EOFError:
+                    break
+            self.spill_file.close()
+            self.spill_file = None
+        items, self.items = self.items, []
+        yield from items
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+
+def get_work_units(detectors):
+    '''Splits detectors into units of work that can run independently: one unit per sub-check
+       for detectors that have sub-checks, and one unit per detector otherwise. '''
+    units = []
+    for detector in detectors:
+        subchecks = detector.get_subchecks()
+        if len(subchecks) == 0:
+            units.append((detector, None))
+        else:
+            units.extend((detector, subcheck) for subcheck in subchecks
+                         if detector.need_to_run_subcheck(subcheck))
+    return units
+
+
+def _run_unit(args, pool, snapshot_id, output_queue, unit_num, detector, subcheck):
+    connection = pool.getconn()
+    try:
+        utils.import_snapshot(connection, snapshot_id)
+        unit_detector = type(detector)(args, connection, QueueOutputProcessor(output_queue, unit_num),
+                                       state=detector.state, scan_engine=detector.scan_engine,
+                                       profiler=detector.profiler, scheduler=detector.scheduler)
+        unit_detector.share_run_state(detector)
+        if subcheck is not None:
+            unit_detector.restrict_to_subcheck(subcheck)
+        if args.v:
+            unit_detector.print_progress(
+                "Starting test {}".format(detector.get_name())
+                + ("" if subcheck is None else " ({})".format(subcheck)))
+        if detector.scheduler is None:
+            issue_found = unit_detector.run_with_retries()
+        else:
+            try:
+                issue_found = detector.scheduler.run_check(connection, detector.get_name(), subcheck,
+                                                           unit_detector.run_with_retries)[1]
+            except TimeBudgetExceeded:
+                # The coverage report shows that the unit has been stopped
+                issue_found = False
+        output_queue.put((unit_num, 'done', issue_found))
+    except BaseException as error:
+        output_queue.put((unit_num, 'failed', error))
+    finally:
+        connection.rollback()
+        pool.putconn(connection)
+
+
+def run_detectors(args, config, connection, output_processor, detectors, snapshot_id=None):
+    '''Runs detectors concurrently on a pool of args.jobs connections. All connections share the
+       REPEATABLE READ snapshot of the main connection, so that all checks see the same database state.
+       The snapshot is exported, unless the identifier of a snapshot that the main connection has
+       exported before is passed. Output is written in the same order as when the detectors are run
+       one after another: the output of a unit is held back until all preceding units have finished,
+       in memory up to MAX_BUFFERED_OUTPUT items per unit and in a temporary file beyond that.
+
+       Returns True if an issue has been found, otherwise False.'''
+    if snapshot_id is None:
+        snapshot_id = utils.export_snapshot(connection)
+    pool = utils.get_connection_pool(config, args.jobs)
+    output_queue = queue.Queue()
+    units = get_work_units(detectors)
+    buffered_output = [UnitOutputBuffer() for _ in units]
+    finished = [False] * len(units)
+    failure = None
+    issue_found = False
+    next_unit = 0
+
+    def _write(kind, payload):
+        if kind == 'message':
+            output_processor.output_message(payload)
+        elif kind == 'item':
+            output_processor.output_item(*payload)
+
+    for detector in detectors:
+        detector.print_option_warnings()
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for unit_num, (detector, subcheck) in enumerate(units):
+            executor.submit(_run_unit, args, pool, snapshot_id,
+                            output_queue, unit_num, detector, subcheck)
+
+        while next_unit < len(units):
+            unit_num, kind, payload = output_queue.get()
+            if kind == 'progress':
+                output_processor.print_progress(payload)
+            elif kind == 'error':
+                output_processor.print_error(payload)
+            elif kind in ('done', 'failed'):
+                finished[unit_num] = True
+                if kind == 'done':
+                    issue_found = issue_found or payload
+                elif failure is None:
+                    failure = payload
+            elif unit_num == next_unit:
+                _write(kind, payload)
+            else:
+                buffered_output[unit_num].append((kind, payload))
+
+            # Output of units that have been queued after the current one is held back until
+            # all preceding units have finished, so that findings are not interleaved.
+            while next_unit < len(units) and finished[next_unit]:
+                next_unit += 1
+                if next_unit < len(units):
+                    for kind, payload in buffered_output[next_unit].drain():
+                        _write(kind, payload)
+
+    for unit_output in buffered_output:
+        unit_output.close()
+    pool.closeall()
+    connection.rollback()
+
+    if isinstance(failure, SystemExit):
+        sys.exit(failure.code)
+    elif failure is not None:
+        raise failure
+
+    return issue_found
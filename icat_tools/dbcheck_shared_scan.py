@@ -0,0 +1,129 @@
+from icat_tools import utils
+from icat_tools.scan_engine import get_range_end, RowVisitor
+from itertools import islice
+
+# Number of rows that are passed to the visitors at a time
+BATCH_SIZE = 1000
+
+
+class SharedScanProcessor(RowVisitor):
+    '''Processor for the scan engine that passes each batch of rows of a shared scan to a number
+       of visitors, each with the columns it needs. Yields (visitor number, result) tuples. '''
+
+    def __init__(self, visitors):
+        self.visitors = visitors
+        self.columns = tuple(sorted({column for visitor in visitors for column in visitor.columns}))
+        self.ordered = any(visitor.ordered for visitor in visitors)
+        self.projections = [[self.columns.index(column) for column in visitor.columns]
+                            for visitor in visitors]
+
+    def visit(self, rows):
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, BATCH_SIZE))
+            if len(batch) == 0:
+                break
+            for visitor_num, visitor in enumerate(self.visitors):
+                projection = self.projections[visitor_num]
+                for result in visitor.visit([tuple(row[i] for i in projection) for row in batch]):
+                    yield visitor_num, result
+
+    def visit_columns(self, columns):
+        for visitor_num, visitor in enumerate(self.visitors):
+            for result in visitor.visit_columns([columns[i] for i in self.projections[visitor_num]]):
+                yield visitor_num, result
+
+    def finish(self):
+        for visitor_num, visitor in enumerate(self.visitors):
+            for result in visitor.finish():
+                yield visitor_num, result
+
+
+def run_shared_scan(args, connection, scan_engine, detectors, checkpoints=None):
+    '''Reads r_data_main once, and performs the data object checks of all detectors that support
+       shared scans on the rows. Detectors whose checks are fully covered by the shared scan are
+       removed from the list of detectors; other detectors skip the sub-check that has been covered.
+       If progress is checkpointed, the scan continues where an interrupted run has stopped.
+
+       Returns True if an issue has been found, otherwise False.'''
+    visiting_detectors = []
+    visitors = []
+    for detector in detectors:
+        visitor = detector.get_data_object_visitor()
+        if visitor is not None:
+            visiting_detectors.append(detector)
+            visitors.append(visitor)
+
+    if len(visitors) == 0:
+        return False
+
+    if args.v and not (checkpoints is not None and checkpoints.is_completed('shared_scan')):
+        detectors[0].print_progress(
+            "Starting shared scan of data objects for tests: "
+            + ", ".join(detector.get_name() for detector in visiting_detectors))
+
+    # Detectors that are fully covered by the shared scan don't run on their own
+    for detector in visiting_detectors:
+        if detector.get_data_object_subcheck() is None:
+            detector.print_option_warnings()
+
+    processor = SharedScanProcessor(visitors)
+    conditions = ["data_id > %s", "data_id <= %s"]
+    params = ()
+    if args.data_object_prefix is not None:
+        prefix_condition, params = utils.get_data_object_prefix_condition(connection, args.data_object_prefix)
+        conditions.append(prefix_condition)
+    query = "SELECT {} FROM r_data_main WHERE {} {}".format(
+        ", ".join(processor.columns),
+        " AND ".join(conditions),
+        "ORDER BY data_id" if processor.ordered else "")
+    scheduler = detectors[0].scheduler
+    if checkpoints is None and scheduler is None:
+        partitions = [data_id_range + params for data_id_range in scan_engine.get_data_id_ranges(connection)]
+    elif checkpoints is not None and checkpoints.is_completed('shared_scan'):
+        partitions = []
+    else:
+        position = None if checkpoints is None else checkpoints.get_position('shared_scan')
+        partitions = (data_id_range + params for data_id_range in scan_engine.get_data_id_ranges(
+            connection, position, paged=True))
+
+    issue_found = False
+    pending = [[] for _ in visitors]
+
+    def flush(visitor_num):
+        visiting_detectors[visitor_num].output_visitor_results(pending[visitor_num])
+        pending[visitor_num] = []
+
+    if checkpoints is None and scheduler is None:
+        partition_done = None
+    else:
+        def partition_done(partition):
+            if checkpoints is not None:
+                for visitor_num in range(len(visitors)):
+                    flush(visitor_num)
+                checkpoints.set_position('shared_scan', None, get_range_end(partition))
+            if scheduler is not None:
+                scheduler.set_progress('shared_scan', None, get_range_end(partition))
+
+    profiler = detectors[0].profiler
+    cursor_factory = None if profiler is None else lambda name: profiler.cursor(connection, name, 'shared_scan')
+    for visitor_num, result in scan_engine.scan(connection, query, partitions, processor, cursor_factory,
+                                                partition_done):
+        issue_found = True
+        pending[visitor_num].append(result)
+        if len(pending[visitor_num]) >= BATCH_SIZE:
+            flush(visitor_num)
+
+    for visitor_num, detector in enumerate(visiting_detectors):
+        flush(visitor_num)
+        subcheck = detector.get_data_object_subcheck()
+        if detector.scheduler is not None:
+            detector.scheduler.set_completed(detector.get_name(), subcheck)
+        if subcheck is None:
+            detectors.remove(detector)
+        else:
+            detector.exclude_subcheck(subcheck)
+
+    if checkpoints is not None:
+        checkpoints.complete('shared_scan')
+    return issue_found
@@ -0,0 +1,42 @@
+import json
+import os
+
+
+class StateFile(object):
+    '''Local JSON file with information that is kept between runs of the script, such as
+       the high-water marks of incremental checks. The state of each database is kept
+       separately, so that the same file can be used for multiple databases. '''
+
+    def __init__(self, filename, config):
+        self.filename = filename
+        self.database_key = "{}:{}/{}".format(config['host'], config['port'], config['name'])
+        self.data = {}
+        self.run_timestamp = None
+        if os.path.isfile(filename):
+            with open(filename) as statefile:
+                self.data = json.load(statefile)
+
+    def start_run(self, timestamp):
+        '''Sets the time at which the current run started. Incremental checks that complete
+           during this run record it as their new high-water mark.'''
+        self.run_timestamp = timestamp
+
+    def _get_database_state(self):
+        return self.data.setdefault(self.database_key, {})
+
+    def get(self, section, key, default=None):
+        return self._get_database_state().get(section, {}).get(key, default)
+
+    def set(self, section, key, value):
+        self._get_database_state().setdefault(section, {})[key] = value
+
+    def clear(self, section):
+        self._get_database_state().pop(section, None)
+
+    def save(self):
+        '''Writes the state to disk. The file is replaced atomically, so that an
+           interrupted write does not corrupt the previous state.'''
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, "w") as statefile:
+            json.dump(self.data, statefile, indent=2, sort_keys=True)
+        os.replace(temp_filename, self.filename)
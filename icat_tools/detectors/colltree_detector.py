@@ -0,0 +1,165 @@
+from array import array
+from icat_tools.detectors.detector import Detector
+from icat_tools.scan_engine import RowVisitor
+import bisect
+import hashlib
+import heapq
+
+# Number of fingerprints that are kept in a set before they are moved to the sorted arrays
+FINGERPRINT_BATCH_SIZE = 4096
+
+
+def get_parent_name(coll_name):
+    '''Returns the name that the parent of a collection should have: its name up to the last slash. '''
+    parent_name = coll_name.rpartition("/")[0]
+    return parent_name if parent_name != "" else "/"
+
+
+def is_valid_name(coll_name):
+    '''Returns True if a collection name is an absolute path without empty components, such as
+       /zone/home/user. The root collection is called /. '''
+    return coll_name == "/" or (coll_name.startswith("/") and "//" not in coll_name and not coll_name.endswith("/"))
+
+
+def get_fingerprint(coll_name):
+    '''Returns a 64-bit fingerprint of a collection name. Unlike the built-in hash function, it does not
+       depend on the process, and names only share a fingerprint by a very small chance. '''
+    return int.from_bytes(hashlib.blake2b(coll_name.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class FingerprintSet(object):
+    '''Compact set of 64-bit fingerprints, which takes about 8 bytes per fingerprint.
+
+       New fingerprints are added to a small set. When it is full, they are moved to a sorted array,
+       which is merged with the existing arrays of the same or a smaller size. The set then consists
+       of a logarithmic number of sorted arrays, which are searched using binary search.'''
+
+    def __init__(self):
+        self.recent = set()
+        self.arrays = []
+
+    def add(self, fingerprint):
+        self.recent.add(fingerprint)
+        if len(self.recent) >= FINGERPRINT_BATCH_SIZE:
+            merged = array('Q', sorted(self.recent))
+            self.recent = set()
+            while len(self.arrays) > 0 and len(self.arrays[-1]) <= len(merged):
+                merged = array('Q', heapq.merge(self.arrays.pop(), merged))
+            self.arrays.append(merged)
+
+    def __contains__(self, fingerprint):
+        if fingerprint in self.recent:
+            return True
+        for fingerprints in self.arrays:
+            index = bisect.bisect_left(fingerprints, fingerprint)
+            if index < len(fingerprints) and fingerprints[index] == fingerprint:
+                return True
+        return False
+
+
+class CollectionTreeValidator(RowVisitor):
+    '''Processor for the scan engine that checks the tree of collections in a single pass over a stream
+       of (coll_id, coll_name, parent_coll_name) rows ordered by name. It yields (type, coll_id, coll_name,
+       parent_coll_name) tuples for collections:
+
+       - with a name that is not an absolute path without empty components (invalid_name),
+       - with a parent name that is not their own name up to the last slash (parent_mismatch). Each
+         parent is then one level closer to the root, so cycles are reported as well,
+       - with a parent that does not exist (missing_parent), and
+       - at the top level that are not the collection of a zone (not_zone_collection).
+
+       Rather than the names of the collections, it keeps a set of their 64-bit fingerprints, so that
+       memory use is proportional to the number of collections, not to the length of their names. The
+       rows need to be ordered by name in byte order (COLLATE "C"), in which the name of a parent sorts
+       before the names of its children, so that the parent of a collection has been seen when the
+       collection is checked. Only collections whose parent has not been seen are kept until the end
+       of the stream. The detector confirms by name that their parents are missing in the database.'''
+    columns = ('coll_id', 'coll_name', 'parent_coll_name')
+
+    def __init__(self, zone_names):
+        self.zone_names = zone_names
+        self.fingerprints = FingerprintSet()
+        self.pending = []
+
+    def visit(self, rows):
+        for coll_id, coll_name, parent_coll_name in rows:
+            self.fingerprints.add(get_fingerprint(coll_name))
+
+            if not is_valid_name(coll_name):
+                yield 'invalid_name', coll_id, coll_name, parent_coll_name
+            elif parent_coll_name != get_parent_name(coll_name):
+                yield 'parent_mismatch', coll_id, coll_name, parent_coll_name
+            elif coll_name != "/":
+                if get_fingerprint(parent_coll_name) not in self.fingerprints:
+                    self.pending.append((coll_id, coll_name, parent_coll_name))
+                if parent_coll_name == "/" and coll_name[1:] not in self.zone_names:
+                    yield 'not_zone_collection', coll_id, coll_name, parent_coll_name
+
+    def finish(self):
+        for coll_id, coll_name, parent_coll_name in self.pending:
+            yield 'missing_parent', coll_id, coll_name, parent_coll_name
+        self.fingerprints = FingerprintSet()
+        self.pending = []
+
+
+class CollectionTreeDetector(Detector):
+    def get_name(self):
+        return "coll_tree"
+
+    def included_in_all(self):
+        # The test sorts all collections by name, which is too expensive for every run
+        return False
+
+    def print_option_warnings(self):
+        super().print_option_warnings()
+        if self.args.data_object_prefix:
+            self.print_error(
+                "The collection tree test does not support the --data-object-prefix option.")
+            self.print_error(
+                "Ignoring the --data-object-prefix option for this test.")
+
+    def _get_zone_names(self):
+        cursor = self.get_cursor()
+        cursor.execute("SELECT zone_name FROM r_zone_main")
+        result = set(row[0] for row in cursor)
+        cursor.close()
+        return result
+
+    def _get_existing_collections(self, coll_names):
+        cursor = self.get_cursor()
+        cursor.execute("SELECT coll_name FROM r_coll_main WHERE coll_name = ANY(%s)", (list(coll_names),))
+        result = set(row[0] for row in cursor)
+        cursor.close()
+        return result
+
+    def run(self):
+        issue_found = False
+        # The collections are read in a single partition, since the order of the names matters
+        query = "SELECT coll_id, coll_name, parent_coll_name FROM r_coll_main ORDER BY coll_name COLLATE \"C\""
+        processor = CollectionTreeValidator(self._get_zone_names())
+        missing_parents = []
+        for finding in self.scan(query, [()], processor):
+            if finding[0] == 'missing_parent':
+                missing_parents.append(finding)
+            else:
+                self._output_finding(finding)
+                issue_found = True
+
+        # Missing parents are found at the end of the scan. Confirm them by name, so that the result does
+        # not depend on the order in which the database returns the names.
+        if len(missing_parents) > 0:
+            existing = self._get_existing_collections(set(finding[3] for finding in missing_parents))
+            for finding in missing_parents:
+                if finding[3] not in existing:
+                    self._output_finding(finding)
+                    issue_found = True
+
+        return issue_found
+
+    def _output_finding(self, finding):
+        finding_type, coll_id, coll_name, parent_coll_name = finding
+        self.output_item(
+            {'type': finding_type,
+             'coll_id': coll_id,
+             'coll_name': coll_name,
+             'parent_coll_name': parent_coll_name})
@@ -1,12 +1,102 @@
+from icat_tools import utils
+from icat_tools.lookup_cache import CatalogLookups
+from icat_tools.name_resolver import ObjectNameResolver
+from icat_tools.scan_engine import ScanEngine
+
+# Incremental runs check rows modified up to this number of seconds before the start of the previous run,
+# so that rows committed after that run had started, or timestamped by a server whose clock runs behind
+# the database server, are not missed
+WATERMARK_MARGIN = 300
+
+
 class Detector(object):
-    def __init__(self, args, connection, output_processor):
+    def __init__(self, args, connection, output_processor, resolver=None, state=None, scan_engine=None, profiler=None,
+                 checkpoints=None, scheduler=None):
         self.args = args
         self.connection = connection
         self.output_processor = output_processor
+        self.resolver = resolver if resolver is not None else ObjectNameResolver(connection)
+        self.state = state
+        self.scan_engine = scan_engine if scan_engine is not None else ScanEngine()
+        self.profiler = profiler
+        self.checkpoints = checkpoints
+        self.scheduler = scheduler
+        self._profiled_cursor = None
+        self.subcheck = None
+        self.excluded_subchecks = set()
+        self._prefix_condition = None
+        self.findings = 0
 
     def output_item(self, values):
+        self.findings += 1
+        if self._profiled_cursor is not None:
+            self.profiler.add_findings(self._profiled_cursor)
+        if self.checkpoints is not None:
+            self.checkpoints.add_finding(self.get_name())
         self.output_processor.output_item(self.get_name(), values)
 
+    def run_with_retries(self):
+        '''Runs the detector, and runs it again in a new transaction if one of its queries has been
+           cancelled because of a conflict with recovery on a hot standby, up to --conflict-retries
+           times. It is only run again if it has not reported any issues yet, so that issues are not
+           reported twice.'''
+        findings = self.findings
+        return utils.run_with_conflict_retries(self.connection, self.run, self.args.conflict_retries,
+                                               lambda: self.findings == findings)
+
+    def get_cursor(self, name=None, check_name=None):
+        '''Returns a cursor for a query of the detector. Named cursors are server-side cursors. If
+           profiling is enabled, statistics of the query and the findings that follow it are recorded.
+           If a query scheduler is set, the query waits for it.'''
+        if self.profiler is None:
+            cursor = self.connection.cursor(name) if name is not None else self.connection.cursor()
+        else:
+            self._profiled_cursor = self.profiler.cursor(
+                self.connection, name, self.get_name(), check_name if check_name is not None else self.subcheck)
+            cursor = self._profiled_cursor
+        return cursor if self.scheduler is None else self.scheduler.cursor(cursor, self.connection)
+
+    def scan(self, query, partitions, processor, check_name=None, get_position=None, flush=None):
+        '''Runs a large scan using the scan engine, and yields the results of the processor.
+
+           The position returned by get_position for the parameters of each completed partition is
+           recorded in the checkpoints, so that an interrupted run can continue after it, and in the
+           coverage report of the query scheduler. The optional flush function is called first, to
+           report results that have been held back.'''
+        self._profiled_cursor = None
+        if get_position is None or (self.checkpoints is None and self.scheduler is None):
+            partition_done = None
+        else:
+            def partition_done(params):
+                position = get_position(params)
+                if self.checkpoints is not None:
+                    if flush is not None:
+                        flush()
+                    self.checkpoints.set_position(self.get_name(), check_name, position)
+                if self.scheduler is not None:
+                    self.scheduler.set_progress(self.get_name(), check_name, position)
+        if self.profiler is None and self.scheduler is None:
+            cursor_factory = None
+        else:
+            def cursor_factory(name):
+                return self.get_cursor(name, check_name)
+        return self.scan_engine.scan(self.connection, query, partitions, processor, cursor_factory, partition_done)
+
+    def get_data_id_partitions(self, params=(), check_name=None):
+        '''Returns the partitions of a scan of r_data_main by ranges of data object ids, each followed
+           by the query parameters in params. If progress is checkpointed or queries are scheduled, the
+           partitions are pages, which start after the position reached by an interrupted run.'''
+        if self.checkpoints is None and self.scheduler is None:
+            return [data_id_range + params for data_id_range in self.scan_engine.get_data_id_ranges(self.connection)]
+        position = None if self.checkpoints is None else self.checkpoints.get_position(self.get_name(), check_name)
+        data_id_ranges = self.scan_engine.get_data_id_ranges(self.connection, position, paged=True)
+        return (data_id_range + params for data_id_range in data_id_ranges)
+
+    def get_catalog_lookups(self):
+        '''Returns the lookup tables of resources and collections. If the --lookup-cache option is used,
+           they are kept in a local cache between runs.'''
+        return CatalogLookups(self.connection, self.args.lookup_cache)
+
     def output_message(self, message):
         self.output_processor.output_message(message)
 
@@ -21,3 +111,92 @@ class Detector(object):
 
     def get_name(self):
         return "detector_superclass"
+
+    def print_option_warnings(self):
+        '''Prints warnings about command line options that the detector does not support. This is
+           done once per detector, also when its sub-checks are run separately. '''
+        if self.state is not None and not self.supports_incremental():
+            self.print_error(
+                "The {} test does not support the --incremental option, and always checks all rows.".format(
+                    self.get_name()))
+
+    def included_in_all(self):
+        '''Returns True if the detector runs when all tests are selected. Tests that do more than query
+           the database only run if they are selected explicitly.'''
+        return True
+
+    def supports_incremental(self):
+        '''Returns True if the detector can limit its checks to rows that have been modified since
+           the previous run, without missing issues.'''
+        return False
+
+    def get_incremental_condition(self, check_name, table, column='modify_ts'):
+        '''Returns a query condition that selects the rows of the table that have been modified since
+           the check last completed, or None if all rows need to be checked. Rows modified up to
+           WATERMARK_MARGIN seconds before the previous run are checked again, so that they cannot be
+           missed.'''
+        if self.state is None or not self.supports_incremental():
+            return None
+        watermark = self.state.get(self.get_name(), check_name)
+        if watermark is None:
+            return None
+        # Timestamps are stored as zero-padded strings, so they can be compared as strings
+        return "{}.{} >= '{:011d}'".format(table, column, max(0, watermark - WATERMARK_MARGIN))
+
+    def get_prefix_condition(self, table='r_data_main'):
+        '''Returns a condition for queries of the table that applies the --data-object-prefix option,
+           along with its query parameters. Only queries of r_data_main are filtered.'''
+        if table != 'r_data_main' or self.args.data_object_prefix is None:
+            return "", ()
+        if self._prefix_condition is None:
+            self._prefix_condition = utils.get_data_object_prefix_condition(
+                self.connection, self.args.data_object_prefix)
+        condition, params = self._prefix_condition
+        return "AND " + condition, params
+
+    def update_watermark(self, check_name):
+        '''Records that the check has completed, so that the next incremental run only needs
+           to check rows modified since the start of this run. Runs with the --data-object-prefix
+           option have not checked all rows, so they are not recorded.'''
+        if self.state is not None and self.supports_incremental() and self.args.data_object_prefix is None:
+            self.state.set(self.get_name(), check_name, self.state.run_timestamp)
+
+    def share_run_state(self, detector):
+        '''Makes the detector share state that is built once per run, such as lookup tables, with another
+           detector of the same test. This is used by parallel runs, whose units of work each have their
+           own detector, on connections that share a snapshot.'''
+        pass
+
+    def get_subchecks(self):
+        '''Returns the names of the sub-checks of this detector that can be run independently
+           of each other. Detectors that can only be run as a whole return an empty list.'''
+        return []
+
+    def restrict_to_subcheck(self, name):
+        '''Makes the detector only run the sub-check with the given name.'''
+        self.subcheck = name
+
+    def exclude_subcheck(self, name):
+        '''Makes the detector skip the sub-check with the given name, e.g. because it has
+           already been performed as part of a shared scan.'''
+        self.excluded_subchecks.add(name)
+
+    def need_to_run_subcheck(self, name):
+        return name not in self.excluded_subchecks and (self.subcheck is None or self.subcheck == name)
+
+    def get_data_object_visitor(self):
+        '''Returns a row visitor that performs the data object checks of this detector as part of
+           a shared scan of r_data_main, or None if the detector does not support shared scans.'''
+        return None
+
+    def get_data_object_subcheck(self):
+        '''Returns the name of the sub-check that the data object visitor performs, or None if
+           the visitor performs all checks of the detector.'''
+        return None
+
+    def output_visitor_results(self, results):
+        '''Reports a batch of results of the data object visitor of this detector. Returns True
+           if an issue has been found, otherwise False.'''
+        for result in results:
+            self.output_item(result)
+        return len(results) > 0
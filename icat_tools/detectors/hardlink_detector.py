@@ -1,54 +1,146 @@
-from icat_tools import utils
 from icat_tools.detectors.detector import Detector
+from icat_tools.scan_engine import iterate_rows, RowVisitor
+from itertools import compress
+from operator import eq
+
+
+class AdjacentPathGrouper(RowVisitor):
+    '''Processor for the scan engine that groups a stream of (resc_id, data_path, data_id) rows
+       ordered by path, and yields the paths that are used more than once as (resc_id, data_path,
+       data_ids) tuples. Duplicates are found by comparing adjacent rows.'''
+    columns = ('resc_id', 'data_path', 'data_id')
+
+    def __init__(self):
+        self.current_key = None
+        self.current_ids = []
+
+    def visit(self, rows):
+        for row in rows:
+            if (row[0], row[1]) != self.current_key:
+                for result in self.finish():
+                    yield result
+                self.current_key = (row[0], row[1])
+            self.current_ids.append(row[2])
+
+    def visit_columns(self, columns):
+        '''Finds duplicates in a batch of columns. Adjacent paths are compared for the whole batch at
+           once, so that only rows with the same path as the previous row are processed one by one.'''
+        resc_ids, paths, data_ids = columns
+        number_rows = len(data_ids)
+        if number_rows == 0:
+            return []
+        results = []
+        # Positions of rows with the same resource and path as the previous row, grouped into runs
+        runs = []
+        for position in compress(range(1, number_rows), map(eq, paths[1:], paths)):
+            if resc_ids[position] != resc_ids[position - 1]:
+                continue
+            if len(runs) > 0 and runs[-1][1] == position - 1:
+                runs[-1][1] = position
+            else:
+                runs.append([position, position])
+
+        # The first row continues the group of the previous batch if it has the same resource and path
+        if (resc_ids[0], paths[0]) != self.current_key:
+            results.extend(self.finish())
+            self.current_key = (resc_ids[0], paths[0])
+        first_group_end = runs.pop(0)[1] if len(runs) > 0 and runs[0][0] == 1 else 0
+        self.current_ids.extend(data_ids[:first_group_end + 1])
+        if first_group_end == number_rows - 1:
+            return results
+        results.extend(self.finish())
+
+        # The group of the last row can continue in the next batch
+        for start, end in runs:
+            if end == number_rows - 1:
+                self.current_key = (resc_ids[start - 1], paths[start - 1])
+                self.current_ids = data_ids[start - 1:]
+                return results
+            results.append((resc_ids[start - 1], paths[start - 1], data_ids[start - 1:end + 1]))
+        self.current_key = (resc_ids[-1], paths[-1])
+        self.current_ids = [data_ids[-1]]
+        return results
+
+    def finish(self):
+        if len(self.current_ids) > 1:
+            yield self.current_key[0], self.current_key[1], self.current_ids
+        self.current_key = None
+        self.current_ids = []
 
 
 class HardlinkDetector(Detector):
     def get_name(self):
         return "hardlinks"
 
-    def run(self):
-        issue_found = False
-        resource_name_lookup = utils.get_resource_name_dict(self.connection)
+    def _output_duplicates(self, duplicates, resource_name_lookup):
+        object_names = self.resolver.resolve_dataobjects(
+            [this_id for this_id, _, _, _ in duplicates] + [other_id for _, other_id, _, _ in duplicates])
+        for this_id, other_id, resc_id, phy_path in duplicates:
+            this_object = object_names.get(this_id)
+            other_object = object_names.get(other_id)
+            if this_object == other_object:
+                self.output_item(
+                    {'type': 'duplicate_dataobject_entry',
+                     'object_name': this_object,
+                     'resource_name': resource_name_lookup[resc_id],
+                     'phy_path': phy_path,
+                     'data_id': this_id,
+                     'resc_id': resc_id})
+            else:
+                self.output_item(
+                    {'type': 'hardlink',
+                     'phy_path': phy_path,
+                     'resource_name': resource_name_lookup[resc_id],
+                     'object1': this_object,
+                     'object2': other_object,
+                     'data_id1': this_id,
+                     'data_id2': other_id,
+                     'resc_id': resc_id})
 
+    def print_option_warnings(self):
+        super().print_option_warnings()
         if self.args.data_object_prefix:
             self.print_error(
                 "The hard links test does not support the --data-object-prefix option.")
             self.print_error(
                 "Ignoring the --data-object-prefix option for this test.")
 
-        for resc_id, resc_path in utils.get_resource_vault_path_dict(
-                self.connection).items():
-
-            query = "SELECT data_id, data_path FROM r_data_main WHERE resc_id = {}".format(
-                resc_id)
-
-            lookup_path = {}
-            cursor = self.connection.cursor(self.get_name())
-            cursor.execute(query)
-
-            for row in cursor:
-                if row[1] in lookup_path:
-                    issue_found = True
-                    this_object = utils.get_dataobject_name(
-                        self.connection, row[0])
-                    other_object = utils.get_dataobject_name(
-                        self.connection, lookup_path[row[1]])
-                    if this_object == other_object:
-                        self.output_item(
-                            {'type': 'duplicate_dataobject_entry',
-                             'object_name': this_object,
-                             'resource_name': resource_name_lookup[resc_id],
-                             'phy_path': row[1]})
-                    else:
-                        self.output_item(
-                            {'type': 'hardlink',
-                             'phy_path': row[1],
-                             'resource_name': resource_name_lookup[resc_id],
-                             'object1': this_object,
-                             'object2': other_object})
-                else:
-                    lookup_path[row[1]] = row[0]
-
-            cursor.close()
+    def run(self):
+        issue_found = False
+        lookups = self.get_catalog_lookups()
+        resource_name_lookup = lookups.get_resource_names()
+
+        if self.args.hardlinks_mode == 'stream':
+            # Streams the replicas of each resource ordered by physical path
+            query = ("SELECT resc_id, data_path, data_id FROM r_data_main "
+                     + "WHERE resc_id = %s ORDER BY data_path, data_id")
+            processor = AdjacentPathGrouper()
+        else:
+            # Groups the replicas of each resource by physical path in the database
+            query = ("SELECT resc_id, data_path, array_agg(data_id ORDER BY data_id) FROM r_data_main "
+                     + "WHERE resc_id = %s GROUP BY resc_id, data_path HAVING count(*) > 1")
+            processor = iterate_rows
+
+        # Each resource is scanned as a separate partition, in order of resource id, so that
+        # an interrupted run can continue after the last resource that has been completed.
+        position = None if self.checkpoints is None else self.checkpoints.get_position(self.get_name())
+        partitions = [(resc_id,) for resc_id in sorted(lookups.get_resource_vault_paths())
+                      if position is None or resc_id > position]
+
+        duplicates = []
+
+        def flush():
+            self._output_duplicates(duplicates, resource_name_lookup)
+            del duplicates[:]
+
+        for resc_id, phy_path, data_ids in self.scan(query, partitions, processor,
+                                                     get_position=lambda params: params[0], flush=flush):
+            issue_found = True
+            # Each data object is compared with the first data object that refers to
+            # the same path.
+            duplicates.extend((data_id, data_ids[0], resc_id, phy_path) for data_id in data_ids[1:])
+            if len(duplicates) >= self.resolver.batch_size:
+                flush()
 
+        flush()
         return issue_found
@@ -1,42 +1,128 @@
-from icat_tools import utils
 from icat_tools.detectors.detector import Detector
+from icat_tools.scan_engine import get_range_end, iterate_rows, RowVisitor
+from itertools import compress
+from operator import ne
+
+
+class ReplicaCounter(RowVisitor):
+    '''Processor for the scan engine that counts the replicas of data objects in a stream
+       of (data_id, resc_id) rows ordered by data object id, and yields the ids and replica
+       counts of data objects with too few replicas. '''
+    columns = ('data_id', 'resc_id')
+    ordered = True
+
+    def __init__(self, min_replicas):
+        self.min_replicas = min_replicas
+        self.current_data_id = None
+        self.current_resources = set()
+
+    def visit(self, rows):
+        for row in rows:
+            if row[0] != self.current_data_id:
+                for result in self.finish():
+                    yield result
+                self.current_data_id = row[0]
+            self.current_resources.add(row[1])
+
+    def visit_columns(self, columns):
+        '''Counts replicas in a batch of columns. The rows of each data object are found by comparing
+           adjacent data object ids for the whole batch at once.'''
+        data_ids, resc_ids = columns
+        if len(data_ids) == 0:
+            return []
+        results = []
+        starts = [0]
+        starts.extend(compress(range(1, len(data_ids)), map(ne, data_ids[1:], data_ids)))
+        starts.append(len(data_ids))
+        for start, end in zip(starts, starts[1:]):
+            if data_ids[start] != self.current_data_id:
+                results.extend(self.finish())
+                self.current_data_id = data_ids[start]
+            self.current_resources.update(resc_ids[start:end])
+        return results
+
+    def finish(self):
+        if self.current_data_id is not None and len(self.current_resources) < self.min_replicas:
+            yield self.current_data_id, len(self.current_resources)
+        self.current_data_id = None
+        self.current_resources = set()
 
 
 class MinreplicaIssueDetector(Detector):
     def get_name(self):
         return 'minreplicas'
 
-    def run(self):
+    def _get_query_condition(self):
+        '''Returns the query condition for a range of data object ids and the --data-object-prefix option,
+           along with the query parameters for each partition of the scan.'''
+        prefix_condition, prefix_params = self.get_prefix_condition()
+        partitions = self.get_data_id_partitions(prefix_params)
+        return "WHERE r_data_main.data_id > %s AND r_data_main.data_id <= %s " + prefix_condition, partitions
+
+    def _output_violations(self, violations):
+        object_names = self.resolver.resolve_dataobjects(
+            [data_id for data_id, _ in violations])
+        for data_id, number_replicas in violations:
+            self.output_item({
+                'object_name': object_names.get(data_id),
+                'number_replicas': number_replicas,
+                'min_replicas': self.args.min_replicas,
+                'data_id': data_id})
+
+    def get_data_object_visitor(self):
+        return ReplicaCounter(self.args.min_replicas)
+
+    def output_visitor_results(self, results):
+        self._output_violations(results)
+        return len(results) > 0
+
+    def _run_aggregate(self):
+        '''Counts replicas in the database, so that only data objects with too few
+           replicas are sent to the client, along with their names.'''
         issue_found = False
+        query_condition, partitions = self._get_query_condition()
+        query = ("SELECT r_coll_main.coll_name || '/' || replicas.data_name, replicas.number_replicas, replicas.data_id FROM "
+                 + "( SELECT data_id, min(coll_id) AS coll_id, min(data_name) AS data_name, count(DISTINCT resc_id) AS number_replicas "
+                 + "FROM r_data_main {} GROUP BY data_id HAVING count(DISTINCT resc_id) < {:d} ) AS replicas "
+                 + "LEFT JOIN r_coll_main ON r_coll_main.coll_id = replicas.coll_id "
+                 + "ORDER BY replicas.data_id").format(query_condition, self.args.min_replicas)
 
-        if self.args.data_object_prefix is None:
-            query_condition = ""
-        else:
-            query_condition = "WHERE concat ( ( select coll_name from r_coll_main where coll_id = r_data_main.coll_id ), '/', r_data_main.data_name) LIKE '{}%'".format(
-                self.args.data_object_prefix)
+        for row in self.scan(query, partitions, iterate_rows, get_position=get_range_end):
+            issue_found = True
+            self.output_item({
+                'object_name': row[0],
+                'number_replicas': row[1],
+                'min_replicas': self.args.min_replicas,
+                'data_id': row[2]})
+
+        return issue_found
 
-        query = "SELECT data_id, resc_id FROM r_data_main {}".format(
+    def _run_stream(self):
+        '''Streams replicas ordered by data object id, so that replicas only need
+           to be counted for one data object at a time.'''
+        issue_found = False
+        query_condition, partitions = self._get_query_condition()
+        query = "SELECT data_id, resc_id FROM r_data_main {} ORDER BY data_id".format(
             query_condition)
-        cursor = self.connection.cursor(self.get_name())
-        cursor.execute(query)
-        data_resc_lookup = {}
-
-        for row in cursor:
-            if row[0] in data_resc_lookup:
-                if row[1] not in data_resc_lookup[row[0]]:
-                    data_resc_lookup[row[0]][row[1]] = ""
-            else:
-                data_resc_lookup[row[0]] = {row[1]: ""}
-
-        for data_id, resc_dict in data_resc_lookup.items():
-            number_replicas = len(resc_dict.keys())
-            if number_replicas < self.args.min_replicas:
-                issue_found = True
-                object_name = utils.get_dataobject_name(
-                    self.connection, data_id)
-                self.output_item({
-                    'object_name': object_name,
-                    'number_replicas': number_replicas,
-                    'min_replicas': self.args.min_replicas})
 
+        violations = []
+
+        def flush():
+            self._output_violations(violations)
+            del violations[:]
+
+        for violation in self.scan(query, partitions, ReplicaCounter(self.args.min_replicas),
+                                   get_position=get_range_end, flush=flush):
+            issue_found = True
+            violations.append(violation)
+            if len(violations) >= self.resolver.batch_size:
+                flush()
+
+        flush()
         return issue_found
+
+    def run(self):
+        if self.args.minreplicas_mode == 'stream':
+            return self._run_stream()
+        else:
+            return self._run_aggregate()
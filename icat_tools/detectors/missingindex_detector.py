@@ -8,12 +8,16 @@ class MissingIndexDetector(Detector):
     def get_name(self):
         return "indexes"
 
+    def print_option_warnings(self):
+        # This test does not scan any catalog tables, so the --incremental option does not apply to it
+        pass
+
     def _get_expected_index_filename(self):
         return "/var/lib/irods/packaging/sql/icatSysTables.sql"
 
     def _get_actual_indexes(self):
         query = "SELECT indexname FROM pg_indexes WHERE schemaname = 'public' ORDER BY indexname"
-        cursor = self.connection.cursor("missing_indexes")
+        cursor = self.get_cursor("missing_indexes")
         cursor.execute(query)
         return [r[0] for r in list(cursor)]
 
@@ -1,5 +1,23 @@
-from icat_tools import utils
 from icat_tools.detectors.detector import Detector
+from icat_tools.scan_engine import RowVisitor
+import re
+
+
+class NameChecker(RowVisitor):
+    '''Row visitor that performs the name checks for data objects in a shared scan, and yields
+       (type, row) tuples for data objects with a problematic name. '''
+    columns = ('data_id', 'data_name', 'coll_id')
+    buggy_characters = re.compile('[`\x01-\x08\x0b\x0c\x0e-\x1f]')
+
+    def visit(self, rows):
+        for row in rows:
+            name = row[1]
+            if name == '':
+                yield 'empty_name', row
+            if name != '/' and name.endswith('/'):
+                yield 'trailing_slash', row
+            if self.buggy_characters.search(name):
+                yield 'buggy_characters', row
 
 
 class NameIssueDetector(Detector):
@@ -31,111 +49,111 @@ class NameIssueDetector(Detector):
                 'name': 'zone_name'}}
         return data.items()
 
-    def _get_prefix_condition(self, table):
-        if table == 'r_data_main' and self.args.data_object_prefix is not None:
-            return "AND concat ( ( select coll_name from r_coll_main where coll_id = r_data_main.coll_id ), '/', r_data_main.data_name) LIKE '{}%'".format(
-                self.args.data_object_prefix)
-        else:
-            return ""
-
-    def _check_name_empty(self, table, name, report_columns):
-        query = "SELECT {} FROM {} WHERE {} = '' {}".format(
-            ",".join(report_columns), table, name, self._get_prefix_condition(table))
-        cursor = self.connection.cursor(
-            "{}._check_name_empty".format(
-                self.get_name()))
-        cursor.execute(query)
-        return cursor
-
-    def _check_name_buggy_characters(self, table, name, report_columns):
-        query = r"SELECT {} FROM {} WHERE {} ~ '[\`\x01\x02\x03\x04\x05\x06\x07\x08\x0b\x0c\x0e\x0f\x10\x11\x12\x13\x14\x15\x16\x17\x18\x19\x1a\x1b\x1c\x1d\x1e\x1f]' {}".format(
-            ",".join(report_columns), table, name, self._get_prefix_condition(table))
-        cursor = self.connection.cursor(
-            "{}._check_buggy_characters".format(
-                self.get_name()))
-        cursor.execute(query)
+    def supports_incremental(self):
+        return True
+
+    def get_subchecks(self):
+        return [check_name for check_name, _ in self._get_name_check_data()]
+
+    def _get_incremental_condition(self, check_name, table):
+        condition = self.get_incremental_condition(check_name, table)
+        return "" if condition is None else "AND " + condition
+
+    def _get_name_checks(self, check_name, name):
+        '''Returns the type and query condition of each name check for a table. '''
+        checks = [('empty_name', "{} = ''".format(name))]
+        if check_name in ["data object", "collection"]:
+            checks.append(('trailing_slash', "{0} != '/' AND {0} LIKE '%%/'".format(name)))
+        checks.append(('buggy_characters', r"{} ~ '[\`\x01\x02\x03\x04\x05\x06\x07\x08\x0b\x0c\x0e\x0f\x10\x11\x12\x13\x14\x15\x16\x17\x18\x19\x1a\x1b\x1c\x1d\x1e\x1f]'".format(name)))
+        return checks
+
+    def _check_names(self, check_name, table, name, report_columns, checks):
+        '''Runs all name checks for a table in a single query. It returns the rows that fail at least one
+           check, with a column for each check that tells whether the row fails it. '''
+        prefix_condition, prefix_params = self.get_prefix_condition(table)
+        query = "SELECT {}, {} FROM {} WHERE ( {} ) {} {}".format(
+            ",".join(report_columns),
+            ", ".join("( {} ) AS {}".format(condition, type_name) for type_name, condition in checks),
+            table,
+            " OR ".join("( {} )".format(condition) for _, condition in checks),
+            prefix_condition,
+            self._get_incremental_condition(check_name, table))
+        cursor = self.get_cursor(
+            "{}._check_names".format(
+                self.get_name()), check_name)
+        cursor.execute(query, prefix_params)
         return cursor
 
-    def _check_name_trailing_slash(self, table, name, report_columns):
-        query = "SELECT {} FROM {} WHERE {} != '/' AND {} LIKE '%/' {}".format(
-            ",".join(report_columns), table, name, name, self._get_prefix_condition(table))
-        cursor = self.connection.cursor(
-            "{}._check_name_trailing_slash".format(
-                self.get_name()))
-        cursor.execute(query)
-        return cursor
+    def _output_rows(self, check_name, report_columns, typed_rows):
+        """Translates a batch of (type, row) tuples with the results of a check to generic
+           output dictionaries and feeds them to the output processor. Also translates
+           collection IDs to collection names for readability."""
+        if 'coll_id' in report_columns:
+            coll_names = self.resolver.resolve_collections(
+                row[report_columns.index('coll_id')] for _, row in typed_rows)
+
+        for type_name, row in typed_rows:
+            output = {
+                'type': type_name,
+                'check_name': check_name,
+                'report_columns': {}}
+            column_num = 0
+            for report_column in report_columns:
+                if str(report_column) == 'coll_id':
+                    coll_name = coll_names.get(row[column_num])
+                    if coll_name is not None:
+                        output['report_columns']['Collection name'] = coll_name
+                else:
+                    output['report_columns'][str(report_column)] = str(
+                        row[column_num])
+                column_num = column_num + 1
+
+            self.output_item(output)
+
+    def get_data_object_visitor(self):
+        if self.state is not None:
+            return None
+        return NameChecker()
+
+    def get_data_object_subcheck(self):
+        return 'data object'
+
+    def output_visitor_results(self, results):
+        check_data = dict(self._get_name_check_data())
+        self._output_rows('data object', check_data['data object']['report_columns'], results)
+        return len(results) > 0
 
     def run(self):
         issue_found = False
 
-        def _do_output(type_name, report_columns, query_result):
-            """Internal function for translating query results of a check to a generic
-               output dictionary and feeding it to the output processor. Also translates
-               collection IDs to collection names for readability."""
-            nonlocal issue_found
-
-            for row in query_result:
-                output = {
-                    'type': type_name,
-                    'check_name': check_name,
-                    'report_columns': {}}
-                column_num = 0
-                for report_column in report_columns:
-                    if str(report_column) == 'coll_id':
-                        coll_name = utils.get_collection_name(
-                            self.connection, str(row[column_num]))
-                        if coll_name is not None:
-                            output['report_columns']['Collection name'] = coll_name
-                    else:
-                        output['report_columns'][str(report_column)] = str(
-                            row[column_num])
-                    column_num = column_num + 1
-
-                self.output_item(output)
-                issue_found = True
-
-            query_result.close()
-            return issue_found
-
         for check_name, check_params in self._get_name_check_data():
-            if self.args.v:
-                self.print_progress(
-                    "Running empty name test for: " + check_name)
-
-            result_empty = self._check_name_empty(
-                check_params['table'],
-                check_params['name'],
-                check_params['report_columns'])
-            _do_output(
-                "empty_name",
-                check_params['report_columns'],
-                result_empty)
-
-            if check_name in ["data object", "collection"]:
-                if self.args.v:
-                    self.print_progress(
-                        "Running trailing slash test for: " + check_name)
-
-                result_trailing_slash = self._check_name_trailing_slash(
-                    check_params['table'],
-                    check_params['name'],
-                    check_params['report_columns'])
-                _do_output(
-                    "trailing_slash",
-                    check_params['report_columns'],
-                    result_trailing_slash)
+            if not self.need_to_run_subcheck(check_name):
+                continue
 
             if self.args.v:
                 self.print_progress(
-                    "Running problematic character name test for: " + check_name)
+                    "Running name tests for: " + check_name)
 
-            result_buggy_characters = self._check_name_buggy_characters(
+            report_columns = check_params['report_columns']
+            checks = self._get_name_checks(check_name, check_params['name'])
+            result = self._check_names(
+                check_name,
                 check_params['table'],
                 check_params['name'],
-                check_params['report_columns'])
-            _do_output(
-                "buggy_characters",
-                check_params['report_columns'],
-                result_buggy_characters)
+                report_columns,
+                checks)
+
+            # Each row is reported once for each check that it fails
+            while True:
+                rows = result.fetchmany(self.resolver.batch_size)
+                if len(rows) == 0:
+                    break
+                self._output_rows(check_name, report_columns,
+                                  [(type_name, row[:len(report_columns)]) for row in rows
+                                   for (type_name, _), failed in zip(checks, row[len(report_columns):]) if failed])
+                issue_found = True
+            result.close()
+
+            self.update_watermark(check_name)
 
         return issue_found
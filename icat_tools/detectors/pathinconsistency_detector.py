@@ -1,55 +1,179 @@
-from icat_tools import utils
 from icat_tools.detectors.detector import Detector
+from icat_tools.scan_engine import get_range_end, RowVisitor
 import pathlib
 
 
+# Regular expression for absolute paths in normal form: no empty components, no "." components and no
+# trailing slash. Paths in this form compare equal as strings if and only if their pathlib parts are equal.
+NORMAL_PATH_PATTERN = '^(/([^/.][^/]*|[.][^/]+))+$'
+
+# Maximum number of collections for which the expected directory is cached
+COLL_PREFIX_CACHE_SIZE = 100000
+
+
+def get_vault_prefix(vault_path):
+    '''Returns the vault path of a resource as pathlib normalizes it, followed by a slash, or None for
+       relative vault paths, which are only compared using pathlib. '''
+    path = pathlib.PurePosixPath(vault_path)
+    if not path.is_absolute():
+        return None
+    return str(path) if str(path).endswith("/") else str(path) + "/"
+
+
+def get_coll_prefix(coll_name):
+    '''Returns the collection name without the zone, as pathlib normalizes it, followed by a slash
+       unless it is empty. '''
+    relative_path = "/".join(pathlib.PurePosixPath(coll_name).parts[2:])
+    return relative_path + "/" if relative_path != "" else ""
+
+
+class PathConsistencyChecker(RowVisitor):
+    '''Processor for the scan engine that checks whether the directory names of replicas
+       on unixfilesystem resources are consistent with their collection names. Replicas on
+       other resources are ignored.
+
+       Physical paths are compared as strings with the expected directory: the normalized vault
+       path of the resource, followed by the collection name without the zone, which is cached for
+       recently seen collections. Only paths that don't match, e.g. because they are not in normal
+       form, are compared using pathlib, so the result is the same as that of a comparison of
+       pathlib paths. '''
+    columns = ('data_name', 'coll_id', 'resc_id', 'data_path', 'data_id')
+
+    def __init__(self, resource_path_lookup, resource_name_lookup, coll_path_lookup):
+        self.resource_path_lookup = resource_path_lookup
+        self.resource_name_lookup = resource_name_lookup
+        self.coll_path_lookup = coll_path_lookup
+        self.vault_prefixes = {resc_id: get_vault_prefix(vault_path)
+                               for resc_id, vault_path in resource_path_lookup.items()}
+        self.coll_prefixes = {}
+
+    def visit(self, rows):
+        vault_prefixes = self.vault_prefixes
+        coll_prefixes = self.coll_prefixes
+        for row in rows:
+            if row[2] not in vault_prefixes:
+                continue
+            vault_prefix = vault_prefixes[row[2]]
+            if vault_prefix is not None:
+                coll_prefix = coll_prefixes.get(row[1])
+                if coll_prefix is None:
+                    if len(coll_prefixes) >= COLL_PREFIX_CACHE_SIZE:
+                        coll_prefixes.clear()
+                    coll_prefix = coll_prefixes[row[1]] = get_coll_prefix(self.coll_path_lookup[row[1]])
+                expected_dirname = vault_prefix + coll_prefix
+                data_path = row[3]
+                # The physical path is consistent if it consists of the expected directory and a file name
+                if (data_path.startswith(expected_dirname) and data_path.find("/", len(expected_dirname)) == -1
+                        and data_path[len(expected_dirname):] not in ("", ".")):
+                    continue
+            finding = self.check_path(row)
+            if finding is not None:
+                yield finding
+
+    def check_path(self, row):
+        '''Compares the physical path of a replica with its collection name using pathlib. Returns
+           a finding if they are inconsistent, otherwise None. '''
+        vaultpath = pathlib.Path(self.resource_path_lookup[row[2]])
+        dirname = pathlib.Path(*pathlib.Path(row[3]).parts[:-1])
+        try:
+            dirname_without_vault = dirname.relative_to(vaultpath)
+        # If the dirname doesn't start with the vault path, there's either
+        # a path inconsistency or a file is on the wrong resource. Either
+        # way, this is an inconsistency so report it
+        except ValueError:
+            return {
+                'resource_name': self.resource_name_lookup[row[2]],
+                'phy_path': row[3],
+                'data_name': "{}/{}".format(self.coll_path_lookup[row[1]], row[0]),
+                'data_id': row[4],
+                'resc_id': row[2]}
+        collname = self.coll_path_lookup[row[1]]
+        collname_parts = pathlib.Path(collname).parts
+        collname_parts_without_zone = list(collname_parts[2:])
+        collname_without_zone = pathlib.Path(*collname_parts_without_zone)
+        if collname_without_zone != dirname_without_vault:
+            return {
+                'resource_name': self.resource_name_lookup[row[2]],
+                'phy_path': row[3],
+                'data_name': "{}/{}".format(collname, row[0]),
+                'data_id': row[4],
+                'resc_id': row[2]}
+        return None
+
+
 class PathInconsistencyDetector(Detector):
     def get_name(self):
         return "path_consistency"
 
+    def supports_incremental(self):
+        return True
+
+    def _get_incremental_condition(self):
+        '''Returns a condition that selects replicas that have been modified since the previous run,
+           as well as replicas in collections or on resources that have been modified since then.
+           Renaming a collection also changes the names of its subcollections, so those are
+           checked as well.'''
+        data_condition = self.get_incremental_condition('r_data_main', 'r_data_main')
+        if data_condition is None:
+            return ""
+        coll_condition = self.get_incremental_condition('r_data_main', 'modified_coll')
+        resc_condition = self.get_incremental_condition('r_data_main', 'r_resc_main')
+        return ("AND ( {} OR {} OR r_data_main.coll_id IN ( SELECT r_coll_main.coll_id FROM r_coll_main "
+                + "INNER JOIN r_coll_main AS modified_coll ON {} AND ( r_coll_main.coll_name = modified_coll.coll_name "
+                + "OR r_coll_main.coll_name LIKE concat(modified_coll.coll_name, '/%%') ) ) )").format(
+                    data_condition, resc_condition, coll_condition)
+
+    def _get_checker(self):
+        lookups = self.get_catalog_lookups()
+        return PathConsistencyChecker(
+            lookups.get_resource_vault_paths(),
+            lookups.get_resource_names(),
+            lookups.get_collection_names())
+
+    def get_data_object_visitor(self):
+        # The shared scan reads all data objects, so it doesn't support incremental checks.
+        if self.state is not None:
+            return None
+        return self._get_checker()
+
+    def _get_sql_comparison(self):
+        '''Returns a join and a condition that exclude replicas with a physical path that consists of the
+           expected directory and a file name, so that the database only returns the other replicas. Like
+           the checker, it only compares vault paths and collection names in normal form as strings. The
+           checker compares the paths of the replicas that are returned using pathlib. '''
+        # The prefixes are NULL if the vault path or collection name is not in normal form
+        prefix_joins = ("LEFT JOIN ( SELECT resc_id, resc_def_path || '/' AS vault_prefix FROM r_resc_main "
+                        + "WHERE resc_def_path ~ '{0}' ) AS vault ON vault.resc_id = r_data_main.resc_id "
+                        + "LEFT JOIN ( SELECT coll_id, concat(substring(coll_name from '^/[^/]+/(.+)$') || '/') AS coll_prefix "
+                        + "FROM r_coll_main WHERE coll_name ~ '{0}' ) AS coll ON coll.coll_id = r_data_main.coll_id ").format(
+                            NORMAL_PATH_PATTERN)
+        expected_dirname = "vault.vault_prefix || coll.coll_prefix"
+        file_name = "substr(r_data_main.data_path, length({}) + 1)".format(expected_dirname)
+        consistent = ("left(r_data_main.data_path, length({0})) = {0} "
+                      + "AND strpos({1}, '/') = 0 AND {1} NOT IN ('', '.')").format(expected_dirname, file_name)
+        return prefix_joins, "AND NOT coalesce({}, false) ".format(consistent)
+
     def run(self):
         issue_found = False
-        resource_path_lookup = utils.get_resource_vault_path_dict(
-            self.connection)
-        resource_name_lookup = utils.get_resource_name_dict(self.connection)
-        coll_path_lookup = utils.get_coll_path_dict(self.connection)
+        checker = self._get_checker()
+
+        query_condition, query_params = self.get_prefix_condition()
 
-        if self.args.data_object_prefix is None:
-            query_condition = "WHERE r_resc_main.resc_type_name in ('unixfilesystem', 'unix file system')"
+        if self.args.path_consistency_mode == 'sql':
+            prefix_joins, consistency_condition = self._get_sql_comparison()
         else:
-            query_condition = "WHERE concat ( ( select coll_name from r_coll_main where coll_id = r_data_main.coll_id ), '/', r_data_main.data_name) LIKE '{}%' AND r_resc_main.resc_type_name in ('unixfilesystem', 'unix file system')".format(self.args.data_object_prefix)
-
-        query = ("SELECT r_data_main.data_name, r_data_main.coll_id, r_data_main.resc_id, r_data_main.data_path "
-                 + "FROM r_data_main INNER JOIN r_resc_main ON r_resc_main.resc_id = r_data_main.resc_id "
-                 + query_condition)
-        cursor = self.connection.cursor(self.get_name())
-        cursor.execute(query)
-
-        for row in cursor:
-            vaultpath = pathlib.Path(resource_path_lookup[row[2]])
-            dirname = pathlib.Path(*pathlib.Path(row[3]).parts[:-1])
-            try:
-                dirname_without_vault = dirname.relative_to(vaultpath)
-            # If the dirname doesn't start with the vault path, there's either
-            # a path inconsistency or a file is on the wrong resource. Either
-            # way, this is an inconsistency so report it
-            except ValueError:
-                self.output_item({
-                    'resource_name': resource_name_lookup[row[2]],
-                    'phy_path': row[3],
-                    'data_name': "{}/{}".format(coll_path_lookup[row[1]], row[0])})
-                issue_found = True
-                continue
-            collname = coll_path_lookup[row[1]]
-            collname_parts = pathlib.Path(collname).parts
-            collname_parts_without_zone = list(collname_parts[2:])
-            collname_without_zone = pathlib.Path(*collname_parts_without_zone)
-            if collname_without_zone != dirname_without_vault:
-                self.output_item({
-                    'resource_name': resource_name_lookup[row[2]],
-                    'phy_path': row[3],
-                    'data_name': "{}/{}".format(collname, row[0])})
-                issue_found = True
-
-        cursor.close()
+            prefix_joins, consistency_condition = "", ""
+
+        query = ("SELECT r_data_main.data_name, r_data_main.coll_id, r_data_main.resc_id, r_data_main.data_path, r_data_main.data_id "
+                 + "FROM r_data_main INNER JOIN r_resc_main ON r_resc_main.resc_id = r_data_main.resc_id " + prefix_joins
+                 + "WHERE r_data_main.data_id > %s AND r_data_main.data_id <= %s "
+                 + "AND r_resc_main.resc_type_name in ('unixfilesystem', 'unix file system') "
+                 + consistency_condition + query_condition + " " + self._get_incremental_condition())
+        partitions = self.get_data_id_partitions(query_params)
+
+        for finding in self.scan(query, partitions, checker, get_position=get_range_end):
+            self.output_item(finding)
+            issue_found = True
+
+        self.update_watermark('r_data_main')
         return issue_found
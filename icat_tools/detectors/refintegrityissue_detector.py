@@ -1,128 +1,403 @@
+from icat_tools import utils
 from icat_tools.detectors.detector import Detector
+from icat_tools.id_set import IdSetCache
+from operator import itemgetter
+
+# Referenced columns that the client engine can load into id sets: the integer ids of the main tables
+ID_COLUMNS = [('r_coll_main', 'coll_id'),
+              ('r_data_main', 'data_id'),
+              ('r_user_main', 'user_id'),
+              ('r_resc_main', 'resc_id'),
+              ('r_meta_main', 'meta_id')]
+
+
+def qualify_column(column):
+    '''Qualifies a plain column name with the alias of the checked table. Expressions are
+       returned unchanged.'''
+    return "checked." + column if column.isidentifier() else column
+
+
+def compile_conditions(check_params, query_shape):
+    '''Compiles the definition of a referential integrity check into a list of query conditions
+       and a list of joins, using one of these query shapes:
+
+       - not_exists: NOT EXISTS subqueries, which PostgreSQL can run as anti-joins.
+       - left_join: LEFT JOINs on the referenced tables, with a check that no referenced row was found.
+       - not_in: NOT IN subqueries. PostgreSQL can only run these as hashed subplans if the referenced
+         ids fit in memory, and otherwise rescans the subquery result for every row.
+
+       References with a NULL value are never reported, as with NOT IN. '''
+    conditions = list(check_params.get('filters', []))
+    joins = []
+    for column, ref_table, ref_column in check_params.get('collisions', []):
+        if query_shape == 'not_in':
+            conditions.append("{} IN ( SELECT {} FROM {} )".format(qualify_column(column), ref_column, ref_table))
+        else:
+            conditions.append("EXISTS ( SELECT 1 FROM {} AS ref WHERE ref.{} = {} )".format(
+                ref_table, ref_column, qualify_column(column)))
+    for ref_num, (column, ref_table, ref_column) in enumerate(check_params.get('references', [])):
+        if query_shape == 'not_in':
+            conditions.append("{} NOT IN ( SELECT {} FROM {} )".format(qualify_column(column), ref_column, ref_table))
+        elif query_shape == 'left_join':
+            # Referenced ids are made unique, so that rows of the checked table are not duplicated
+            # if an id is used by multiple rows of the referenced table (e.g. replicas).
+            alias = "ref{:d}".format(ref_num)
+            joins.append("LEFT JOIN ( SELECT DISTINCT {} FROM {} ) AS {} ON {}.{} = {}".format(
+                ref_column, ref_table, alias, alias, ref_column, qualify_column(column)))
+            conditions.append("{} IS NOT NULL AND {}.{} IS NULL".format(qualify_column(column), alias, ref_column))
+        else:
+            conditions.append("{} IS NOT NULL AND NOT EXISTS ( SELECT 1 FROM {} AS ref WHERE ref.{} = {} )".format(
+                qualify_column(column), ref_table, ref_column, qualify_column(column)))
+    return conditions, joins
+
+
+def can_run_on_client(check_params):
+    '''Returns True if the client engine can run a referential integrity check, i.e. if it only compares
+       plain columns with ids in ID_COLUMNS. '''
+    columns = check_params.get('references', []) + check_params.get('collisions', [])
+    return (len(check_params.get('filters', [])) == 0
+            and all(column.isidentifier() and (ref_table, ref_column) in ID_COLUMNS
+                    for column, ref_table, ref_column in columns))
+
+
+def get_failing_values(rows, conditions, distinct_values):
+    '''Returns the values of each column of a batch of rows for which the conditions of a client check
+       fail: values that are not in the id set of a reference, or that are in the id set of a collision.
+       Rows fail the check if each of these columns has a failing value. The distinct values of each
+       column are kept in distinct_values, so that they are only collected once per batch. NULL values
+       never fail, as with the queries of the database engine. '''
+    failing_values = {}
+    for column_num, id_set, reference in conditions:
+        if column_num not in distinct_values:
+            distinct_values[column_num] = set(map(itemgetter(column_num), rows))
+            distinct_values[column_num].discard(None)
+        values = failing_values.get(column_num, distinct_values[column_num])
+        failing_values[column_num] = id_set.difference(values) if reference else id_set.intersection(values)
+    return failing_values
 
 
 class RefIntegrityIssueDetector(Detector):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.id_set_cache = IdSetCache()
+        self.id_sets_snapshot = None
+
     def get_name(self):
         return "ref_integrity"
 
     def _get_ref_integrity_data(self):
+        '''Returns the definitions of the referential integrity checks. Each check selects rows of a
+           table that match its filters and either refer to a row that does not exist in any of the
+           referenced tables (references), or have the same id as a row in another table (collisions).
+           References and collisions are (column, referenced table, referenced column) tuples.
+           Columns can also be SQL expressions, in which the checked table is called "checked".'''
         data = {
             'collection and data object have same id': {
                 'table': 'r_coll_main',
                 'report_columns': ['coll_id'],
-                'conditions': ['coll_id IN ( SELECT data_id FROM r_data_main)']},
+                'collisions': [('coll_id', 'r_data_main', 'data_id')]},
             'parent of collection does not exist': {
                 'table': 'r_coll_main',
                 'report_columns': ['coll_name'],
-                'conditions': ['parent_coll_name NOT IN ( SELECT coll_name from r_coll_main)']},
+                'references': [('parent_coll_name', 'r_coll_main', 'coll_name')]},
             'collection of data object does not exist': {
                 'table': 'r_data_main',
                 'report_columns': [
                     'coll_id',
                     'data_id',
                     'data_name'],
-                'conditions': ['coll_id NOT IN ( SELECT coll_id from r_coll_main)']},
+                'references': [('coll_id', 'r_coll_main', 'coll_id')]},
             'resource of data object does not exist': {
                 'table': 'r_data_main',
                 'report_columns': [
                     'coll_id',
                     'data_id',
                     'data_name'],
-                'conditions': ['resc_id NOT IN ( SELECT resc_id from r_resc_main)']},
+                'references': [('resc_id', 'r_resc_main', 'resc_id')]},
             'object of object access does not exist': {
                 'table': 'r_objt_access',
                 'report_columns': [
                     'object_id',
                     'user_id'],
-                'conditions': [
-                    'object_id not in ( SELECT coll_id from r_coll_main)',
-                    'object_id not in (SELECT data_id from r_data_main)']},
+                'references': [
+                    ('object_id', 'r_coll_main', 'coll_id'),
+                    ('object_id', 'r_data_main', 'data_id')]},
             'user of object access does not exist': {
                 'table': 'r_objt_access',
                 'report_columns': [
                     'object_id',
                     'user_id'],
-                'conditions': ['user_id not in ( SELECT user_id from r_user_main)']},
+                'references': [('user_id', 'r_user_main', 'user_id')]},
             'metamap refers no nonexistent object': {
                 'table': 'r_objt_metamap',
                 'report_columns': [
                     'object_id',
                     'meta_id'],
-                'conditions': [
-                    'object_id not in ( SELECT coll_id from r_coll_main)',
-                    'object_id not in (SELECT data_id from r_data_main)',
-                    'object_id not in (SELECT user_id from r_user_main)',
-                    'object_id not in (SELECT resc_id from r_resc_main)']},
+                'references': [
+                    ('object_id', 'r_coll_main', 'coll_id'),
+                    ('object_id', 'r_data_main', 'data_id'),
+                    ('object_id', 'r_user_main', 'user_id'),
+                    ('object_id', 'r_resc_main', 'resc_id')]},
             'metamap refers to nonexistent metadata entry': {
                 'table': 'r_objt_metamap',
                 'report_columns': [
                     'object_id',
                     'meta_id'],
-                'conditions': ['meta_id not in (select meta_id from r_meta_main)']},
+                'references': [('meta_id', 'r_meta_main', 'meta_id')]},
             'main quota table refers to nonexistent user': {
                 'table': 'r_quota_main',
                 'report_columns': [
                     'user_id',
                     'resc_id'],
-                'conditions': ['user_id not in (SELECT user_id from r_user_main)']},
+                'references': [('user_id', 'r_user_main', 'user_id')]},
             'main quota table refers to nonexistent resource': {
                 'table': 'r_quota_main',
                 'report_columns': [
                     'user_id',
                     'resc_id'],
-                'conditions': ['resc_id not in (SELECT resc_id from r_resc_main)']},
+                'references': [('resc_id', 'r_resc_main', 'resc_id')]},
             'quota usage table refers to nonexistent user': {
                 'table': 'r_quota_usage',
                 'report_columns': [
                     'user_id',
                     'resc_id'],
-                'conditions': ['user_id not in (SELECT user_id from r_user_main)']},
+                'references': [('user_id', 'r_user_main', 'user_id')]},
             'quota usage table refers to nonexistent resource': {
                 'table': 'r_quota_usage',
                 'report_columns': [
                     'user_id',
                     'resc_id'],
-                'conditions': ['resc_id not in (SELECT resc_id from r_resc_main)']},
+                'references': [('resc_id', 'r_resc_main', 'resc_id')]},
             'resource refers to nonexistent parent resource': {
                 'table': 'r_resc_main',
                 'report_columns': ['resc_name'],
-                'conditions': [
-                    '( resc_parent = \'\' ) IS FALSE',
-                    'CAST(resc_parent AS bigint) not in (SELECT resc_id from r_resc_main)']},
+                'filters': ['( checked.resc_parent = \'\' ) IS FALSE'],
+                'references': [('CAST(checked.resc_parent AS bigint)', 'r_resc_main', 'resc_id')]},
             'user refers to nonexistent zone name': {
                 'table': 'r_user_main',
                 'report_columns': [
                     'user_id',
                     'zone_name'],
-                'conditions': ['zone_name not in (select zone_name from r_zone_main)']},
+                'references': [('zone_name', 'r_zone_main', 'zone_name')]},
             'user password table refers to nonexistent user': {
                 'table': 'r_user_password',
                 'report_columns': ['user_id'],
-                'conditions': ['user_id not in (select user_id from r_user_main)']}}
+                'references': [('user_id', 'r_user_main', 'user_id')]}}
 
         return data.items()
 
-    def _check_ref_integrity(self, table, report_columns, conditions):
-        query = "SELECT {} FROM {} WHERE {}".format(
-                ",".join(report_columns),
+    def _check_ref_integrity(self, table, report_columns, conditions, joins=(), check_name=None):
+        query = "SELECT {} FROM {} AS checked {} WHERE {}".format(
+                ",".join(qualify_column(column) for column in report_columns),
                 table,
+                " ".join(joins),
                 " AND ".join(conditions))
-        cursor = self.connection.cursor()
+        cursor = self.get_cursor(check_name=check_name)
         cursor.execute(query)
         return cursor
 
+    def _check_ref_integrity_merged(self, table, checks):
+        '''Runs a number of checks of the same table in a single pass. Each row of the result has
+           the union of the report columns of the checks, followed by a boolean for each check that
+           indicates whether the row violates it.'''
+        columns = []
+        for _, check_params in checks:
+            columns.extend(column for column in check_params['report_columns'] if column not in columns)
+        violations = ["( {} )".format(" AND ".join(compile_conditions(check_params, 'not_exists')[0]))
+                      for _, check_params in checks]
+        query = "SELECT {}, {} FROM {} AS checked WHERE {}".format(
+            ",".join(qualify_column(column) for column in columns),
+            ",".join(violations),
+            table,
+            " OR ".join(violations))
+        cursor = self.get_cursor(check_name=table)
+        cursor.execute(query)
+        return columns, cursor
+
     def need_to_run_check(self, name: str) -> bool:
         return (self.args.ref_integrity_check == "all"
                 or name in self.args.ref_integrity_check.split(","))
 
-    def run(self):
-        issue_found = False
+    def _get_checks_by_table(self):
+        '''Returns a dictionary with the checks that need to be run for each table. '''
+        result = {}
+        for check_name, check_params in self._get_ref_integrity_data():
+            if self.need_to_run_check(check_name):
+                result.setdefault(check_params['table'], []).append((check_name, check_params))
+        return result
+
+    def get_subchecks(self):
+        if self.args.ref_integrity_merge or self.args.ref_integrity_engine == 'client':
+            return list(self._get_checks_by_table())
+        return [check_name for check_name, _ in self._get_ref_integrity_data()
+                if self.need_to_run_check(check_name)]
 
+    def print_option_warnings(self):
+        super().print_option_warnings()
         if self.args.data_object_prefix:
             self.print_error(
                 "The referential integrity checks do not yet support the --data-object-prefix option.")
             self.print_error("Ignoring this option for these tests.")
+
+    def _output_row(self, check_name, report_columns, row):
+        output = {'check_name': check_name, 'report_columns': {}}
+        column_num = 0
+        for report_column in report_columns:
+            output['report_columns'][str(report_column)] = str(
+                row[column_num])
+            column_num = column_num + 1
+        self.output_item(output)
+
+    def _print_skipped_checks(self):
+        if self.args.v and self.subcheck is None:
+            for check_name, _ in self._get_ref_integrity_data():
+                if not self.need_to_run_check(check_name):
+                    self.print_progress("Skipping referential integrity check for: " + check_name)
+
+    def _run_merged_checks(self, table, checks):
+        if self.args.v:
+            self.print_progress(
+                "Running referential integrity checks for table {}: {}".format(
+                    table, ", ".join(check_name for check_name, _ in checks)))
+
+        issue_found = False
+        columns, result = self._check_ref_integrity_merged(table, checks)
+        for row in result:
+            for check_num, (check_name, check_params) in enumerate(checks):
+                if row[len(columns) + check_num]:
+                    self._output_row(check_name, check_params['report_columns'],
+                                     [row[columns.index(column)] for column in check_params['report_columns']])
+                    issue_found = True
+
+        result.close()
+        return issue_found
+
+    def _run_merged(self):
+        issue_found = False
+        self._print_skipped_checks()
+
+        for table, checks in self._get_checks_by_table().items():
+            if not self.need_to_run_subcheck(table):
+                continue
+
+            issue_found = self._run_merged_checks(table, checks) or issue_found
+
+        return issue_found
+
+    def share_run_state(self, detector):
+        # The units of parallel runs share a snapshot, so they can share the id sets
+        self.id_set_cache = detector.id_set_cache
+
+    def _get_id_set(self, table, column):
+        '''Returns the set of ids in a column of a table. Id sets are kept for as long as the connection
+           sees the same snapshot, so that each set is only loaded once per run. '''
+        def on_load():
+            if self.args.v:
+                self.print_progress("Loading ids of {}.{}".format(table, column))
+        return self.id_set_cache.get(self.connection, self.id_sets_snapshot, table, column,
+                                     self.scan_engine.itersize, on_load)
+
+    def _run_client_checks(self, table, checks):
+        '''Runs checks of a table in the script: the table is read once, and the references and
+           collisions of each row are looked up in the id sets of the referenced tables. '''
+        if self.args.v:
+            self.print_progress(
+                "Running referential integrity checks for table {} in the script: {}".format(
+                    table, ", ".join(check_name for check_name, _ in checks)))
+
+        columns = []
+        for _, check_params in checks:
+            columns.extend(column for column in check_params['report_columns'] if column not in columns)
+            columns.extend(column for column, _, _ in check_params.get('references', []) + check_params.get('collisions', [])
+                           if column not in columns)
+        # Each check as its name, report columns, and the column number, id set and type (True for references,
+        # False for collisions) of each condition
+        compiled_checks = [(check_name,
+                            check_params['report_columns'],
+                            [columns.index(column) for column in check_params['report_columns']],
+                            [(columns.index(column), self._get_id_set(ref_table, ref_column), True)
+                             for column, ref_table, ref_column in check_params.get('references', [])]
+                            + [(columns.index(column), self._get_id_set(ref_table, ref_column), False)
+                               for column, ref_table, ref_column in check_params.get('collisions', [])])
+                           for check_name, check_params in checks]
+
+        issue_found = False
+        cursor = self.get_cursor('ref_integrity_client', check_name=table)
+        cursor.execute("SELECT {} FROM {} AS checked".format(
+            ",".join(qualify_column(column) for column in columns), table))
+        for rows in iter(lambda: cursor.fetchmany(self.scan_engine.itersize), []):
+            distinct_values = {}
+            for check_name, report_columns, report_column_nums, conditions in compiled_checks:
+                failing_values = get_failing_values(rows, conditions, distinct_values)
+                # Rows are only examined one by one if the batch has rows that fail the check
+                if all(len(values) > 0 for values in failing_values.values()):
+                    for row in rows:
+                        if all(row[column_num] in values for column_num, values in failing_values.items()):
+                            self._output_row(check_name, report_columns,
+                                             [row[column_num] for column_num in report_column_nums])
+                            issue_found = True
+
+        cursor.close()
+        return issue_found
+
+    def _run_client(self):
+        '''Runs the checks using the client engine. Checks that it cannot run are run by the database,
+           merged if the --ref-integrity-merge option is used. '''
+        # The id sets and the checked tables need to be read in the same snapshot, so that rows that
+        # refer to objects created in between are not reported
+        utils.begin_repeatable_read(self.connection)
+        self.id_sets_snapshot = utils.get_snapshot(self.connection)
+
+        issue_found = False
+        self._print_skipped_checks()
+
+        for table, checks in self._get_checks_by_table().items():
+            if not self.need_to_run_subcheck(table):
+                continue
+
+            client_checks = [check for check in checks if can_run_on_client(check[1])]
+            database_checks = [check for check in checks if not can_run_on_client(check[1])]
+            if len(client_checks) > 0:
+                issue_found = self._run_client_checks(table, client_checks) or issue_found
+            if len(database_checks) > 0 and self.args.ref_integrity_merge:
+                issue_found = self._run_merged_checks(table, database_checks) or issue_found
+            else:
+                for check_name, check_params in database_checks:
+                    if self.args.v:
+                        self.print_progress("Running referential integrity check for: " + check_name)
+                    issue_found = self._run_check(check_name, check_params) or issue_found
+
+        return issue_found
+
+    def _run_check(self, check_name, check_params):
+        conditions, joins = compile_conditions(check_params, self.args.ref_integrity_query)
+        result = self._check_ref_integrity(
+            check_params['table'],
+            check_params['report_columns'],
+            conditions,
+            joins,
+            check_name)
+
+        issue_found = False
+        for row in result:
+            self._output_row(check_name, check_params['report_columns'], row)
+            issue_found = True
+
+        result.close()
+        return issue_found
+
+    def run(self):
+        if self.args.ref_integrity_engine == 'client':
+            return self._run_client()
+        if self.args.ref_integrity_merge:
+            return self._run_merged()
+
+        issue_found = False
+
         for check_name, check_params in self._get_ref_integrity_data():
+            if not self.need_to_run_subcheck(check_name):
+                continue
+
             need_to_run_check: bool = self.need_to_run_check(check_name)
             if self.args.v:
                 self.print_progress(
@@ -132,21 +407,6 @@ class RefIntegrityIssueDetector(Detector):
             if not need_to_run_check:
                 continue
 
-            result = self._check_ref_integrity(
-                check_params['table'],
-                check_params['report_columns'],
-                check_params['conditions'])
-
-            for row in result:
-                output = {'check_name': check_name, 'report_columns': {}}
-                column_num = 0
-                for report_column in check_params['report_columns']:
-                    output['report_columns'][str(report_column)] = str(
-                        row[column_num])
-                    column_num = column_num + 1
-                self.output_item(output)
-                issue_found = True
-
-            result.close()
+            issue_found = self._run_check(check_name, check_params) or issue_found
 
         return issue_found
@@ -1,7 +1,28 @@
 from icat_tools.detectors.detector import Detector
+from icat_tools.scan_engine import RowVisitor
 import time
 
 
+class TimestampChecker(RowVisitor):
+    '''Row visitor that performs the timestamp checks for data objects in a shared scan, and yields
+       (type, row) tuples for data objects with timestamps that are out of order or in the future. '''
+    columns = ('coll_id', 'data_name', 'create_ts', 'modify_ts')
+
+    def __init__(self, max_ts):
+        self.max_ts = max_ts
+
+    def visit(self, rows):
+        for row in rows:
+            if row[2] is None or row[3] is None:
+                continue
+            create_ts = int(row[2])
+            modify_ts = int(row[3])
+            if create_ts > modify_ts:
+                yield 'order', row
+            if create_ts > self.max_ts or modify_ts > self.max_ts:
+                yield 'future', row
+
+
 class TimestampIssueDetector(Detector):
 
     def get_name(self):
@@ -33,74 +54,95 @@ class TimestampIssueDetector(Detector):
         }
         return data.items()
 
-    def _get_prefix_condition(self, table):
-        if table == 'r_data_main' and self.args.data_object_prefix is not None:
-            return "AND concat ( ( select coll_name from r_coll_main where coll_id = r_data_main.coll_id ), '/', r_data_main.data_name) LIKE '{}%'".format(
-                self.args.data_object_prefix)
-        else:
+    def get_subchecks(self):
+        return [check_name for check_name, _ in self._get_ts_check_data()]
+
+    def supports_incremental(self):
+        return True
+
+    def _get_incremental_condition(self, check_name, table, first_ts, second_ts):
+        # Rows with incorrect timestamps may have an old modification timestamp, so
+        # rows with a recent value in either column are checked.
+        first_condition = self.get_incremental_condition(check_name, table, first_ts)
+        second_condition = self.get_incremental_condition(check_name, table, second_ts)
+        if first_condition is None:
             return ""
+        else:
+            return "AND ( {} OR {} )".format(first_condition, second_condition)
 
-    def _check_timestamp_order(self, table, report_columns,
-                               first_ts='create_ts', second_ts='modify_ts'):
-        query = "SELECT {} FROM {} WHERE CAST ( {} AS INT ) > CAST ( {} AS INT ) {}".format(
-            ",".join(report_columns), table, first_ts, second_ts, self._get_prefix_condition(table))
-        cursor = self.connection.cursor()
-        cursor.execute(query)
-        return cursor
+    def _get_timestamp_checks(self, max_ts, first_ts='create_ts', second_ts='modify_ts'):
+        '''Returns the type and query condition of each timestamp check. '''
+        return [('order', "CAST ( {} AS INT ) > CAST ( {} AS INT )".format(first_ts, second_ts)),
+                ('future', "CAST( {} AS INT) > {} OR CAST( {} AS INT) > {}".format(first_ts, max_ts, second_ts, max_ts))]
 
-    def _check_timestamp_future(self, table, report_columns, max_ts,
-                                first_ts='create_ts', second_ts='modify_ts'):
-        query = "SELECT {} FROM {} WHERE CAST( {} AS INT) > {} OR CAST( {} AS INT) > {} {}".format(
-            ",".join(report_columns), table, first_ts, max_ts, second_ts, max_ts, self._get_prefix_condition(table))
-        cursor = self.connection.cursor()
-        cursor.execute(query)
+    def _check_timestamps(self, check_name, table, report_columns, checks,
+                          first_ts='create_ts', second_ts='modify_ts'):
+        '''Runs all timestamp checks for a table in a single query. It returns the rows that fail at least
+           one check, with a column for each check that tells whether the row fails it. '''
+        prefix_condition, prefix_params = self.get_prefix_condition(table)
+        query = "SELECT {}, {} FROM {} WHERE ( {} ) {} {}".format(
+            ",".join(report_columns),
+            ", ".join("( {} ) AS {}".format(condition, type_name) for type_name, condition in checks),
+            table,
+            " OR ".join("( {} )".format(condition) for _, condition in checks),
+            prefix_condition,
+            self._get_incremental_condition(check_name, table, first_ts, second_ts))
+        cursor = self.get_cursor(check_name=check_name)
+        cursor.execute(query, prefix_params)
         return cursor
 
+    def _output_rows(self, check_name, report_columns, typed_rows):
+        """Feeds (type, row) tuples with the results of a check to the output processor."""
+        for type_name, row in typed_rows:
+            output = {
+                'type': type_name,
+                'check_name': check_name,
+                'report_columns': {}}
+            column_num = 0
+            for report_column in report_columns:
+                output['report_columns'][str(report_column)] = str(
+                    row[column_num])
+                column_num = column_num + 1
+            self.output_item(output)
+
+    def get_data_object_visitor(self):
+        if self.state is not None:
+            return None
+        return TimestampChecker(int(time.time()) + 1)
+
+    def get_data_object_subcheck(self):
+        return 'data object'
+
+    def output_visitor_results(self, results):
+        check_data = dict(self._get_ts_check_data())
+        self._output_rows('data object', check_data['data object']['report_columns'], results)
+        return len(results) > 0
+
     def run(self):
         issue_found = False
-        max_ts = int(time.time()) + 1
+        checks = self._get_timestamp_checks(int(time.time()) + 1)
         for check_name, check_params in self._get_ts_check_data():
-            if self.args.v:
-                self.print_progress(
-                    "Running timestamp order test for: " + check_name)
-
-            result_order = self._check_timestamp_order(
-                check_params['table'],
-                check_params['report_columns'])
-            for row in result_order:
-                output = {
-                    'type': 'order',
-                    'check_name': check_name,
-                    'report_columns': {}}
-                column_num = 0
-                for report_column in check_params['report_columns']:
-                    output['report_columns'][str(report_column)] = str(
-                        row[column_num])
-                    column_num = column_num + 1
-                self.output_item(output)
-                issue_found = True
-            result_order.close()
+            if not self.need_to_run_subcheck(check_name):
+                continue
 
             if self.args.v:
                 self.print_progress(
-                    "Running future timestamp test for: " + check_name)
+                    "Running timestamp tests for: " + check_name)
 
-            result_future = self._check_timestamp_future(
+            report_columns = check_params['report_columns']
+            result = self._check_timestamps(
+                check_name,
                 check_params['table'],
-                check_params['report_columns'],
-                max_ts)
-            for row in result_future:
-                output = {
-                    'type': 'future',
-                    'check_name': check_name,
-                    'report_columns': {}}
-                column_num = 0
-                for report_column in check_params['report_columns']:
-                    output['report_columns'][str(report_column)] = str(
-                        row[column_num])
-                    column_num = column_num + 1
-                self.output_item(output)
+                report_columns,
+                checks)
+            # Each row is reported once for each check that it fails
+            for row in result:
+                self._output_rows(check_name, report_columns,
+                                  [(type_name, row[:len(report_columns)])
+                                   for (type_name, _), failed in zip(checks, row[len(report_columns):]) if failed])
                 issue_found = True
-            result_future.close()
+            result.close()
+
+            self.update_watermark(check_name)
 
         return issue_found
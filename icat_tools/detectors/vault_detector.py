@@ -0,0 +1,178 @@
+from icat_tools import utils
+from icat_tools.detectors.detector import Detector
+from icat_tools.vault_listing import VaultListing
+import os
+import socket
+
+# Replica status of replicas that are up to date, which should have a file of the same size
+GOOD_REPLICA = 1
+
+# Files and replicas modified up to this number of seconds before the replicas are read are not reported
+# as orphan files or missing files, or compared either, since iRODS registers a replica after its file has
+# been written, and the clocks of the database and the vault host can differ
+MTIME_MARGIN = 300
+
+
+def reconcile(files, replicas, max_mtime=None):
+    '''Merges a listing of the files in a vault with a stream of (data_path, data_id, data_size,
+       replica status, modification time) rows of the replicas in it, both in byte order of their
+       paths. Yields (type, path, data_id, data_size, file_size) tuples for:
+
+       - good replicas without a file (missing_file),
+       - files without a replica (orphan_file), and
+       - good replicas whose size does not match the size of their file (size_mismatch).
+
+       Replicas that are not good, such as stale replicas and replicas that are being written, are
+       not checked. Files modified after max_mtime, which may belong to replicas created or changed
+       after the replicas were read, are neither reported as orphan files nor compared; replicas
+       modified after max_mtime are not reported as missing files. A replica without a modification
+       time is checked. Directories that could
+       not be read are yielded as (unreadable_directory, path, None, None, error) tuples; the replicas
+       in them are not checked. Raises ValueError if the replicas are not in byte order.'''
+    files = iter(files)
+    file = next(files, None)
+    # Path of the last file that has been matched with a replica, which can have multiple replicas
+    matched = None
+    unreadable = None
+    previous_path = None
+
+    def get_file_issue(file):
+        path, size, mtime, error = file
+        if error is not None:
+            return 'unreadable_directory', path[:-1], None, None, error
+        if path != matched and (max_mtime is None or mtime <= max_mtime):
+            return 'orphan_file', path, None, None, size
+        return None
+
+    for data_path, data_id, data_size, replica_status, modify_time in replicas:
+        path = os.fsencode(data_path)
+        if previous_path is not None and path < previous_path:
+            raise ValueError("Replica paths are not in byte order: {} follows {}".format(data_path, previous_path))
+        previous_path = path
+
+        # Files that sort before the replica have no replica
+        while file is not None and file[0] < path:
+            issue = get_file_issue(file)
+            if issue is not None:
+                yield issue
+            if file[3] is not None:
+                unreadable = file[0]
+            file = next(files, None)
+
+        if unreadable is not None and path.startswith(unreadable):
+            continue
+        if file is None or file[0] != path:
+            if (replica_status == GOOD_REPLICA
+                    and (max_mtime is None or modify_time is None or modify_time <= max_mtime)):
+                yield 'missing_file', path, data_id, data_size, None
+            continue
+        matched = path
+        if (replica_status == GOOD_REPLICA and data_size is not None and data_size != file[1]
+                and (max_mtime is None or file[2] <= max_mtime)):
+            yield 'size_mismatch', path, data_id, data_size, file[1]
+
+    while file is not None:
+        issue = get_file_issue(file)
+        if issue is not None:
+            yield issue
+        file = next(files, None)
+
+
+class VaultDetector(Detector):
+    def get_name(self):
+        return "vault"
+
+    def included_in_all(self):
+        return False
+
+    def print_option_warnings(self):
+        super().print_option_warnings()
+        if self.args.data_object_prefix:
+            self.print_error(
+                "The vault test does not support the --data-object-prefix option.")
+            self.print_error(
+                "Ignoring the --data-object-prefix option for this test.")
+
+    def _get_vault_resources(self, lookups):
+        '''Returns the ids and vault paths of the unixfilesystem resources on this host. '''
+        if self.args.vault_host is not None:
+            hosts = [self.args.vault_host]
+        else:
+            hosts = [socket.gethostname(), socket.getfqdn()]
+        resource_hosts = utils.get_resource_host_dict(self.connection)
+        return sorted((resc_id, vault_path) for resc_id, vault_path in lookups.get_resource_vault_paths().items()
+                      if resource_hosts.get(resc_id) in hosts)
+
+    def _get_replicas(self, resc_id, vault_path):
+        '''Yields the replicas of a resource in its vault, in byte order of their paths. '''
+        cursor = self.get_cursor('vault_replicas')
+        cursor.execute("SELECT data_path, data_id, data_size, data_is_dirty, modify_ts FROM r_data_main "
+                       + "WHERE resc_id = %s AND data_path LIKE %s ORDER BY data_path COLLATE \"C\", data_id",
+                       (resc_id, utils.escape_like_pattern(vault_path.rstrip("/") + "/") + "%"))
+        for rows in iter(lambda: cursor.fetchmany(self.scan_engine.itersize), []):
+            for data_path, data_id, data_size, replica_status, modify_ts in rows:
+                # Timestamps that are not a number are reported by the timestamps test
+                modify_time = int(modify_ts) if modify_ts is not None and modify_ts.strip().isdigit() else None
+                yield data_path, data_id, data_size, replica_status, modify_time
+        cursor.close()
+
+    def _output_issues(self, issues, resc_id, resource_name):
+        object_names = self.resolver.resolve_dataobjects(
+            [data_id for _, _, data_id, _, _ in issues if data_id is not None])
+        for issue_type, path, data_id, data_size, file_size in issues:
+            self.output_item(
+                {'type': issue_type,
+                 'resc_id': resc_id,
+                 'resource_name': resource_name,
+                 'phy_path': os.fsdecode(path),
+                 'data_id': data_id,
+                 'object_name': object_names.get(data_id) if data_id is not None else None,
+                 'data_size': data_size,
+                 'file_size': file_size})
+
+    def _check_vault(self, resc_id, vault_path, resource_name, max_mtime):
+        if self.args.v:
+            self.print_progress("Checking vault {} of resource {}".format(vault_path, resource_name))
+        if not os.path.isdir(vault_path):
+            self.print_error("Vault {} of resource {} not found. Skipping this resource.".format(
+                vault_path, resource_name))
+            return False
+
+        issue_found = False
+        issues = []
+        files = VaultListing(vault_path, self.args.vault_jobs)
+        try:
+            for issue in reconcile(files, self._get_replicas(resc_id, vault_path), max_mtime):
+                if issue[0] == 'unreadable_directory':
+                    self.print_error("Cannot read directory {}: {}. Replicas in this directory have not been checked.".format(
+                        os.fsdecode(issue[1]), issue[4]))
+                    continue
+                issues.append(issue)
+                issue_found = True
+                if len(issues) >= self.resolver.batch_size:
+                    self._output_issues(issues, resc_id, resource_name)
+                    issues = []
+        except ValueError as error:
+            # The collation of the database does not order paths by their bytes, e.g. because of its encoding
+            self.exit_error("Error: cannot compare the vault of resource {} with the catalog: {}".format(
+                resource_name, error))
+        self._output_issues(issues, resc_id, resource_name)
+        return issue_found
+
+    def run(self):
+        issue_found = False
+        lookups = self.get_catalog_lookups()
+        resource_names = lookups.get_resource_names()
+        resources = self._get_vault_resources(lookups)
+        if self.args.v and len(resources) == 0:
+            self.print_progress("No unixfilesystem resources found on this host.")
+
+        # Files that have been modified since the replicas are read may belong to replicas that are not
+        # visible yet, and replicas that have been modified recently may not have a file yet, so they are
+        # not reported
+        max_mtime = utils.get_database_time(self.connection) - MTIME_MARGIN
+        for resc_id, vault_path in resources:
+            if self._check_vault(resc_id, vault_path, resource_names[resc_id], max_mtime):
+                issue_found = True
+
+        return issue_found
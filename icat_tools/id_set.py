@@ -0,0 +1,103 @@
+from array import array
+import bisect
+from itertools import repeat
+import threading
+
+
+class IdSet(object):
+    '''Compact set of integer ids, such as the ids of all collections of a catalog, for membership
+       tests in the script.
+
+       The ids are kept in a sorted array of 64-bit integers, which takes 8 bytes per id and is searched
+       using binary search. iRODS assigns the ids of all kinds of objects from a single sequence, so the
+       ids of a table often cover a large part of their range. If a bitmap of the range takes less memory
+       than the array, the ids are kept in a bitmap instead, which is searched in constant time.'''
+
+    def __init__(self, ids):
+        '''Creates a set from an array of unique ids in ascending order. '''
+        self.length = len(ids)
+        self.ids = None
+        self.bitmap = None
+        self.offset = 0
+        if len(ids) > 0 and (ids[-1] - ids[0]) // 8 + 1 < len(ids) * ids.itemsize:
+            self.offset = ids[0]
+            self.bitmap = bytearray((ids[-1] - ids[0]) // 8 + 1)
+            for id in ids:
+                position = id - self.offset
+                self.bitmap[position >> 3] |= 1 << (position & 7)
+        else:
+            self.ids = ids
+
+    @classmethod
+    def from_database(cls, connection, table, column, batch_size=10000):
+        '''Reads the distinct values of an id column of a table from the database. The database sorts
+           the ids, which it can usually do using an index. '''
+        cursor = connection.cursor('get_id_set')
+        cursor.execute("SELECT DISTINCT {0} FROM {1} WHERE {0} IS NOT NULL ORDER BY {0}".format(column, table))
+        ids = array('q')
+        for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+            ids.extend(row[0] for row in rows)
+        cursor.close()
+        return cls(ids)
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, id):
+        return len(self.intersection([id])) > 0
+
+    def intersection(self, values):
+        '''Returns the values that are in the set, as a set. The lookups are done in a single expression,
+           which is much faster than testing the values one at a time using the in operator. '''
+        if self.bitmap is not None:
+            bitmap, offset, size = self.bitmap, self.offset, len(self.bitmap) * 8
+            return {value for value in values
+                    if 0 <= value - offset < size and bitmap[(value - offset) >> 3] >> ((value - offset) & 7) & 1}
+        ids, length = self.ids, len(self.ids)
+        return {value for value, index in zip(values, map(bisect.bisect_left, repeat(ids), values))
+                if index < length and ids[index] == value}
+
+    def difference(self, values):
+        '''Returns the values that are not in the set, as a set. '''
+        return set(values) - self.intersection(values)
+
+    def get_size(self):
+        '''Returns the number of bytes used by the ids. '''
+        return len(self.bitmap) if self.bitmap is not None else len(self.ids) * self.ids.itemsize
+
+
+class IdSetCache(object):
+    '''Id sets of the id columns of tables, each read from the database once per snapshot. The cache can
+       be shared by detectors that run in threads on connections that have imported the same snapshot, so
+       that the sets are loaded and kept in memory only once. A set is loaded by the first thread that
+       needs it; other threads that need it wait until it has been loaded.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.id_sets = {}
+        self.loading_locks = {}
+
+    def get(self, connection, snapshot, table, column, batch_size=10000, on_load=None):
+        '''Returns the id set of a column of a table. The connection needs to be in a REPEATABLE READ
+           transaction with the given snapshot (see utils.get_snapshot); sets of other snapshots are
+           discarded. on_load is called before a set is read from the database. '''
+        key = (table, column)
+        with self.lock:
+            if snapshot != self.snapshot:
+                self.snapshot = snapshot
+                self.id_sets = {}
+                self.loading_locks = {}
+            loading_lock = self.loading_locks.setdefault(key, threading.Lock())
+        with loading_lock:
+            with self.lock:
+                id_set = self.id_sets.get(key) if snapshot == self.snapshot else None
+            if id_set is not None:
+                return id_set
+            if on_load is not None:
+                on_load()
+            id_set = IdSet.from_database(connection, table, column, batch_size)
+            with self.lock:
+                if snapshot == self.snapshot:
+                    self.id_sets[key] = id_set
+            return id_set
@@ -0,0 +1,218 @@
+from icat_tools import utils
+from icat_tools.coll_path_store import CollectionPathStore
+import hashlib
+import json
+import os
+import tempfile
+
+# Version of the format of the cache files. Caches in other formats are rebuilt.
+CACHE_VERSION = 1
+
+# Collections modified up to this number of seconds before the newest modification seen by the previous
+# refresh are read again, so that modifications that were committed out of order are not missed
+REFRESH_MARGIN = 300
+
+# The cached collection names are rebuilt from the database when the number of collections that have been
+# modified since the cache was built exceeds this fraction of the number of collections
+MAX_MODIFIED_FRACTION = 0.1
+
+
+def get_database_identity(connection):
+    '''Returns a string that identifies the database of the connection: the address of the server, the
+       name of the database and, if the user may read it, the system identifier of the database cluster. '''
+    params = connection.get_dsn_parameters()
+    identity = "{}:{}/{}".format(params.get('host'), params.get('port'), params.get('dbname'))
+    cursor = connection.cursor()
+    cursor.execute("SELECT has_function_privilege('pg_control_system()', 'execute')")
+    if cursor.fetchone()[0]:
+        cursor.execute("SELECT system_identifier FROM pg_control_system()")
+        identity += "#{}".format(cursor.fetchone()[0])
+    cursor.close()
+    return identity
+
+
+def format_timestamp(timestamp):
+    # Timestamps are stored as zero-padded strings, so they can be compared as strings
+    return "{:011d}".format(max(0, timestamp))
+
+
+class ModifiedCollectionNames(object):
+    '''Collection names from a cached CollectionPathStore, with the names of collections that have been
+       created or renamed since the store was built taking precedence. '''
+
+    def __init__(self, store, modified):
+        self.store = store
+        self.modified = modified
+
+    def __contains__(self, coll_id):
+        return coll_id in self.modified or coll_id in self.store
+
+    def __getitem__(self, coll_id):
+        coll_name = self.modified.get(coll_id)
+        return self.store[coll_id] if coll_name is None else coll_name
+
+    def get(self, coll_id, default=None):
+        coll_name = self.modified.get(coll_id)
+        return self.store.get(coll_id, default) if coll_name is None else coll_name
+
+
+class CatalogLookups(object):
+    '''Lookup tables of resources and collections that the checks need: the vault paths and names of
+       resources, and the names of collections.
+
+       If a cache directory is given, the tables are kept in a local cache between runs, separately
+       for each database. Resources are read again if the number of resources or their most recent
+       modification time has changed. The collection names are kept in a CollectionPathStore file,
+       which is memory-mapped rather than read. Collections that have been modified since the previous
+       run, according to their modification time, and the subcollections of those that have been renamed,
+       are read from the database and stored alongside it.
+       The store is rebuilt if collections have been removed, or if many collections have been modified.
+       Otherwise, the tables are read from the database.'''
+
+    def __init__(self, connection, cache_directory=None):
+        self.connection = connection
+        self.directory = None
+        self.resources = None
+        if cache_directory is not None:
+            self.identity = get_database_identity(connection)
+            self.directory = os.path.join(cache_directory,
+                                          hashlib.sha256(self.identity.encode("utf-8")).hexdigest()[:16])
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _query(self, query, params=None):
+        cursor = self.connection.cursor()
+        cursor.execute(query, params)
+        result = cursor.fetchall()
+        cursor.close()
+        return result
+
+    def _read_index(self, section):
+        '''Returns the cached information about a section of the cache, or None if there is none. '''
+        try:
+            with open(os.path.join(self.directory, section + ".json")) as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return None
+        if index.get('version') != CACHE_VERSION or index.get('database') != self.identity:
+            return None
+        return index
+
+    def _write_index(self, section, index):
+        '''Writes information about a section of the cache. The file is replaced atomically, so that
+           concurrent runs never read a partially written file. '''
+        index.update({'version': CACHE_VERSION, 'database': self.identity})
+        temp_filename = os.path.join(self.directory, section + ".json.tmp{}".format(os.getpid()))
+        with open(temp_filename, "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(temp_filename, os.path.join(self.directory, section + ".json"))
+
+    def _get_resources(self):
+        if self.resources is not None:
+            return self.resources
+        if self.directory is None:
+            self.resources = (utils.get_resource_vault_path_dict(self.connection),
+                              utils.get_resource_name_dict(self.connection))
+            return self.resources
+        table_version = list(self._query("SELECT count(*), max(modify_ts) FROM r_resc_main")[0])
+        index = self._read_index("resources")
+        if index is not None and index['table_version'] == table_version:
+            # JSON object keys are strings
+            self.resources = tuple({int(resc_id): value for resc_id, value in index[lookup].items()}
+                                   for lookup in ['vault_paths', 'names'])
+        else:
+            self.resources = (utils.get_resource_vault_path_dict(self.connection),
+                              utils.get_resource_name_dict(self.connection))
+            self._write_index("resources", {'table_version': table_version,
+                                            'vault_paths': self.resources[0],
+                                            'names': self.resources[1]})
+        return self.resources
+
+    def get_resource_vault_paths(self):
+        '''Returns a dictionary with resource ids (keys) and vault paths (values) of all unixfilesystem resources. '''
+        return self._get_resources()[0]
+
+    def get_resource_names(self):
+        '''Returns a dictionary with resource ids (keys) and resource names. '''
+        return self._get_resources()[1]
+
+    def get_collection_names(self):
+        '''Returns a mapping of collection ids to collection names. '''
+        if self.directory is None:
+            return CollectionPathStore.from_database(self.connection)
+        index = self._read_index("collections")
+        if index is not None:
+            result = self._update_collection_names(index)
+            if result is not None:
+                return result
+        return self._build_collection_names(index)
+
+    def _load_store(self, index):
+        try:
+            return CollectionPathStore.load(os.path.join(self.directory, index['filename']))
+        except (OSError, ValueError):
+            return None
+
+    def _update_collection_names(self, index):
+        '''Returns the cached collection names, along with the names of collections that have been
+           modified since the previous refresh, or None if the store needs to be rebuilt. '''
+        store = self._load_store(index)
+        if store is None:
+            return None
+        previous_modified = {int(coll_id): coll_name for coll_id, coll_name in index['modified'].items()}
+        modified = dict(previous_modified)
+        created = set()
+        last_modified = int(index['last_modified'])
+        now = utils.get_database_time(self.connection)
+        # Modified collections are read before the collections are counted, so that collections that are
+        # created or removed in between cause a rebuild rather than being missed
+        rows = self._query("SELECT coll_id, coll_name, modify_ts FROM r_coll_main WHERE modify_ts >= %s",
+                           (format_timestamp(last_modified - REFRESH_MARGIN),))
+        # iRODS does not update the modification time of the subcollections of a collection that is renamed
+        # or moved, so the subcollections of collections whose name has changed are read as well
+        renamed = [coll_name for coll_id, coll_name, _ in rows
+                   if modified.get(coll_id, store.get(coll_id, coll_name)) != coll_name]
+        if len(renamed) > 0:
+            rows.extend((coll_id, coll_name, None) for coll_id, coll_name in self._query(
+                "SELECT coll_id, coll_name FROM r_coll_main WHERE coll_name LIKE ANY(%s)",
+                ([utils.escape_like_pattern(coll_name) + "/%" for coll_name in renamed],)))
+        for coll_id, coll_name, modify_ts in rows:
+            if coll_id not in modified and coll_id not in store:
+                created.add(coll_id)
+            if store.get(coll_id) == coll_name:
+                modified.pop(coll_id, None)
+            else:
+                modified[coll_id] = coll_name
+            # Invalid timestamps and timestamps in the future are not used as the starting point of the next refresh
+            if modify_ts is not None and modify_ts.isdigit() and int(modify_ts) <= now:
+                last_modified = max(last_modified, int(modify_ts))
+        number_collections = self._query("SELECT count(*) FROM r_coll_main")[0][0]
+        if (number_collections != index['count'] + len(created)
+                or len(modified) > MAX_MODIFIED_FRACTION * number_collections):
+            return None
+        if (number_collections != index['count'] or last_modified != int(index['last_modified'])
+                or modified != previous_modified):
+            index.update({'count': number_collections, 'last_modified': last_modified, 'modified': modified})
+            self._write_index("collections", index)
+        return ModifiedCollectionNames(store, modified) if len(modified) > 0 else store
+
+    def _build_collection_names(self, previous_index):
+        '''Reads all collection names from the database, and replaces the cached store. '''
+        # The newest modification time is read before the names, so that the next refresh doesn't miss
+        # collections that are modified in between
+        last_modified = self._query("SELECT max(modify_ts) FROM r_coll_main WHERE modify_ts ~ '^[0-9]+$' "
+                                    + "AND modify_ts <= %s", (format_timestamp(utils.get_database_time(self.connection)),))[0][0]
+        store = CollectionPathStore.from_database(self.connection)
+        file_descriptor, temp_filename = tempfile.mkstemp(prefix="collections-", suffix=".store", dir=self.directory)
+        os.close(file_descriptor)
+        store.save(temp_filename)
+        filename = os.path.basename(temp_filename)
+        self._write_index("collections", {'filename': filename, 'count': len(store),
+                                          'last_modified': 0 if last_modified is None else int(last_modified),
+                                          'modified': {}})
+        if previous_index is not None and previous_index.get('filename') not in (None, filename):
+            try:
+                os.remove(os.path.join(self.directory, previous_index['filename']))
+            except OSError:
+                pass
+        # The workers of parallel scans map the cached file rather than a temporary copy
+        return self._load_store({'filename': filename}) or store
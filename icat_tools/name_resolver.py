@@ -0,0 +1,96 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''Dictionary-like cache that holds at most max_size entries. When it is full,
+       the least recently used entry is evicted. '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        return default
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class ObjectNameResolver(object):
+    '''Translates collection and data object ids to names. Ids that are not cached yet
+       are looked up in batches, so that reporting many findings does not result in
+       a database round trip per finding. '''
+
+    def __init__(self, connection, cache_size=100000, batch_size=1000):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.collection_cache = LRUCache(cache_size)
+        self.dataobject_cache = LRUCache(cache_size)
+
+    def _lookup_batches(self, query, ids):
+        cursor = self.connection.cursor()
+        for start in range(0, len(ids), self.batch_size):
+            cursor.execute(query, (ids[start:start + self.batch_size],))
+            for row in cursor:
+                yield row
+        cursor.close()
+
+    def resolve_collections(self, coll_ids):
+        '''Returns a dictionary with collection ids (keys) and collection names (values).
+           Ids of collections that do not exist are left out. '''
+        result = {}
+        missing = []
+        for coll_id in set(coll_ids):
+            coll_name = self.collection_cache.get(coll_id)
+            if coll_name is None:
+                missing.append(coll_id)
+            else:
+                result[coll_id] = coll_name
+
+        query = "SELECT coll_id, coll_name FROM r_coll_main WHERE coll_id = ANY(%s)"
+        for coll_id, coll_name in self._lookup_batches(query, missing):
+            self.collection_cache.put(coll_id, coll_name)
+            result[coll_id] = coll_name
+        return result
+
+    def resolve_dataobjects(self, data_ids):
+        '''Returns a dictionary with data object ids (keys) and full data object names (values).
+           Ids of data objects that do not exist, or whose collection does not exist, are left out. '''
+        dataobjects = {}
+        missing = []
+        for data_id in set(data_ids):
+            entry = self.dataobject_cache.get(data_id)
+            if entry is None:
+                missing.append(data_id)
+            else:
+                dataobjects[data_id] = entry
+
+        # The data object table has a separate entry for each replica, so the same
+        # id can occur multiple times.
+        query = "SELECT DISTINCT ON (data_id) data_id, coll_id, data_name FROM r_data_main WHERE data_id = ANY(%s)"
+        for data_id, coll_id, data_name in self._lookup_batches(query, missing):
+            self.dataobject_cache.put(data_id, (coll_id, data_name))
+            dataobjects[data_id] = (coll_id, data_name)
+
+        coll_names = self.resolve_collections(coll_id for coll_id, _ in dataobjects.values())
+        return {data_id: coll_names[coll_id] + "/" + data_name
+                for data_id, (coll_id, data_name) in dataobjects.items()
+                if coll_id in coll_names}
+
+    def get_collection_name(self, coll_id):
+        return self.resolve_collections([coll_id]).get(coll_id)
+
+    def get_dataobject_name(self, data_id):
+        return self.resolve_dataobjects([data_id]).get(data_id)
@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+
+
+class ProfiledCursor(object):
+    '''Wrapper around a database cursor that records the wall time, the time to the first row and
+       the number of rows fetched of the query that it executes. '''
+
+    def __init__(self, cursor, profiler, record):
+        self.cursor = cursor
+        self.profiler = profiler
+        self.record = record
+        self.start = None
+
+    @property
+    def itersize(self):
+        return self.cursor.itersize
+
+    @itersize.setter
+    def itersize(self, value):
+        self.cursor.itersize = value
+
+    def execute(self, query, params=None):
+        self.record['query'] = query
+        if self.profiler.explain:
+            self.record['explain'] = self.profiler.explain_query(self.cursor.connection, query, params)
+        self.start = time.monotonic()
+        self.cursor.execute(query, params)
+        self._update_wall_time()
+
+    def _update_wall_time(self):
+        self.record['wall_time'] = time.monotonic() - self.start
+
+    def _add_rows(self, number_rows):
+        if self.record['time_to_first_row'] is None and number_rows > 0:
+            self.record['time_to_first_row'] = time.monotonic() - self.start
+        self.record['rows_fetched'] += number_rows
+        self._update_wall_time()
+
+    def __iter__(self):
+        for row in self.cursor:
+            self._add_rows(1)
+            yield row
+        self._update_wall_time()
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        self._add_rows(0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self.cursor.fetchmany(size) if size is not None else self.cursor.fetchmany()
+        self._add_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self._add_rows(len(rows))
+        return rows
+
+    def close(self):
+        self.cursor.close()
+
+
+class QueryProfiler(object):
+    '''Collects statistics of the queries of the detectors: wall time, time to first row, rows
+       fetched and findings emitted, and optionally the output of EXPLAIN (ANALYZE, BUFFERS).
+       Getting the query plan executes each query a second time, so it makes checks much slower.
+
+       Cursors are created by the profiler, so that it can record their queries. Findings are counted
+       for the query that the detector ran last, so findings that are reported in batches after a scan
+       are counted for its last partition. The profiler can be used by multiple threads at the same time.'''
+
+    def __init__(self, explain=False):
+        self.explain = explain
+        self.records = []
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def cursor(self, connection, name=None, detector=None, check_name=None):
+        '''Returns a profiled cursor for the connection. Named cursors are server-side cursors. '''
+        cursor = connection.cursor(name) if name is not None else connection.cursor()
+        record = {'detector': detector,
+                  'check_name': check_name,
+                  'cursor_name': name,
+                  'query': None,
+                  'wall_time': 0,
+                  'time_to_first_row': None,
+                  'rows_fetched': 0,
+                  'findings': 0}
+        with self.lock:
+            self.records.append(record)
+        return ProfiledCursor(cursor, self, record)
+
+    def explain_query(self, connection, query, params):
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+        plan = cursor.fetchone()[0]
+        cursor.close()
+        return plan
+
+    def add_findings(self, cursor, number_findings=1):
+        '''Adds findings to the statistics of the query of a profiled cursor. '''
+        with self.lock:
+            cursor.record['findings'] += number_findings
+
+    def get_report(self):
+        with self.lock:
+            return {'total_time': time.monotonic() - self.start,
+                    'queries': list(self.records)}
+
+    def write_report(self, filename):
+        with open(filename, 'w') as report_file:
+            json.dump(self.get_report(), report_file, indent=2)
+            report_file.write("\n")
@@ -0,0 +1,310 @@
+from icat_tools import utils
+import contextlib
+import multiprocessing
+import psycopg2
+import psycopg2.extensions
+import threading
+import time
+
+# Minimum number of seconds between checks of the number of active sessions on the database
+SESSION_CHECK_INTERVAL = 5
+
+# Maximum number of seconds to wait before checking the number of active sessions again
+MAX_BACKOFF = 60
+
+# SQLSTATE of queries that have exceeded the lock timeout
+LOCK_NOT_AVAILABLE = '55P03'
+
+
+class TimeBudgetExceeded(Exception):
+    '''Raised when a check is stopped because the time budget of the run has been used up. '''
+
+
+class ScheduledCursor(object):
+    '''Wrapper around a database cursor that waits for the query scheduler before it executes its
+       query, and after each batch of rows that it fetches. The cursor holds a query slot of the
+       scheduler from the start of its query until all rows have been fetched or it is closed. '''
+
+    def __init__(self, cursor, scheduler, connection):
+        self.cursor = cursor
+        self.scheduler = scheduler
+        self.connection = connection
+        self.has_slot = False
+
+    @property
+    def itersize(self):
+        return self.cursor.itersize
+
+    @itersize.setter
+    def itersize(self, value):
+        self.cursor.itersize = value
+
+    @contextlib.contextmanager
+    def _query(self):
+        try:
+            yield
+        except BaseException as error:
+            self._release()
+            # Queries that have been cancelled because the statement timeout was lowered to the
+            # remaining time budget have exceeded the budget
+            if isinstance(error, psycopg2.extensions.QueryCanceledError):
+                self.scheduler.check_time_budget(margin=1)
+            raise
+
+    def _release(self):
+        if self.has_slot:
+            self.scheduler.release_slot()
+            self.has_slot = False
+
+    def _after_batch(self):
+        self.scheduler.throttle(self.connection)
+        self.scheduler.wait_for_database()
+
+    def execute(self, query, params=None):
+        self.scheduler.wait_for_database()
+        self.has_slot = self.scheduler.acquire_slot()
+        with self._query():
+            self.scheduler.limit_statement_time(self.connection)
+            self.cursor.execute(query, params)
+            self.scheduler.throttle(self.connection)
+
+    def __iter__(self):
+        batch_size = getattr(self.cursor, 'itersize', 2000)
+        number_rows = 0
+        with self._query():
+            for row in self.cursor:
+                yield row
+                number_rows += 1
+                if number_rows == batch_size:
+                    self._after_batch()
+                    number_rows = 0
+            self.scheduler.throttle(self.connection)
+        self._release()
+
+    def fetchone(self):
+        with self._query():
+            row = self.cursor.fetchone()
+            if row is None:
+                self.scheduler.throttle(self.connection)
+        if row is None:
+            self._release()
+        return row
+
+    def fetchmany(self, size=None):
+        with self._query():
+            rows = self.cursor.fetchmany(size) if size is not None else self.cursor.fetchmany()
+            self._after_batch()
+        if len(rows) == 0:
+            self._release()
+        return rows
+
+    def fetchall(self):
+        with self._query():
+            rows = self.cursor.fetchall()
+            self.scheduler.throttle(self.connection)
+        self._release()
+        return rows
+
+    def close(self):
+        self._release()
+        self.cursor.close()
+
+
+class QueryScheduler(object):
+    '''Limits the load that the checks put on the database server:
+       - rows_per_second limits the number of rows that the queries of the checks read per second, as
+         counted by the database server. It is enforced between batches of rows, so queries that read
+         many rows before they return any are followed by a pause.
+       - max_queries limits the number of queries that run at the same time, including queries of
+         concurrent checks (--jobs) and of worker processes of large scans (--scan-jobs).
+       - statement_timeout and lock_timeout (in milliseconds) are set for each connection, so that
+         they apply to each query. For large scans, the statement timeout applies to each batch of rows.
+       - max_sessions makes the checks wait, with increasing intervals, while more than this number of
+         other sessions are active on the database, e.g. those of busy iRODS servers.
+       - deadline (a Unix timestamp) is the end of the time budget of the run. Checks are stopped when
+         it has passed, and the statement timeout of each query is lowered to the remaining time, so
+         that long queries are cancelled as well.
+
+       The scheduler records the coverage of the run: whether each test and sub-check has been completed,
+       and how far the scans of tests that have been stopped have progressed.'''
+
+    def __init__(self, config, rows_per_second=None, max_queries=None, statement_timeout=None, lock_timeout=None,
+                 max_sessions=None, deadline=None, slots=None):
+        self.config = config
+        self.rows_per_second = rows_per_second
+        self.max_queries = max_queries
+        self.statement_timeout = statement_timeout
+        self.lock_timeout = lock_timeout
+        self.max_sessions = max_sessions
+        self.deadline = deadline
+        if slots is None and max_queries is not None:
+            # A semaphore of the spawn context can be used by threads as well as worker processes
+            slots = multiprocessing.get_context('spawn').BoundedSemaphore(max_queries)
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.rows_read = {}
+        self.available_at = time.monotonic()
+        self.monitor_connection = None
+        self.last_session_check = None
+        self.coverage = {}
+        self.progress = {}
+
+    def get_worker_settings(self, jobs):
+        '''Returns the arguments for a scheduler in each of a number of worker processes, which share
+           the query slots and the time budget. Each worker gets an equal part of the rows per second.'''
+        return {'config': self.config,
+                'rows_per_second': None if self.rows_per_second is None else self.rows_per_second / jobs,
+                'statement_timeout': self.statement_timeout,
+                'max_sessions': self.max_sessions,
+                'deadline': self.deadline,
+                'slots': self.slots}
+
+    def get_connection_options(self):
+        '''Returns the options for new connections, which set the timeouts of each query. '''
+        options = []
+        if self.statement_timeout is not None:
+            options.append("-c statement_timeout={:d}".format(self.statement_timeout))
+        if self.lock_timeout is not None:
+            options.append("-c lock_timeout={:d}".format(self.lock_timeout))
+        return " ".join(options) if len(options) > 0 else None
+
+    def cursor(self, cursor, connection):
+        return ScheduledCursor(cursor, self, connection)
+
+    def check_time_budget(self, margin=0):
+        if self.deadline is not None and time.time() >= self.deadline - margin:
+            raise TimeBudgetExceeded("time budget exceeded")
+
+    def limit_statement_time(self, connection):
+        '''Lowers the statement timeout of the next query to the remaining time budget. '''
+        if self.deadline is None:
+            return
+        remaining = max(1, int((self.deadline - time.time()) * 1000))
+        if self.statement_timeout is not None:
+            remaining = min(remaining, self.statement_timeout)
+        cursor = connection.cursor()
+        cursor.execute("SELECT set_config('statement_timeout', %s, false)", (str(remaining),))
+        cursor.close()
+
+    def acquire_slot(self):
+        '''Waits for a query slot. Returns True if a slot has been acquired, or False if no slot is
+           needed, e.g. because the thread already holds one. A thread holds at most one slot, so that
+           it cannot wait for itself.'''
+        self.check_time_budget()
+        if self.slots is None or getattr(self.local, 'slots_held', 0) > 0:
+            return False
+        while not self.slots.acquire(timeout=1):
+            self.check_time_budget()
+        self.local.slots_held = 1
+        return True
+
+    def release_slot(self):
+        self.local.slots_held = 0
+        self.slots.release()
+
+    def throttle(self, connection):
+        '''Waits until the rows that the queries on the connection have read so far are within the
+           limit of rows per second. '''
+        if self.rows_per_second is None:
+            return
+        rows = utils.get_rows_scanned(connection)
+        with self.lock:
+            previous = self.rows_read.get(id(connection), 0)
+            # The count starts again with each transaction
+            new_rows = rows - previous if rows >= previous else rows
+            self.rows_read[id(connection)] = rows
+            now = time.monotonic()
+            self.available_at = max(self.available_at, now) + new_rows / self.rows_per_second
+            delay = self.available_at - now
+        self._sleep(delay)
+
+    def _sleep(self, delay):
+        if self.deadline is not None and time.time() + delay >= self.deadline:
+            time.sleep(max(0, self.deadline - time.time()))
+            self.check_time_budget()
+        time.sleep(max(0, delay))
+
+    def get_active_sessions(self):
+        '''Returns the number of other sessions that are running a query on the database. Sessions of
+           the checker itself are not counted. '''
+        if self.monitor_connection is None:
+            self.monitor_connection = utils.get_connection_database(self.config)
+            self.monitor_connection.autocommit = True
+        cursor = self.monitor_connection.cursor()
+        cursor.execute("SELECT count(*) FROM pg_stat_activity WHERE datname = current_database() "
+                       + "AND state = 'active' AND application_name <> %s", (utils.APPLICATION_NAME,))
+        result = cursor.fetchone()[0]
+        cursor.close()
+        return result
+
+    def wait_for_database(self):
+        '''Waits while more than the maximum number of other sessions are active, with intervals that
+           double up to MAX_BACKOFF seconds. The number of sessions is checked at most once every
+           SESSION_CHECK_INTERVAL seconds. '''
+        self.check_time_budget()
+        if self.max_sessions is None:
+            return
+        backoff = 1
+        while True:
+            with self.lock:
+                # Another worker may have found that the database is no longer busy in the meantime
+                now = time.monotonic()
+                if self.last_session_check is not None and now - self.last_session_check < SESSION_CHECK_INTERVAL:
+                    return
+                if self.get_active_sessions() <= self.max_sessions:
+                    self.last_session_check = time.monotonic()
+                    return
+            # The lock is not held while waiting, so that other workers can use the scheduler
+            self._sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def plan(self, test, subcheck=None):
+        self.coverage[(test, subcheck)] = ('not started', None)
+
+    def set_completed(self, test, subcheck=None):
+        self.coverage[(test, subcheck)] = ('completed', None)
+
+    def set_progress(self, test, check_name, position):
+        with self.lock:
+            self.progress[(test, check_name)] = position
+
+    def run_check(self, connection, test, subcheck, run):
+        '''Runs a check, and records whether it has been completed. Checks whose queries exceed the
+           statement or lock timeout, or are cancelled because of a conflict with recovery on a hot
+           standby, are recorded as such; the transaction is restarted, so that other checks can
+           continue. Returns True if the check has been completed, along with its result.
+           TimeBudgetExceeded is raised again after it has been recorded.'''
+        try:
+            result = run()
+        except TimeBudgetExceeded:
+            self.coverage[(test, subcheck)] = ('stopped', "time budget exceeded")
+            connection.rollback()
+            raise
+        except psycopg2.OperationalError as error:
+            if not (isinstance(error, psycopg2.extensions.QueryCanceledError) or error.pgcode == LOCK_NOT_AVAILABLE
+                    or utils.is_recovery_conflict(connection, error)):
+                raise
+            self.coverage[(test, subcheck)] = ('stopped', str(error).strip().splitlines()[0])
+            utils.restart_transaction(connection)
+            return False, False
+        self.set_completed(test, subcheck)
+        return True, result
+
+    def is_complete(self):
+        return all(status == 'completed' for status, _ in self.coverage.values())
+
+    def get_coverage_report(self):
+        '''Returns lines with the coverage of each test and sub-check, and the position reached by
+           scans of checks that have been stopped.'''
+        lines = []
+        for (test, subcheck), (status, reason) in self.coverage.items():
+            name = test if subcheck is None else "{} ({})".format(test, subcheck)
+            line = "{}: {}".format(name, status)
+            if reason is not None:
+                line += " ({})".format(reason)
+            position = self.progress.get((test, subcheck))
+            if status == 'stopped' and position is not None:
+                line += ", scanned up to id {}".format(position)
+            lines.append(line)
+        return lines
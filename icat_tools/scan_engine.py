@@ -0,0 +1,214 @@
+from concurrent.futures import ProcessPoolExecutor
+from icat_tools import copy_reader, utils
+from icat_tools.query_scheduler import QueryScheduler, ScheduledCursor
+import multiprocessing
+
+# State of worker processes
+_worker_connection = None
+_worker_processor = None
+_worker_scheduler = None
+
+
+def _init_worker(config, snapshot_id, processor, scheduler_settings):
+    global _worker_connection, _worker_processor, _worker_scheduler
+    _worker_connection = utils.get_connection_database(config)
+    utils.import_snapshot(_worker_connection, snapshot_id)
+    _worker_processor = processor
+    if scheduler_settings is not None:
+        _worker_scheduler = QueryScheduler(**scheduler_settings)
+
+
+def _scan_partition(query, params, itersize, conflict_retries, column_types=None):
+    def _scan():
+        if column_types is not None:
+            return copy_reader.read_partition(_worker_connection, query, params, column_types, itersize,
+                                              _worker_processor)
+        cursor = _worker_connection.cursor("scan_partition")
+        if _worker_scheduler is not None:
+            cursor = _worker_scheduler.cursor(cursor, _worker_connection)
+        cursor.itersize = itersize
+        cursor.execute(query, params)
+        results = list(_worker_processor(cursor))
+        cursor.close()
+        return results
+
+    # Results are only returned when the partition is complete, so it can always be scanned again
+    return utils.run_with_conflict_retries(_worker_connection, _scan, conflict_retries)
+
+
+def iterate_rows(rows):
+    '''Processor that passes rows on unchanged. '''
+    for row in rows:
+        yield row
+
+
+def get_range_end(params):
+    '''Returns the position of a scan by ranges of ids after a partition: the end of its range. '''
+    return params[1]
+
+
+class RowVisitor(object):
+    '''Base class for processors that can also take part in a shared scan, in which the rows
+       of a table are read once and passed to multiple visitors in batches.
+
+       The visit method is called for each batch of rows in a partition, and the finish method
+       at the end of each partition. Both yield results. Visitors list the columns they need,
+       which are passed in that order, and whether they need the rows ordered by object id.
+
+       Scans that read rows using COPY call visit_columns with each batch of rows as a list of
+       columns instead, which visitors can override to process whole columns at once.'''
+    columns = ()
+    ordered = False
+
+    def visit(self, rows):
+        return iter(())
+
+    def visit_columns(self, columns):
+        return self.visit(zip(*columns))
+
+    def finish(self):
+        return iter(())
+
+    def __call__(self, rows):
+        for result in self.visit(rows):
+            yield result
+        for result in self.finish():
+            yield result
+
+
+class ScanEngine(object):
+    '''Runs large scans of catalog tables as a number of partitions, each with its own query
+       parameters (typically a range of object ids, or a resource id).
+
+       The rows of each partition are passed to a processor: a picklable callable that takes an
+       iterable of rows and yields results. If more than one job is configured, partitions are
+       processed by a pool of worker processes, each with its own connection and named cursor.
+       Workers use the snapshot of the connection that started the scan, so the result is the
+       same as that of a sequential scan. Processes are used rather than threads, so that
+       processing of rows can use multiple cores.
+
+       If a query scheduler is set, all queries of scans wait for it, including those of workers.
+       Partitions of workers whose query has been cancelled because of a conflict with recovery on a
+       hot standby are scanned again, up to conflict_retries times.
+
+       If the scan method is 'copy', rows are read using COPY rather than a cursor, and passed to the
+       processor in batches of columns, if the processor is a row visitor. Scans with a query scheduler
+       or a cursor factory use cursors, so that they can wait or be profiled between batches of rows.'''
+
+    def __init__(self, config=None, jobs=1, itersize=2000, page_size=1000000, scheduler=None, conflict_retries=0,
+                 scan_method='cursor'):
+        self.config = config
+        self.jobs = jobs
+        self.itersize = itersize
+        self.page_size = page_size
+        self.scheduler = scheduler
+        self.conflict_retries = conflict_retries
+        self.scan_method = scan_method
+
+    def is_parallel(self):
+        return self.jobs > 1 and self.config is not None
+
+    def uses_copy(self, processor, cursor_factory=None):
+        return (self.scan_method == 'copy' and isinstance(processor, RowVisitor) and cursor_factory is None
+                and self.scheduler is None)
+
+    def get_data_id_ranges(self, connection, after=None, paged=False):
+        '''Splits the range of data object ids into partitions. Returns a list of (low, high) tuples;
+           each partition contains the ids that are greater than low and less than or equal to high.
+
+           If after is set, only ids greater than it are included. If paged is set, the partitions are
+           pages of about page_size rows each, which are looked up one at a time, so that a scan can be
+           resumed after the last page that has been completed, and each query reads a limited number
+           of rows.'''
+        if paged:
+            return self._get_data_id_pages(connection, after, self.page_size)
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT min(data_id), max(data_id) FROM r_data_main")
+        min_id, max_id = cursor.fetchone()
+        cursor.close()
+        if min_id is None:
+            return []
+
+        # Use more partitions than jobs, so that work is still spread evenly over the workers
+        # if ids are not distributed evenly.
+        number_partitions = self.jobs * 4 if self.is_parallel() else 1
+        low = min_id - 1 if after is None else max(min_id - 1, after)
+        size = max(1, -(-(max_id - low) // number_partitions))
+        ranges = []
+        while low < max_id:
+            high = min(low + size, max_id)
+            ranges.append((low, high))
+            low = high
+        return ranges
+
+    def _get_data_id_pages(self, connection, after, page_size):
+        '''Yields the (low, high) data object id ranges of consecutive pages of about page_size rows,
+           using keyset pagination on the data object id index. All replicas of a data object are in
+           the same page. '''
+        cursor = connection.cursor()
+        low = -1 if after is None else after
+        while True:
+            cursor.execute("SELECT data_id FROM r_data_main WHERE data_id > %s ORDER BY data_id OFFSET %s LIMIT 1",
+                           (low, page_size - 1))
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute("SELECT max(data_id) FROM r_data_main WHERE data_id > %s", (low,))
+                row = cursor.fetchone()
+            if row[0] is None:
+                break
+            yield low, row[0]
+            low = row[0]
+        cursor.close()
+
+    def scan(self, connection, query, partitions, processor, cursor_factory=None, partition_done=None):
+        '''Runs the query once for each tuple of parameters in partitions, and yields the results of
+           the processor for each partition. Results are yielded in the order of the partitions.
+
+           The optional cursor factory is called with a cursor name to create the cursors of a sequential
+           scan, e.g. for profiling. Worker processes always create their own cursors. The optional
+           partition_done function is called with the parameters of each partition after all of its
+           results have been yielded, e.g. to record progress. '''
+        use_copy = self.uses_copy(processor, cursor_factory)
+        if not self.is_parallel():
+            column_types = None
+            for params in partitions:
+                if use_copy:
+                    if column_types is None:
+                        column_types = copy_reader.get_column_types(connection, query, params)
+                    for result in copy_reader.read_partition(connection, query, params, column_types, self.itersize,
+                                                             processor):
+                        yield result
+                else:
+                    cursor = cursor_factory("scan_partition") if cursor_factory is not None else connection.cursor("scan_partition")
+                    if self.scheduler is not None and not isinstance(cursor, ScheduledCursor):
+                        cursor = self.scheduler.cursor(cursor, connection)
+                    cursor.itersize = self.itersize
+                    cursor.execute(query, params)
+                    for result in processor(cursor):
+                        yield result
+                    cursor.close()
+                if partition_done is not None:
+                    partition_done(params)
+            return
+
+        snapshot_id = utils.export_snapshot(connection)
+        scheduler_settings = None if self.scheduler is None else self.scheduler.get_worker_settings(self.jobs)
+        column_types = None
+        if use_copy:
+            partitions = list(partitions)
+            if len(partitions) > 0:
+                column_types = copy_reader.get_column_types(connection, query, partitions[0])
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.jobs,
+                                 mp_context=context,
+                                 initializer=_init_worker,
+                                 initargs=(self.config, snapshot_id, processor, scheduler_settings)) as executor:
+            futures = [(params, executor.submit(_scan_partition, query, params, self.itersize, self.conflict_retries,
+                                                column_types))
+                       for params in partitions]
+            for params, future in futures:
+                for result in future.result():
+                    yield result
+                if partition_done is not None:
+                    partition_done(params)
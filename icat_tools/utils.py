@@ -1,6 +1,9 @@
 import json
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 import sys
+import weakref
 
 
 def read_database_config(config_filename):
@@ -15,48 +18,208 @@ def read_database_config(config_filename):
         return data['plugin_configuration']['database']
 
 
+def get_replica_config(config, host=None, port=None, name=None):
+    '''Returns the configuration for connections to a read-only copy of the database, such as a streaming
+       replica or a restored snapshot. Settings that are not given are the same as those of the database
+       in config. '''
+    replica_config = dict(config)
+    if host is not None:
+        replica_config['host'] = host
+    if port is not None:
+        replica_config['port'] = port
+    if name is not None:
+        replica_config['name'] = name
+    return replica_config
+
+
+# Application name of the connections of the checker, which distinguishes them from those of iRODS servers
+APPLICATION_NAME = 'icat-database-checker'
+
+
 def get_connection_database(config):
+    '''Returns a connection to the database. Connection options (e.g. timeouts) in the "options" entry
+       of the configuration are passed to the database server. '''
     try:
         connection = psycopg2.connect(user=config['username'],
                                       password=config['password'],
                                       host=config['host'],
                                       port=config['port'],
-                                      database=config['name'])
+                                      database=config['name'],
+                                      application_name=APPLICATION_NAME,
+                                      options=config.get('options'))
     except (Exception, psycopg2.Error) as error:
         print("Error while connecting to database: ", error)
         sys.exit(1)
     return connection
 
 
-def get_collection_name(connection, search_coll_id):
-    query = "SELECT coll_name FROM r_coll_main WHERE coll_id = {}".format(
-        str(search_coll_id))
+def get_connection_pool(config, size):
+    '''Returns a thread-safe pool of at most size connections to the database. '''
+    try:
+        pool = psycopg2.pool.ThreadedConnectionPool(1, size,
+                                                    user=config['username'],
+                                                    password=config['password'],
+                                                    host=config['host'],
+                                                    port=config['port'],
+                                                    database=config['name'],
+                                                    application_name=APPLICATION_NAME,
+                                                    options=config.get('options'))
+    except (Exception, psycopg2.Error) as error:
+        print("Error while connecting to database: ", error)
+        sys.exit(1)
+    return pool
+
+
+# Snapshots that connections have imported, so that they can be imported again in a new transaction
+_imported_snapshots = weakref.WeakKeyDictionary()
+
+# SQLSTATEs of queries on a hot standby that have been cancelled because of a conflict with recovery
+RECOVERY_CONFLICT_ERRORS = ['40001', '40P01']
+
+
+def begin_repeatable_read(connection):
+    '''Makes sure that the connection is in a REPEATABLE READ transaction, so that all of its queries see
+       the same database state. If it is not, a new read-only one is started, which uses the snapshot that
+       the connection has imported before, if any. '''
+    if not (connection.isolation_level == psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ
+            and connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS):
+        connection.rollback()
+        connection.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+        if connection in _imported_snapshots:
+            import_snapshot(connection, _imported_snapshots[connection])
+
+
+def get_snapshot(connection):
+    '''Returns a description of the snapshot of the current transaction of the connection. Transactions
+       with the same description see the same database state. '''
     cursor = connection.cursor()
-    cursor.execute(query)
-    if cursor.rowcount == 1:
-        collection = cursor.fetchone()
-        return collection[0]
-    elif cursor.rowcount > 1:
-        raise ValueError(
-            "Unexpected duplicate result when retrieving collection name.")
-    else:
-        return None
+    cursor.execute("SELECT CAST(txid_current_snapshot() AS text)")
+    result = cursor.fetchone()[0]
+    cursor.close()
+    return result
 
 
-def get_dataobject_name(connection, search_data_id):
-    query = "SELECT data_name, coll_id FROM r_data_main WHERE data_id = {}".format(
-        str(search_data_id))
+def export_snapshot(connection):
+    '''Returns the identifier of the snapshot of the connection, so that other connections can see
+       exactly the same database state. If the connection is not in a REPEATABLE READ transaction yet,
+       one is started (see begin_repeatable_read). The snapshot remains valid for as long as the
+       transaction stays open. '''
+    begin_repeatable_read(connection)
     cursor = connection.cursor()
-    cursor.execute(query)
+    cursor.execute("SELECT pg_export_snapshot()")
+    snapshot_id = cursor.fetchone()[0]
+    cursor.close()
+    return snapshot_id
+
+
+def import_snapshot(connection, snapshot_id):
+    '''Starts a read-only REPEATABLE READ transaction on the connection that uses a snapshot
+       exported by another connection. '''
+    connection.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    cursor = connection.cursor()
+    cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+    cursor.close()
+    _imported_snapshots[connection] = snapshot_id
+
 
-    if cursor.rowcount >= 1:
-        # It is possible that we get multiple matches for the dataobject id, because the table
-        # has separate entries for replicas
-        data_entry = cursor.fetchone()
-        return get_collection_name(
-            connection, data_entry[1]) + "/" + data_entry[0]
+def restart_transaction(connection):
+    '''Rolls back the transaction of the connection. If the connection has imported a snapshot, the new
+       transaction imports it again, so that the connection keeps seeing the same database state. This
+       fails if the transaction that exported the snapshot has ended. '''
+    connection.rollback()
+    snapshot_id = _imported_snapshots.get(connection)
+    if snapshot_id is not None:
+        import_snapshot(connection, snapshot_id)
+
+
+def is_recovery_conflict(connection, error):
+    '''Returns whether a query has been cancelled because of a conflict with recovery on a hot standby,
+       and the connection can still be used. The read-only transactions of the checks cannot fail with
+       serialization failures or deadlocks otherwise. '''
+    return isinstance(error, psycopg2.Error) and error.pgcode in RECOVERY_CONFLICT_ERRORS and not connection.closed
+
+
+def run_with_conflict_retries(connection, run, retries, can_retry=None):
+    '''Calls run, which queries the connection, and calls it again in a new transaction if a query has
+       been cancelled because of a conflict with recovery on a hot standby, up to retries times. The
+       optional can_retry function can prevent a retry, e.g. if results have already been reported. '''
+    attempt = 0
+    while True:
+        try:
+            return run()
+        except psycopg2.Error as error:
+            if attempt >= retries or not is_recovery_conflict(connection, error) or not (can_retry is None or can_retry()):
+                raise
+        attempt += 1
+        restart_transaction(connection)
+
+
+def get_database_time(connection):
+    '''Returns the current time of the database server, as a Unix timestamp. '''
+    cursor = connection.cursor()
+    cursor.execute("SELECT CAST(extract(epoch FROM now()) AS bigint)")
+    result = cursor.fetchone()[0]
+    cursor.close()
+    return result
+
+
+def get_rows_scanned(connection):
+    '''Returns the number of rows read by sequential and index scans of the connection in its
+       current transaction. '''
+    cursor = connection.cursor()
+    cursor.execute("SELECT coalesce(sum(seq_tup_read + coalesce(idx_tup_fetch, 0)), 0) FROM pg_stat_xact_user_tables")
+    result = int(cursor.fetchone()[0])
+    cursor.close()
+    return result
+
+
+# Maximum number of collection ids that are passed to queries as a parameter by the --data-object-prefix
+# condition. Collections under prefixes with more collections are selected by a subquery.
+MAX_PREFIX_COLLECTIONS = 10000
+
+
+def escape_like_pattern(value):
+    '''Escapes the wildcard characters of LIKE patterns in a string. '''
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def get_data_object_prefix_condition(connection, prefix):
+    '''Returns a query condition that selects the rows of r_data_main with a logical path that
+       starts with prefix, along with its query parameters.
+
+       The ids of the collections whose name starts with the prefix are looked up first, so that
+       data objects can be selected by collection id using an index. If there are more than
+       MAX_PREFIX_COLLECTIONS of them, e.g. for the prefix of a zone, the collections are selected
+       by a subquery instead, so that the ids are not sent with each query. Names of data objects
+       only need to be compared for the collections that the prefix ends in (e.g. /zone/home for
+       the prefix /zone/home/obj). '''
+    pattern = escape_like_pattern(prefix) + "%"
+    cursor = connection.cursor('get_data_object_prefix_condition')
+    cursor.execute("SELECT coll_id FROM r_coll_main WHERE coll_name LIKE %s LIMIT %s",
+                   (pattern, MAX_PREFIX_COLLECTIONS + 1))
+    coll_ids = [row[0] for row in cursor]
+    cursor.close()
+
+    # Collections whose name followed by a slash is a prefix of the prefix
+    boundary_colls = {prefix[:position]: prefix[position + 1:]
+                      for position in range(1, len(prefix)) if prefix[position] == "/"}
+    cursor = connection.cursor()
+    cursor.execute("SELECT coll_id, coll_name FROM r_coll_main WHERE coll_name = ANY(%s)",
+                   (list(boundary_colls),))
+    boundary_conditions = cursor.fetchall()
+    cursor.close()
+
+    if len(coll_ids) > MAX_PREFIX_COLLECTIONS:
+        condition = ("r_data_main.coll_id IN ( SELECT prefix_coll.coll_id FROM r_coll_main AS prefix_coll "
+                     + "WHERE prefix_coll.coll_name LIKE %s )")
+        params = (pattern,)
     else:
-        return None
+        condition = "r_data_main.coll_id = ANY(%s)"
+        params = (coll_ids,)
+    for coll_id, coll_name in boundary_conditions:
+        condition += " OR ( r_data_main.coll_id = %s AND r_data_main.data_name LIKE %s )"
+        params += (coll_id, escape_like_pattern(boundary_colls[coll_name]) + "%")
+    return "( " + condition + " )", params
 
 
 def get_resource_vault_path_dict(connection):
@@ -81,11 +244,11 @@ def get_resource_name_dict(connection):
     return result
 
 
-def get_coll_path_dict(connection):
-    '''Returns a dictionary with collection ids (keys) and collection names (values) of all collections. '''
-    query = "SELECT coll_id, coll_name FROM r_coll_main"
+def get_resource_host_dict(connection):
+    '''Returns a dictionary with resource ids (keys) and the host names of the resources. '''
+    query = "SELECT resc_id, resc_net from r_resc_main"
     result = {}
-    cursor = connection.cursor('get_coll_path_dict')
+    cursor = connection.cursor()
     cursor.execute(query)
     for row in cursor:
         result[row[0]] = row[1]
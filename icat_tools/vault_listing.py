@@ -0,0 +1,90 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+# Number of directories per thread that are listed ahead of the directory that is being read
+READ_AHEAD = 4
+
+
+def _list_directory(path):
+    '''Returns the entries of a directory as a sorted list of (sort key, name, size, modification time)
+       tuples, where the size and modification time of subdirectories are None, along with the error that
+       prevented the directory from being read, if any. Subdirectories sort as their name followed by a
+       slash, so that expanding them in place yields full paths in byte order. '''
+    entries = []
+    try:
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                if entry.is_dir(follow_symlinks=False):
+                    entries.append((entry.name + b"/", entry.name, None, None))
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    # The file has been removed after the directory was read
+                    continue
+                entries.append((entry.name, entry.name, stat.st_size, stat.st_mtime))
+    except OSError as error:
+        return [], error
+    entries.sort()
+    return entries, None
+
+
+class VaultListing(object):
+    '''Lists the files in a vault, in byte order of their paths. The listing yields (path, size,
+       modification time, error) tuples, with paths as bytes. Directories that cannot be read are listed
+       as their path followed by a slash, with the error, which sorts right before the paths that they
+       would contain.
+
+       Directories are read in depth-first order, so that memory use depends on the depth of the tree
+       and the size of its directories, not on the number of files. A pool of threads lists the
+       directories that will be needed next ahead of time, so that the latency of reading directories
+       and file sizes, e.g. on network file systems, is spread over multiple requests.'''
+
+    def __init__(self, root, jobs=8):
+        self.root = os.fsencode(root).rstrip(b"/")
+        self.jobs = jobs
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(max_workers=self.jobs)
+        futures = {}
+        # Directories that have been found but are not being listed yet, in the order in which they are needed
+        pending = deque()
+
+        def get_listing(path):
+            future = futures.pop(path, None)
+            if future is not None:
+                entries, error = future.result()
+            else:
+                if len(pending) > 0 and pending[0] == path:
+                    pending.popleft()
+                entries, error = _list_directory(path)
+            # The subdirectories are needed before the other directories that have been found
+            pending.extendleft(reversed([path + b"/" + name for _, name, size, _ in entries if size is None]))
+            while len(futures) < self.jobs * READ_AHEAD and len(pending) > 0:
+                next_path = pending.popleft()
+                futures[next_path] = executor.submit(_list_directory, next_path)
+            return entries, error
+
+        try:
+            stack = [(None, iter([(None, self.root, None, None)]))]
+            while len(stack) > 0:
+                directory, entries = stack[-1]
+                entry = next(entries, None)
+                if entry is None:
+                    stack.pop()
+                    continue
+                _, name, size, mtime = entry
+                path = name if directory is None else directory + b"/" + name
+                if size is not None:
+                    yield path, size, mtime, None
+                    continue
+                subdirectory_entries, error = get_listing(path)
+                if error is not None:
+                    yield path + b"/", None, None, error
+                else:
+                    stack.append((path, iter(subdirectory_entries)))
+        finally:
+            for future in futures.values():
+                future.cancel()
+            executor.shutdown()
@@ -7,6 +7,10 @@ setup(
     install_requires=[
         'psycopg2-binary>=2.7.7',
     ],
+    extras_require={
+        'zstd': ['zstandard>=0.15'],
+        'parquet': ['pyarrow>=8.0.0'],
+    },
     name='icat_tools',
     packages=['icat_tools', 'icat_tools.detectors'],
     entry_points={
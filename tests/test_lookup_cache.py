@@ -0,0 +1,81 @@
+'''Tests of the local cache of collection names.
+
+The tests create a synthetic catalog in a temporary schema of the PostgreSQL database given by the
+ICAT_CHECKER_TEST_DSN environment variable, and are skipped if it is not set. Never point it at a
+production database.'''
+
+from benchmarks import synthetic_catalog
+from icat_tools import utils
+from icat_tools.lookup_cache import CatalogLookups, format_timestamp
+import os
+import psycopg2
+import tempfile
+import unittest
+
+TEST_DSN = os.environ.get('ICAT_CHECKER_TEST_DSN')
+
+
+@unittest.skipIf(TEST_DSN is None, "ICAT_CHECKER_TEST_DSN is not set")
+class CollectionNameCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = psycopg2.connect(TEST_DSN)
+        self.schema = "lookup_cache_test_{}".format(os.getpid())
+        cursor = self.connection.cursor()
+        cursor.execute("CREATE SCHEMA {0}; SET search_path TO {0}".format(self.schema))
+        self.connection.commit()
+        cursor.close()
+        synthetic_catalog.create_schema(self.connection)
+        synthetic_catalog.populate(self.connection, collections=100, data_objects=100,
+                                   corruption={corruption_type: 0 for corruption_type in synthetic_catalog.CORRUPTION_RATES})
+        # A subtree below one of the collections
+        self.parent_id = synthetic_catalog.COLL_ID_OFFSET + 1
+        self.child_id = synthetic_catalog.COLL_ID_OFFSET + 1000
+        self.grandchild_id = synthetic_catalog.COLL_ID_OFFSET + 1001
+        self._execute("INSERT INTO r_coll_main (coll_id, parent_coll_name, coll_name, coll_owner_name, coll_owner_zone, "
+                      + "create_ts, modify_ts) VALUES "
+                      + "(%(child)s, '/zone0/home/coll1', '/zone0/home/coll1/sub', 'user0', 'zone0', %(ts)s, %(ts)s), "
+                      + "(%(grandchild)s, '/zone0/home/coll1/sub', '/zone0/home/coll1/sub/subsub', 'user0', 'zone0', "
+                      + "%(ts)s, %(ts)s)",
+                      {'child': self.child_id, 'grandchild': self.grandchild_id, 'ts': synthetic_catalog.TIMESTAMP})
+        # A recent modification, so that refreshes of the cache do not read the other collections again
+        self._execute("UPDATE r_coll_main SET modify_ts = %s WHERE coll_id = %s",
+                      (format_timestamp(utils.get_database_time(self.connection) - 3600),
+                       synthetic_catalog.COLL_ID_OFFSET + 2))
+        self.cache_directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.connection.rollback()
+        self._execute("DROP SCHEMA {} CASCADE".format(self.schema))
+        self.connection.close()
+        self.cache_directory.cleanup()
+
+    def _execute(self, query, params=None):
+        cursor = self.connection.cursor()
+        cursor.execute(query, params)
+        self.connection.commit()
+        cursor.close()
+
+    def _get_collection_names(self):
+        return CatalogLookups(self.connection, self.cache_directory.name).get_collection_names()
+
+    def test_rename_parent_collection(self):
+        self.assertEqual(self._get_collection_names()[self.child_id], "/zone0/home/coll1/sub")
+
+        # Like iRODS, only update the modification time of the renamed collection itself
+        self._execute("UPDATE r_coll_main SET coll_name = '/zone0/home/renamed', modify_ts = %s WHERE coll_id = %s",
+                      (format_timestamp(utils.get_database_time(self.connection)), self.parent_id))
+        self._execute("UPDATE r_coll_main SET parent_coll_name = '/zone0/home/renamed' || substr(parent_coll_name, 18), "
+                      + "coll_name = '/zone0/home/renamed' || substr(coll_name, 18) "
+                      + "WHERE coll_name LIKE '/zone0/home/coll1/%'")
+
+        collection_names = self._get_collection_names()
+        self.assertEqual(collection_names[self.parent_id], "/zone0/home/renamed")
+        self.assertEqual(collection_names[self.child_id], "/zone0/home/renamed/sub")
+        self.assertEqual(collection_names[self.grandchild_id], "/zone0/home/renamed/sub/subsub")
+        # Collections with a name that starts with the same characters are not affected
+        self.assertEqual(collection_names[synthetic_catalog.COLL_ID_OFFSET + 10], "/zone0/home/coll10")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+'''Tests of the comparison of vaults with the replicas in the catalog, using a vault in a temporary
+directory and hand-made replicas. They do not need a database.'''
+
+from icat_tools.detectors.vault_detector import GOOD_REPLICA, MTIME_MARGIN, reconcile
+from icat_tools.vault_listing import VaultListing
+import os
+import tempfile
+import time
+import unittest
+
+# Replica status of a stale replica
+STALE_REPLICA = 0
+
+
+class ReconcileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vault = tempfile.TemporaryDirectory()
+        self.addCleanup(self.vault.cleanup)
+        self.now = time.time()
+        self.max_mtime = self.now - MTIME_MARGIN
+        self.old_mtime = self.now - 2 * MTIME_MARGIN
+        self._create_file("home/coll1/obj1", 10)
+        self._create_file("home/coll1/obj2", 10)
+        self._create_file("home/coll2/stray", 5)
+
+    def _path(self, name):
+        return os.path.join(self.vault.name, name)
+
+    def _create_file(self, name, size, mtime=None):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(b"x" * size)
+        mtime = mtime if mtime is not None else self.old_mtime
+        os.utime(path, (mtime, mtime))
+
+    def _replica(self, name, data_id, data_size, replica_status=GOOD_REPLICA, modify_time=None):
+        return (self._path(name), data_id, data_size, replica_status,
+                modify_time if modify_time is not None else int(self.old_mtime))
+
+    def _reconcile(self, replicas, files=None):
+        files = files if files is not None else VaultListing(self.vault.name, jobs=2)
+        return [(issue_type, os.fsdecode(path), data_id, data_size, file_size)
+                for issue_type, path, data_id, data_size, file_size in reconcile(files, replicas, self.max_mtime)]
+
+    def test_consistent_vault(self):
+        self._create_file("home/coll2/obj3", 5)
+        replicas = [self._replica("home/coll1/obj1", 1, 10),
+                    self._replica("home/coll1/obj2", 2, 10),
+                    self._replica("home/coll2/obj3", 3, 5),
+                    self._replica("home/coll2/stray", 4, 5)]
+        self.assertEqual(self._reconcile(replicas), [])
+
+    def test_orphan_file(self):
+        replicas = [self._replica("home/coll1/obj1", 1, 10),
+                    self._replica("home/coll1/obj2", 2, 10)]
+        self.assertEqual(self._reconcile(replicas),
+                         [('orphan_file', self._path("home/coll2/stray"), None, None, 5)])
+
+    def test_missing_file(self):
+        replicas = [self._replica("home/coll1/obj1", 1, 10),
+                    self._replica("home/coll1/obj2", 2, 10),
+                    self._replica("home/coll1/obj3", 3, 10),
+                    self._replica("home/coll2/stray", 4, 5)]
+        self.assertEqual(self._reconcile(replicas),
+                         [('missing_file', self._path("home/coll1/obj3"), 3, 10, None)])
+
+    def test_missing_file_of_stale_replica(self):
+        replicas = [self._replica("home/coll1/obj1", 1, 10),
+                    self._replica("home/coll1/obj2", 2, 10),
+                    self._replica("home/coll1/obj3", 3, 10, replica_status=STALE_REPLICA),
+                    self._replica("home/coll2/stray", 4, 5)]
+        self.assertEqual(self._reconcile(replicas), [])
+
+    def test_size_mismatch(self):
+        replicas = [self._replica("home/coll1/obj1", 1, 10),
+                    self._replica("home/coll1/obj2", 2, 20),
+                    self._replica("home/coll2/stray", 4, 5, replica_status=STALE_REPLICA)]
+        self.assertEqual(self._reconcile(replicas),
+                         [('size_mismatch', self._path("home/coll1/obj2"), 2, 20, 10)])
+
+    def test_recent_files_and_replicas(self):
+        self._create_file("home/coll1/obj2", 20, mtime=self.now)
+        self._create_file("home/coll3/upload", 10, mtime=self.now)
+        replicas = [self._replica("home/coll1/obj1", 1, 10),
+                    self._replica("home/coll1/obj2", 2, 10),
+                    self._replica("home/coll1/obj3", 3, 10, modify_time=int(self.now)),
+                    self._replica("home/coll2/stray", 4, 5)]
+        self.assertEqual(self._reconcile(replicas), [])
+
+    def test_replicas_in_unreadable_directory(self):
+        files = [(os.fsencode(self._path("home/coll1")) + b"/", None, None, PermissionError("Permission denied")),
+                 (os.fsencode(self._path("home/coll2/stray")), 5, self.old_mtime, None)]
+        replicas = [self._replica("home/coll1/obj1", 1, 10),
+                    self._replica("home/coll1/obj3", 3, 10),
+                    self._replica("home/coll2/stray", 4, 5)]
+        issues = self._reconcile(replicas, files)
+        self.assertEqual([issue[:4] for issue in issues],
+                         [('unreadable_directory', self._path("home/coll1"), None, None)])
+
+    @unittest.skipIf(os.geteuid() == 0, "root can read directories without read permission")
+    def test_unreadable_directory(self):
+        os.chmod(self._path("home/coll1"), 0)
+        self.addCleanup(os.chmod, self._path("home/coll1"), 0o755)
+        replicas = [self._replica("home/coll1/obj1", 1, 10),
+                    self._replica("home/coll1/obj3", 3, 10),
+                    self._replica("home/coll2/stray", 4, 5)]
+        issues = self._reconcile(replicas)
+        self.assertEqual([issue[:4] for issue in issues],
+                         [('unreadable_directory', self._path("home/coll1"), None, None)])
+
+    def test_replicas_not_in_byte_order(self):
+        replicas = [self._replica("home/coll1/obj2", 2, 10),
+                    self._replica("home/coll1/obj1", 1, 10)]
+        with self.assertRaises(ValueError):
+            self._reconcile(replicas)
+
+
+if __name__ == '__main__':
+    unittest.main()